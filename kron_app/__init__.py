@@ -36,6 +36,16 @@ def make_celery(app):
             'schedule': timedelta(minutes=15),
             'args': []
         },
+        'solver_requested': {
+            'task': 'kron_app.tasks.task_solver_requested',
+            'schedule': timedelta(minutes=1),
+            'args': []
+        },
+        'refresh_availability': {
+            'task': 'kron_app.tasks.task_refresh_availability',
+            'schedule': timedelta(hours=1),
+            'args': []
+        },
         'purge_task_table': {
             'task': 'kron_app.tasks.task_purge_task_table',
             'schedule': timedelta(days=1),
@@ -1,6 +1,6 @@
 from kron_app import db
 from kron_app.utils import uid, flatten
-from kron_app.models import User, Email, Contact, AvailabilityEvent
+from kron_app.models import User, Email, Contact, AvailabilityEvent, AvailabilityInterval, AvailabilityHorizon
 from kron_app.events import events_for
 from kron_app.calendars import delete_calendar
 from kron_app.gcal_integration import GcalPushState
@@ -26,6 +26,8 @@ def remove(user):
         email.address = f'{uid()}@kronistic.com'
     Contact.query.filter((Contact.user_id==user.id)|(Contact.contact_id==user.id)).delete()
     AvailabilityEvent.query.filter_by(user_id=user.id).delete()
+    AvailabilityInterval.query.filter_by(user_id=user.id).delete()
+    AvailabilityHorizon.query.filter_by(user_id=user.id).delete()
     user.is_removed = True
     user.first_name = 'Deleted'
     user.last_name = 'User'
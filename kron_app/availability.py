@@ -3,7 +3,8 @@ from enum import IntEnum, unique
 from datetime import datetime, timedelta, date, time
 from dateutil.tz import gettz
 from sqlalchemy import desc
-from kron_app.models import Change, AvailabilityEvent as AEvent, Calendar, Event, EventState, Attendance, FixedEvent
+from sqlalchemy.dialects import postgresql
+from kron_app.models import Change, AvailabilityEvent as AEvent, AvailabilityInterval as AInterval, AvailabilityHorizon as AHorizon, Calendar, Event, EventState, Attendance, FixedEvent
 from kron_app.utils import to_utc, from_utc, dotdict, ids
 from kron_app.events import events_for
 from kron_app import db
@@ -91,23 +92,44 @@ class Occurence:
     def __repr__(self):
         return f'<Occurence start_at={repr(self.start_at)} end_at={repr(self.end_at)} tzname={repr(self.tzname)} cost={repr(self.cost)}>'
     def to_fixed_event(self):
-        assert 0 <= self.cost < UNAVAILABLE
-        return dotdict(kind='availability',
-                       start_at=self.utc_start_at,
-                       end_at=self.utc_end_at,
-                       kron_duty=True,
-                       costs=dict(everyone=self.cost),
-                       calendar=dict(user_id=self.user_id))
-
-def occurences(aevent):
-    cur_start_at = aevent.start_at # semantics of recurrence is repetitions in local time
-    cur_end_at = aevent.end_at # end time is preserved, not necessarily length
+        return availability_fixed_event(self.user_id, self.utc_start_at, self.utc_end_at, self.cost)
+
+def availability_fixed_event(user_id, utc_start_at, utc_end_at, cost):
+    assert 0 <= cost < UNAVAILABLE
+    return dotdict(kind='availability',
+                   start_at=utc_start_at,
+                   end_at=utc_end_at,
+                   kron_duty=True,
+                   costs=dict(everyone=cost),
+                   calendar=dict(user_id=user_id))
+
+def occurences(aevent, first=0):
+    # Occurrences from the `first`th (counting from 0) onwards.
+    cur_start_at = aevent.start_at + first*timedelta(days=7) # semantics of recurrence is repetitions in local time
+    cur_end_at = aevent.end_at + first*timedelta(days=7) # end time is preserved, not necessarily length
     unbounded = aevent.recur_end_at is None
     while unbounded or cur_end_at <= aevent.recur_end_at:
         yield Occurence(cur_start_at, cur_end_at, aevent.user_id, aevent.tzname, aevent.cost)
         cur_start_at += timedelta(days=7)
         cur_end_at += timedelta(days=7)
 
+def first_occurence(aevent, utc_window_start):
+    # The index of the first occurrence that can end after
+    # `utc_window_start`. Local times are within `maxoffset` of UTC,
+    # so occurrences ending (in local time) `maxoffset` or more before
+    # the window starts end before it in UTC, whatever the tz and DST.
+    # This can be up to one occurrence early, never late.
+    return max(0, (utc_window_start - maxoffset - aevent.end_at) // timedelta(days=7) + 1)
+
+def overlapping_occurences(aevent, utc_window_start, utc_window_end):
+    # Jumps straight to the window rather than stepping through every
+    # week since the event started.
+    for i in occurences(aevent, first_occurence(aevent, utc_window_start)):
+        if i.utc_start_at >= utc_window_end:
+            break
+        if overlaps(i, utc_window_start, utc_window_end):
+            yield i
+
 def overlaps(instance, utc_window_start, utc_window_end):
     return (utc_window_end is None or instance.utc_start_at < utc_window_end) and instance.utc_end_at > utc_window_start
 
@@ -121,11 +143,73 @@ def get_overlapping(utc_window_start, utc_window_end, user_ids):
                        .filter((AEvent.recur_end_at == None) | (AEvent.recur_end_at > (utc_window_start-maxoffset))) \
                        .all()
     for c in candidates:
-        for i in occurences(c):
-            if i.utc_start_at > utc_window_end:
-                break
-            if overlaps(i, utc_window_start, utc_window_end):
-                out.append(i)
+        out.extend(overlapping_occurences(c, utc_window_start, utc_window_end))
+    return out
+
+
+# Materialized Availability
+# -------------------------
+#
+# Expanding recurrences each time the solver asks for availability is
+# slow, so each user's occurrences are also kept in UTC, as
+# AvailabilityInterval rows, over the window recorded in their
+# AvailabilityHorizon (from `lookback` before to `horizon` after when
+# it was written). They are rewritten whenever the user's availability
+# events change and rolled forward daily by
+# `task_refresh_availability`. Windows outside a user's horizon fall
+# back to `get_overlapping`.
+
+horizon = timedelta(days=90)
+lookback = timedelta(days=7)
+
+def materialize(user_id, utcnow=None):
+    if utcnow is None:
+        utcnow = datetime.utcnow()
+    start_at = utcnow - lookback
+    end_at = utcnow + horizon
+    AInterval.query.filter_by(user_id=user_id).delete()
+    rows = [dict(user_id=user_id, start_at=i.utc_start_at, end_at=i.utc_end_at, cost=i.cost)
+            for i in get_overlapping(start_at, end_at, [user_id])]
+    if rows:
+        db.session.execute(AInterval.__table__.insert(), rows)
+    stmt = postgresql.insert(AHorizon).values(user_id=user_id, start_at=start_at, end_at=end_at)
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['user_id'], set_=dict(start_at=start_at, end_at=end_at)))
+
+def refresh_materialized(utcnow=None):
+    # Users with availability who have no horizon, or whose horizon
+    # ends within a day of where it should.
+    if utcnow is None:
+        utcnow = datetime.utcnow()
+    stale = db.session.query(AEvent.user_id).distinct() \
+                      .outerjoin(AHorizon, AHorizon.user_id == AEvent.user_id) \
+                      .filter((AHorizon.user_id == None) | (AHorizon.end_at < utcnow + horizon - timedelta(days=1))) \
+                      .all()
+    for (user_id,) in stale:
+        materialize(user_id, utcnow)
+    db.session.commit()
+    return len(stale)
+
+def get_overlapping_fixed_events(utc_window_start, utc_window_end, user_ids):
+    # Availability overlapping the window as fixed events, read from
+    # the materialized intervals of users whose horizon covers it.
+    user_ids = {int(u) for u in user_ids}
+    if not user_ids:
+        return []
+    covered = set(u for (u,) in db.session.query(AHorizon.user_id)
+                                          .filter(AHorizon.user_id.in_(user_ids),
+                                                  AHorizon.start_at <= utc_window_start,
+                                                  AHorizon.end_at >= utc_window_end))
+    out = []
+    if covered:
+        intervals = AInterval.query \
+                             .filter(AInterval.user_id.in_(covered)) \
+                             .filter(AInterval.start_at < utc_window_end, AInterval.end_at > utc_window_start) \
+                             .order_by(AInterval.id) \
+                             .all()
+        out.extend(availability_fixed_event(i.user_id, i.start_at, i.end_at, i.cost) for i in intervals)
+    rest = user_ids - covered
+    if rest:
+        out.extend(i.to_fixed_event() for i in get_overlapping(utc_window_start, utc_window_end, rest))
     return out
 
 @unique
@@ -220,7 +304,6 @@ def make_splits(i, utc_window_start, utc_window_end):
                    cost=i.cost)
         db.session.add(a)
 
-# TODO: do this arithmetic, rather than generate and test?
 def clear_window(utc_window_start, utc_window_end, user_id):
     candidates = AEvent.query \
                        .filter_by(user_id=user_id) \
@@ -228,8 +311,11 @@ def clear_window(utc_window_start, utc_window_end, user_id):
                        .filter(AEvent.start_at < (utc_window_end+maxoffset)) \
                        .all()
     for c in candidates:
-        lastgood = None # remember lastgood, so we can patch up. if no last good, delete
-        for i in occurences(c):
+        # Occurrences before `first` all end before the window, so the
+        # last of them is the last good one so far.
+        first = first_occurence(c, utc_window_start)
+        lastgood = next(occurences(c, first-1)) if first > 0 else None # remember lastgood, so we can patch up. if no last good, delete
+        for i in occurences(c, first):
             if i.utc_end_at < utc_window_start:
                 lastgood = i
             elif overlaps(i, utc_window_start, utc_window_end):
@@ -422,6 +508,7 @@ def api_set_availability(user, d, bitmap, recur):
     else:
         clear_window(utc_start, utc_end, user.id)
     set_bitmap(user, local_start, user.tzname, bitmap, recur)
+    materialize(user.id)
     db.session.commit()
 
 
@@ -445,3 +532,4 @@ def add_core_availability(user, start_time, end_time, days, utcnow=None):
                        recur_end_at=None,
                        cost=0)
             db.session.add(a)
+    materialize(user.id, utcnow)
@@ -3,7 +3,7 @@ from sqlalchemy import desc
 from sqlalchemy.dialects import postgresql
 from kron_app import db
 from kron_app.models import Change, Event, EventState, FixedEvent
-from kron_app.utils import ids
+from kron_app.utils import ids, to_utc
 
 # When the "change" corresponds to a modified (fixed)event we record the
 # event as either `Change.event` or `Change.fixed_event`. This allows us
@@ -29,6 +29,23 @@ def record_current(event):
     stmt = postgresql.insert(Change).values(**change).on_conflict_do_nothing()
     db.session.execute(stmt)
 
+def record_current_rows(rows, user):
+    # As `record_current`, for many fixed events of one of `user`'s
+    # calendars at once. `rows` need only have the `id`, `start_dt`,
+    # `end_dt` and `all_day` columns.
+    if len(rows) == 0:
+        return
+    def utc(dt, all_day):
+        return to_utc(dt, user.tz) if all_day else dt
+    changes = [dict(start_at = utc(r.start_dt, r.all_day),
+                    end_at = utc(r.end_dt, r.all_day),
+                    users = [user.id],
+                    fixed_event_id = r.id,
+                    conflict = False)
+               for r in rows]
+    stmt = postgresql.insert(Change).on_conflict_do_nothing()
+    db.session.execute(stmt, changes)
+
 def record_approx_calendar_changes(calendar):
     # Approximate the effect of deleting a calendar by recording a
     # single space spanning the fixed events on the calendar.
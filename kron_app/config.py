@@ -43,4 +43,21 @@ def mkconfig(env):
     SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD') or '',
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY'),
     PERMANENT_SESSION_LIFETIME = timedelta(days=7),
+    SOLVER_BACKEND = os.environ.get('KRON_SOLVER_BACKEND') or 'z3',
+    SOLVER_PROCESSES = int(os.environ.get('KRON_SOLVER_PROCESSES') or 1),
+    SOLVER_INCREMENTAL = (os.environ.get('KRON_SOLVER_INCREMENTAL') or '') in ('1', 'true'),
+    # Fraction of successful solver runs logged with their problem, failures always are.
+    SOLVER_LOG_SAMPLE = float(os.environ.get('KRON_SOLVER_LOG_SAMPLE') or 1),
+    # Solver runs wait for requests to stop for this long, but no longer than the max latency.
+    SOLVER_DEBOUNCE = timedelta(seconds=int(os.environ.get('KRON_SOLVER_DEBOUNCE') or 10)),
+    SOLVER_MAX_LATENCY = timedelta(seconds=int(os.environ.get('KRON_SOLVER_MAX_LATENCY') or 60)),
+    # Write solver logs from the task queue, off the solver run. Tests run without a worker.
+    SOLVER_LOG_ASYNC = (os.environ.get('KRON_SOLVER_LOG_ASYNC') or ('0' if env == 'test' else '1')) in ('1', 'true'),
+    # Syncs of a user's draft events to gcal wait this long, so that those requested together are batched.
+    GCAL_SYNC_BATCH_DELAY = timedelta(seconds=int(os.environ.get('KRON_GCAL_SYNC_BATCH_DELAY') or 5)),
+    # Calls per gcal batch request. The api allows up to 1000, but batches are processed as their individual calls,
+    # and larger batches are more likely to hit rate limits.
+    GCAL_BATCH_SIZE = int(os.environ.get('KRON_GCAL_BATCH_SIZE') or 50),
+    # Syncs with failed calls are queued again this many times, backing off from GCAL_SYNC_BATCH_DELAY.
+    GCAL_SYNC_RETRIES = int(os.environ.get('KRON_GCAL_SYNC_RETRIES') or 5),
   )
@@ -1,8 +1,10 @@
 import os
+import re
 import json
 import time
 from uuid import uuid4
 import urllib.parse
+from collections import namedtuple
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
 from kron_app import app, db
@@ -78,8 +80,11 @@ class OAuthSession:
     self.user = user
 
   def _with_error_handling(self, method, *args, **kwargs):
+    return self._handle_response(lambda: getattr(self.oauthsession, method)(*args, **kwargs))
+
+  def _handle_response(self, request):
     try:
-      resp = getattr(self.oauthsession, method)(*args, **kwargs)
+      resp = request()
     except InvalidGrantError:
       self._inc_count()
       return
@@ -127,6 +132,36 @@ class OAuthSession:
   def delete(self, *args, **kwargs):
     return self._with_error_handling('delete', *args, **kwargs)
 
+  # Start a request on `executor` (a `concurrent.futures.Executor`),
+  # returning a function that waits for and returns its response.
+  # (When `executor` is `None` the request is made immediately.)
+  #
+  # Only the http request happens on the executor. The error handling
+  # above, and stashing any refreshed token on the user, both touch
+  # the db session, so are deferred until the response is waited for,
+  # in the calling thread. Callers must not use this session for
+  # anything else until then.
+  def prefetch(self, executor, method, *args, **kwargs):
+    if executor is None:
+      resp = self._with_error_handling(method, *args, **kwargs)
+      return lambda: resp
+    new_tokens = []
+    def request():
+      token_updater = self.oauthsession.token_updater
+      self.oauthsession.token_updater = new_tokens.append
+      try:
+        return getattr(self.oauthsession, method)(*args, **kwargs)
+      finally:
+        self.oauthsession.token_updater = token_updater
+    future = executor.submit(request)
+    def result():
+      try:
+        return future.result()
+      finally:
+        for token in new_tokens:
+          self.oauthsession.token_updater(token)
+    return lambda: self._handle_response(result)
+
 
 # The `get_oauth_session_for_user` method wraps up:
 #
@@ -201,7 +236,7 @@ def chk_resp(resp):
 # OAuthSession internally using `get_oauth_session_for_user` on
 # `calendar` and `draft_event.calendar` respectively.
 
-def list_gcal_entries(google, calendar, page_token=None, sync_token=None, single_events=True):
+def list_gcal_entries_params(page_token, sync_token, single_events):
   assert type(single_events) == bool
   # There appears to be a bug in the gcal api, which leads to call to
   # list events to sometimes incorrectly return the empty list.
@@ -221,7 +256,9 @@ def list_gcal_entries(google, calendar, page_token=None, sync_token=None, single
     params['pageToken'] = page_token
   if sync_token is not None:
     params['syncToken'] = sync_token
-  resp = google.get(gcal_events_uri(calendar.gcal_id), params=params)
+  return params
+
+def list_gcal_entries_payload(resp, sync_token):
   if sync_token is not None and resp.status_code == 410:
     # Signal full sync required.
     # https://developers.google.com/calendar/api/guides/sync#full_sync_required_by_server
@@ -229,6 +266,19 @@ def list_gcal_entries(google, calendar, page_token=None, sync_token=None, single
   chk_resp(resp)
   return resp.json()
 
+def list_gcal_entries(google, calendar, page_token=None, sync_token=None, single_events=True):
+  params = list_gcal_entries_params(page_token, sync_token, single_events)
+  resp = google.get(gcal_events_uri(calendar.gcal_id), params=params)
+  return list_gcal_entries_payload(resp, sync_token)
+
+# As `list_gcal_entries`, but the request is started on `executor`
+# (see `OAuthSession.prefetch`). Returns a function that waits for and
+# returns the payload.
+def prefetch_gcal_entries(executor, google, calendar, page_token=None, sync_token=None, single_events=True):
+  params = list_gcal_entries_params(page_token, sync_token, single_events)
+  wait = google.prefetch(executor, 'get', gcal_events_uri(calendar.gcal_id), params=params)
+  return lambda: list_gcal_entries_payload(wait(), sync_token)
+
 def exists_gcal_entry(google, calendar, uid):
   params = {'iCalUID': f'{uid}@google.com', 'showHiddenInvitations': False}
   resp = google.get(gcal_events_uri(calendar.gcal_id), params=params)
@@ -284,6 +334,70 @@ def delete_gcal_entry(google, gcal_id, uid):
       return
     chk_resp(resp)
 
+# Batch requests bundle several api calls into a single http request,
+# with the calls and their responses as the parts of multipart/mixed
+# bodies.
+# https://developers.google.com/calendar/api/guides/batch
+GCAL_BATCH_URI = 'https://www.googleapis.com/batch/calendar/v3'
+# The most calls the api allows per batch. (We make smaller batches,
+# see GCAL_BATCH_SIZE in config.)
+GCAL_BATCH_MAX = 1000
+
+# `uri` is as for a plain request, and `json` is the request body (or
+# `None`). `json` in a result is the response body, when there is one.
+BatchCall = namedtuple('BatchCall', ['method', 'uri', 'json'])
+BatchResult = namedtuple('BatchResult', ['status_code', 'json'])
+
+def encode_gcal_batch(calls, boundary):
+  parts = []
+  for i, call in enumerate(calls):
+    url = urllib.parse.urlsplit(call.uri)
+    path = f'{url.path}?{url.query}' if url.query else url.path
+    headers = ['Content-Type: application/json'] if call.json is not None else []
+    body = json.dumps(call.json) if call.json is not None else ''
+    parts.append('\r\n'.join([f'--{boundary}',
+                               'Content-Type: application/http',
+                               f'Content-ID: <item{i}>',
+                               '',
+                               f'{call.method} {path} HTTP/1.1',
+                               *headers,
+                               '',
+                               body]))
+  return '\r\n'.join(parts + [f'--{boundary}--', ''])
+
+def decode_gcal_batch(content_type, text):
+  # Returns a dict mapping the index of each call to its `BatchResult`.
+  boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+  results = dict()
+  for part in text.split(f'--{boundary}')[1:]:
+    if part.startswith('--'):
+      break
+    part_headers, _, http = re.split(r'(\r?\n\r?\n)', part.strip(), maxsplit=1)
+    content_id = re.search(r'^Content-ID: <response-item(\d+)>', part_headers, flags=re.M|re.I)
+    if content_id is None:
+      continue
+    status_line_and_headers, _, body = (re.split(r'(\r?\n\r?\n)', http, maxsplit=1) + ['', ''])[:3]
+    status_code = int(status_line_and_headers.split()[1])
+    body = body.strip()
+    results[int(content_id.group(1))] = BatchResult(status_code, json.loads(body) if body else None)
+  return results
+
+def batch_gcal_calls(google, calls):
+  """make several calls with a single batch request"""
+  # Returns a `BatchResult` for each call (`None` for any call missing
+  # from the response), or `None` if the batch request itself failed
+  # in a way handled by `OAuthSession`.
+  assert 0 < len(calls) <= GCAL_BATCH_MAX
+  boundary = uuid4().hex
+  resp = google.post(GCAL_BATCH_URI,
+                     data=encode_gcal_batch(calls, boundary).encode(),
+                     headers={'Content-Type': f'multipart/mixed; boundary={boundary}'})
+  if resp is None:
+    return
+  chk_resp(resp)
+  results = decode_gcal_batch(resp.headers['Content-Type'], resp.text)
+  return [results.get(i) for i in range(len(calls))]
+
 def watch_gcal_resource(google, resource, ttl):
   assert type(resource) in (User, Calendar)
   assert type(ttl) == int and ttl > 0
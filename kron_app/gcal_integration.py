@@ -4,19 +4,21 @@ import itertools
 import json
 import math
 import random
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from hashlib import md5
 from pprint import pprint
 from datetime import datetime, timedelta, timezone
 from enum import Enum
-from sqlalchemy import func
+from sqlalchemy import func, or_, update
+from sqlalchemy.dialects import postgresql
 from dateutil import parser
 from dateutil.rrule import rrulestr
 from kron_app import app, db
-from kron_app.models import User, Calendar, Event, EventState, FixedEvent, Change, Email, GcalSyncLog, GcalResponseState, Attendance, AttendeeResponse, GcalPushState
-from kron_app.gcal_api import get_oauth_session_for_user, chk_resp, list_gcal_entries, get_gcal_entry, create_gcal_entry, update_gcal_entry, delete_gcal_entry, watch_gcal_resource, get_gcal_calendar_metadata, list_gcal_settings, get_gcal_setting, GCAL_EVENT_UID_PREFIX, create_gcal_calendar, list_gcal_calendars, stop_gcal_channel, exists_gcal_entry
-from kron_app.changes import record_current
+from kron_app.models import User, Calendar, Event, EventState, FixedEvent, Change, Contact, Email, GcalSyncLog, GcalResponseState, Attendance, AttendeeResponse, GcalPushState
+from kron_app.gcal_api import get_oauth_session_for_user, chk_resp, gcal_events_uri, batch_gcal_calls, BatchCall, prefetch_gcal_entries, get_gcal_entry, create_gcal_entry, update_gcal_entry, delete_gcal_entry, watch_gcal_resource, get_gcal_calendar_metadata, list_gcal_settings, get_gcal_setting, GCAL_EVENT_UID_PREFIX, create_gcal_calendar, list_gcal_calendars, stop_gcal_channel, exists_gcal_entry
+from kron_app.changes import record_current, record_current_rows
 from kron_app.poems import make_edit_poem
-from kron_app.users import find_user_by_email
 from kron_app.utils import tznames, uid, to_utc, ids
 import kron_app.mail as mail
 from kron_app.kron_directives import parse_kron_directive
@@ -102,34 +104,39 @@ def get_kron_duty_and_costs(item):
 def get_attendee_emails(item):
     return [a['email'] for a in item.get('attendees', []) if 'email' in a]
 
-def gcal_list_entries_generator(calendar, incremental=False, single_events=True):
+def gcal_list_entries_generator(calendar, incremental=False, single_events=True, prefetch=True):
     if incremental and calendar.gcal_sync_token is None:
         raise Exception('sync token must be present to perform an incremental fetch')
     sync_token = calendar.gcal_sync_token if incremental else None
     google = get_oauth_session_for_user(calendar.user)
-    next_page_token = None
-    while True:
+    # With `prefetch`, the request for the next page is made while the
+    # consumer is processing the current one. Requests are made on a
+    # single background thread, and we never run more than one page
+    # ahead, so a calendar has at most one request in flight.
+    with ThreadPoolExecutor(max_workers=1) if prefetch else nullcontext() as executor:
         # Not doing a db commit here, even though list_gcal_settings
         # might have fetched a new token. Instead, leave that to
         # callers. (Often stashing the next_sync_token will take care
         # of this.)
-        payload = list_gcal_entries(google, calendar, next_page_token, sync_token, single_events)
-
-        # Always yield an (items_array, result_tuple). This makes the
-        # implementation of consumers a a little cleaner. Before a
-        # break, set the first element of result tuple to be a status.
-        # The second element of the tuple is the (optional)
-        # next_sync_token.
-        if payload is None:
-            yield [], ('full_sync_required', None)
-            break
-        if 'nextPageToken' in payload:
-            next_page_token = payload['nextPageToken']
-            yield payload['items'], (None, None)
-        else:
-            assert 'nextSyncToken' in payload
-            yield payload['items'], ('ok', payload['nextSyncToken'])
-            break
+        pending = prefetch_gcal_entries(executor, google, calendar, None, sync_token, single_events)
+        while True:
+            payload = pending()
+
+            # Always yield an (items_array, result_tuple). This makes the
+            # implementation of consumers a a little cleaner. Before a
+            # break, set the first element of result tuple to be a status.
+            # The second element of the tuple is the (optional)
+            # next_sync_token.
+            if payload is None:
+                yield [], ('full_sync_required', None)
+                break
+            if 'nextPageToken' in payload:
+                pending = prefetch_gcal_entries(executor, google, calendar, payload['nextPageToken'], sync_token, single_events)
+                yield payload['items'], (None, None)
+            else:
+                assert 'nextSyncToken' in payload
+                yield payload['items'], ('ok', payload['nextSyncToken'])
+                break
 
 def differ(fixed_event, item):
     start_dt, end_dt, all_day = get_start_end(item)
@@ -150,19 +157,30 @@ def build_fixed_event(item, calendar):
     db.session.add(f)
     return f
 
-def get_contact_pairs(item, user, all_emails):
-    kron_attendee_emails = (set(e.lower() for e in get_attendee_emails(item)) | {user.email}) & all_emails
-    return set(tuple(sorted(pair)) for pair in itertools.combinations(kron_attendee_emails, 2))
+def get_contact_pairs(items, user):
+    # The pairs of kron users attending the same item, as `(user_id,
+    # contact_id)` in both orders. `user` (whose calendar the items
+    # are from) is taken to attend every item. Attendee addresses are
+    # resolved to users with a single query per page.
+    attendee_emails = [set(e.lower() for e in get_attendee_emails(item)) for item in items]
+    addresses = set().union(*attendee_emails)
+    user_ids = dict()
+    if len(addresses) > 0:
+        stmt = db.select([Email.address, Email.user_id]) \
+                 .where(Email.address.in_(addresses)) \
+                 .where(Email.user_id != None)
+        user_ids = dict(db.session.execute(stmt).all())
+    contact_pairs = set()
+    for emails in attendee_emails:
+        kron_attendee_ids = set(user_ids[e] for e in emails if e in user_ids) | {user.id}
+        contact_pairs |= set(itertools.permutations(kron_attendee_ids, 2))
+    return contact_pairs
 
 def populate_contacts(contact_pairs):
-    for email1, email2 in contact_pairs:
-        user1 = find_user_by_email(email1)
-        user2 = find_user_by_email(email2)
-        if user1 is None or user2 is None or user1 == user2:
-            continue
-        user1.contacts.append(user2)
-        user2.contacts.append(user1)
-    db.session.commit()
+    if len(contact_pairs) == 0:
+        return
+    stmt = postgresql.insert(Contact).on_conflict_do_nothing()
+    db.session.execute(stmt, [dict(user_id=user_id, contact_id=contact_id) for user_id, contact_id in contact_pairs])
 
 def append_gcal_sync_log(calendar, full, elapsed_secs, num_items, num_changes):
     elapsed = int(elapsed_secs*1000) # ms
@@ -170,6 +188,69 @@ def append_gcal_sync_log(calendar, full, elapsed_secs, num_items, num_changes):
     db.session.add(entry)
     db.session.commit()
 
+# The columns written by full sync, and compared to decide whether an
+# existing fixed event has changed.
+FIXED_EVENT_SYNC_COLUMNS = ['start_dt', 'end_dt', 'all_day', 'kron_duty', 'jsoncosts']
+
+def fixed_event_row(item, calendar, kron_duty, costs):
+    # The columns of the fixed event for `item`, as a dict suitable
+    # for a bulk insert. (c.f. `build_fixed_event`.)
+    start_dt, end_dt, all_day = get_start_end(item)
+    return dict(calendar_id=calendar.id,
+                uid=item['id'],
+                start_dt=start_dt,
+                end_dt=end_dt,
+                all_day=all_day,
+                kron_duty=kron_duty,
+                jsoncosts=None if costs is None else json.dumps(costs, default=repr),
+                dirty=True)
+
+def row_differs(fixed_event, row):
+    # c.f. `differ`. Costs are compared decoded, since equal costs
+    # needn't have been serialized identically.
+    def costs(jsoncosts):
+        return json.loads(jsoncosts) if jsoncosts else None
+    return (fixed_event.start_dt != row['start_dt'] or
+            fixed_event.end_dt != row['end_dt'] or
+            fixed_event.all_day != row['all_day'] or
+            fixed_event.kron_duty != row['kron_duty'] or
+            costs(fixed_event.jsoncosts) != costs(row['jsoncosts']))
+
+def select_fixed_event_rows(calendar, uids):
+    # The rows (not ORM objects) of the given fixed events.
+    columns = [FixedEvent.id, FixedEvent.uid] + [getattr(FixedEvent, c) for c in FIXED_EVENT_SYNC_COLUMNS]
+    stmt = db.select(columns) \
+             .where(FixedEvent.calendar_id == calendar.id) \
+             .where(FixedEvent.uid.in_(uids))
+    return db.session.execute(stmt).all()
+
+def upsert_fixed_events(rows):
+    # Insert new fixed events and update existing ones in a single
+    # statement. The `where` makes updating a row that hasn't changed
+    # a no-op, so it isn't marked dirty.
+    if len(rows) == 0:
+        return
+    stmt = postgresql.insert(FixedEvent)
+    changed = [getattr(FixedEvent, c).is_distinct_from(getattr(stmt.excluded, c)) for c in FIXED_EVENT_SYNC_COLUMNS]
+    stmt = stmt.on_conflict_do_update(index_elements=[FixedEvent.calendar_id, FixedEvent.uid],
+                                      set_={c: getattr(stmt.excluded, c) for c in FIXED_EVENT_SYNC_COLUMNS + ['dirty']},
+                                      where=or_(*changed))
+    db.session.execute(stmt, rows)
+
+def delete_fixed_events(calendar, uids):
+    # Record the current position of the given fixed events, then
+    # delete them in bulk. Returns the number deleted.
+    rows = select_fixed_event_rows(calendar, uids)
+    record_current_rows(rows, calendar.user)
+    fixed_event_ids = [r.id for r in rows]
+    # The ORM would unlink the changes from the deleted fixed events,
+    # so that's done by hand here.
+    db.session.execute(db.update(Change)
+                         .where(Change.fixed_event_id.in_(fixed_event_ids))
+                         .values(fixed_event_id=None))
+    db.session.execute(db.delete(FixedEvent).where(FixedEvent.id.in_(fixed_event_ids)))
+    return len(fixed_event_ids)
+
 def gcal_sync_full(calendar, api_calls=None):
     """perform a full sync of a google calendar."""
     t0 = time.time()
@@ -181,53 +262,38 @@ def gcal_sync_full(calendar, api_calls=None):
     stmt = db.select([FixedEvent.uid]).filter_by(calendar=calendar)
     fixed_to_delete = set(db.session.execute(stmt).scalars().all())
 
-    # Having `all_emails` in memory is convenient for now, but will
-    # breakdown eventually.
-    #
-    all_emails = set(e.address for e in Email.query.filter(Email.user!=None).all())
-    contact_pairs = set()
-
     num_items = 0
     num_changes = 0
 
+    # Each page is parsed into rows, compared against the existing
+    # fixed events (fetched as rows rather than ORM objects), and then
+    # the new and modified rows are written with a single upsert. This
+    # keeps full sync of calendars with 10k+ entries to a handful of
+    # statements per page.
     for items, (_, next_sync_token) in api_calls:
         num_items += len(items)
-        uids = [item['id'] for item in items]
-        fixed_events = FixedEvent.query \
-                                 .filter_by(calendar=calendar) \
-                                 .filter(FixedEvent.uid.in_(uids)) \
-                                 .all()
-        fixed_event_lookup = dict((f.uid,f) for f in fixed_events)
-        added = dict()
+        populate_contacts(get_contact_pairs(items, calendar.user))
+        rows = dict()
         for item in items:
             uid = item['id']
-            contact_pairs |= get_contact_pairs(item, calendar.user, all_emails)
             kron_duty, costs = get_kron_duty_and_costs(item)
             if is_draft_event(uid):
                 pass
             elif (not is_free(item) or kron_duty) and can_import_gcal_entry(item):
-                fixed_event = fixed_event_lookup.get(uid)
-                if fixed_event is None:
-                    assert uid not in fixed_to_delete
-                    if uid not in added:
-                        # New fixed event.
-                        build_fixed_event(item, calendar)
-                        added[uid] = item
-                        num_changes += 1
-                    else:
-                        print(f'gcal_sync_full: skipping uid={uid}, calendar_id={calendar.id}, same={added[uid]==item}')
-                elif fixed_event is not None and differ(fixed_event, item):
-                    # Modified existing fixed event. Record current position then update.
-                    record_current(fixed_event)
-                    fixed_event.start_dt, fixed_event.end_dt, fixed_event.all_day = get_start_end(item)
-                    fixed_event.kron_duty = kron_duty
-                    fixed_event.costs = costs
-                    fixed_event.dirty = True
-                    fixed_to_delete.discard(uid) # Don't delete the new fixed event later!
-                    num_changes += 1
+                row = fixed_event_row(item, calendar, kron_duty, costs)
+                if uid not in rows:
+                    rows[uid] = row
                 else:
-                    # No change to existing fixed event.
-                    fixed_to_delete.discard(uid)
+                    print(f'gcal_sync_full: skipping uid={uid}, calendar_id={calendar.id}, same={rows[uid]==row}')
+        existing = select_fixed_event_rows(calendar, list(rows))
+        # Modified existing fixed events. Record current position before updating.
+        modified = [f for f in existing if row_differs(f, rows[f.uid])]
+        record_current_rows(modified, calendar.user)
+        existing_uids = set(f.uid for f in existing)
+        added = [row for uid, row in rows.items() if uid not in existing_uids]
+        upsert_fixed_events(added + [rows[f.uid] for f in modified])
+        fixed_to_delete -= rows.keys() # Don't delete the fixed events seen in this page!
+        num_changes += len(added) + len(modified)
         db.session.commit()
 
     if next_sync_token:
@@ -236,18 +302,10 @@ def gcal_sync_full(calendar, api_calls=None):
     db.session.commit()
 
     if len(fixed_to_delete) > 0:
-        print('will delete the following fixed events:')
-        print(fixed_to_delete)
-        for f in FixedEvent.query \
-                           .filter_by(calendar=calendar) \
-                           .filter(FixedEvent.uid.in_(fixed_to_delete)) \
-                           .all():
-            record_current(f)
-            db.session.delete(f)
-            num_changes += 1
+        print(f'gcal_sync_full: deleting {len(fixed_to_delete)} fixed events, calendar_id={calendar.id}')
+        num_changes += delete_fixed_events(calendar, list(fixed_to_delete))
         db.session.commit()
 
-    populate_contacts(contact_pairs)
     append_gcal_sync_log(calendar, True, time.time() - t0, num_items, num_changes)
 
 class IncSyncResult(Enum):
@@ -301,9 +359,6 @@ def gcal_sync_incremental(calendar, api_calls=None):
     if api_calls is None:
         api_calls = gcal_list_entries_generator(calendar, incremental=True)
 
-    all_emails = set(e.address for e in Email.query.filter(Email.user!=None).all())
-    contact_pairs = set()
-
     num_items = 0
     num_changes = 0
     recurring_events_to_remove = set()
@@ -316,10 +371,10 @@ def gcal_sync_incremental(calendar, api_calls=None):
                                  .filter(FixedEvent.uid.in_(uids)) \
                                  .all()
         fixed_event_lookup = dict((f.uid,f) for f in fixed_events)
+        populate_contacts(get_contact_pairs(items, calendar.user))
         added = dict()
         for item in items:
             uid = item['id']
-            contact_pairs |= get_contact_pairs(item, calendar.user, all_emails)
             if item['status'] == 'cancelled':
                 # Calendar entry deleted.
                 #
@@ -404,7 +459,6 @@ def gcal_sync_incremental(calendar, api_calls=None):
             num_changes += 1
         db.session.commit()
 
-    populate_contacts(contact_pairs)
     append_gcal_sync_log(calendar, False, time.time() - t0, num_items, num_changes)
 
     if status == 'full_sync_required':
@@ -698,6 +752,168 @@ def gcal_sync_event_2(attendance_id, api=None, yank=False):
         db.session.commit() # refresh token
 
 
+def gcal_request_sync_2(event, yank=False):
+    """Mark the attendances of `event` as needing their calendar entries
+    syncing, to be done by `gcal_sync_user_2`. Returns the ids of
+    the users to sync.
+
+    """
+    assert event.gcal_sync_version==2, f'gcal_request_sync_2 can not sync {event}'
+    attendances = [a for a in event.attendances if a.email.user is not None]
+    for a in attendances:
+        a.gcal_sync_pending = True
+        a.gcal_sync_yank = yank # The most recent request wins.
+    db.session.commit()
+    return [a.email.user_id for a in attendances]
+
+def gcal_sync_2_op(a, user, yank, creatable):
+    # The api call needed to sync attendance `a`, as `(kind, entry,
+    # entry_hash)`, or `None`. This makes the same decisions as
+    # `gcal_sync_event_2`. `creatable` is the set of event ids that
+    # `user` has the quota to create entries for.
+    event = a.event
+    if (event.is_scheduled() or event.is_past()) and do_sync_2_for_this_attendee(user.id, event) and not yank:
+        entry = gcal_event_data_n_by_1(event, user) # NOTE: no id set yet
+        entry_hash = hashstr(json.dumps(entry))
+        if not a.gcal_uid:
+            if event.id in creatable:
+                entry['id'] = GCAL_EVENT_UID_PREFIX + uid()
+                return 'create', entry, entry_hash
+        elif entry_hash != a.gcal_hash:
+            assert user.gcal_push_id == a.gcal_push_id
+            return 'update', entry, entry_hash
+    elif a.gcal_uid:
+        assert user.gcal_push_id == a.gcal_push_id
+        return 'delete', None, None
+    return None
+
+def gcal_batch_call(kind, a, entry, gcal_id):
+    uri = gcal_events_uri(gcal_id)
+    if kind == 'create':
+        return BatchCall('POST', uri, entry)
+    elif kind in ('update', 'accept'):
+        return BatchCall('PUT', f'{uri}/{a.gcal_uid}', entry)
+    else:
+        assert kind == 'delete'
+        # Sanity check, as in `delete_gcal_entry`.
+        if not is_draft_event(a.gcal_uid):
+            raise Exception(f'Attempt to delete non-kron gcal entry uid={a.gcal_uid}')
+        return BatchCall('DELETE', f'{uri}/{a.gcal_uid}', None)
+
+def gcal_sync_2_remark(attendance_ids, yanks):
+    # Mark attendances claimed by `gcal_sync_user_2` as needing syncing
+    # again. Those already marked by a request made since the claim are
+    # left alone, since the most recent request wins.
+    for id in attendance_ids:
+        db.session.execute(update(Attendance)
+                           .where(Attendance.id == id, Attendance.gcal_sync_pending == False)
+                           .values(gcal_sync_pending=True, gcal_sync_yank=yanks[id])
+                           .execution_options(synchronize_session=False))
+
+def gcal_sync_user_2(user_id, google=None):
+    """Sync the calendar entries of all of a user's attendances marked by
+    `gcal_request_sync_2`, using batch requests. This does the same
+    work as calling `gcal_sync_event_2` on each attendance, but with a
+    single oauth session, GCAL_BATCH_SIZE (see config) calls per http
+    request, and a commit per batch.
+
+    Calls that fail leave their attendance marked, to be retried (see
+    `task_gcal_sync_user_2`). Returns the number of them. If anything
+    raises, the attendances whose calls weren't made, or failed, are
+    marked again before re-raising.
+
+    """
+    # Claim the pending attendances before making any api calls, so
+    # that concurrent syncs for the user don't repeat them.
+    attendances = Attendance.query \
+                            .join(Email, Attendance.email_id==Email.id) \
+                            .filter(Email.user_id==user_id, Attendance.gcal_sync_pending==True) \
+                            .order_by(Attendance.id) \
+                            .with_for_update(of=Attendance, skip_locked=True) \
+                            .all()
+    yanks = dict()
+    for a in attendances:
+        yanks[a.id] = a.gcal_sync_yank
+        a.gcal_sync_pending = False
+        a.gcal_sync_yank = False
+    db.session.commit()
+
+    user = User.query.get(user_id)
+    if not user.gcal_sync_enabled:
+        return 0
+    if not user.gcal_push_state == GcalPushState.ON:
+        return 0
+
+    batch_size = app.config['GCAL_BATCH_SIZE']
+    failed = 0
+    called = set() # ids of attendances whose calls have been made
+    retry = set() # ids of those whose calls failed
+    try:
+        # See the correctness sketch in `gcal_sync_event_2`. Creating all
+        # of the events in the first `gcal_quota` of the queue at once is
+        # the same as creating them one at a time, in order.
+        creatable = set(ids(gcal_event_queue_for(user.id))[:user.gcal_quota])
+        ops = []
+        for a in attendances:
+            assert a.event.gcal_sync_version==2, f'gcal_sync_user_2 can not sync {a.event}'
+            op = gcal_sync_2_op(a, user, yanks[a.id], creatable)
+            if op is not None:
+                kind, entry, entry_hash = op
+                ops.append((kind, a, entry, entry_hash))
+
+        if google is None:
+            google = get_oauth_session_for_user(user)
+        while len(ops) > 0:
+            # Updates are checked for the attendee's response, and updated
+            # again (an 'accept') if it isn't "accepted".
+            accepts = []
+            for i in range(0, len(ops), batch_size):
+                batch = ops[i:i+batch_size]
+                results = batch_gcal_calls(google, [gcal_batch_call(kind, a, entry, user.gcal_push_id) for kind, a, entry, _ in batch])
+                if results is None:
+                    results = [None] * len(batch)
+                # Don't make these calls again if anything raises from
+                # here on. (Creating the entries again would duplicate
+                # them.)
+                called.update(a.id for _, a, _, _ in batch)
+                for (kind, a, entry, entry_hash), result in zip(batch, results):
+                    ok = result is not None and (200 <= result.status_code < 300 or (kind == 'delete' and result.status_code == 410))
+                    if not ok:
+                        print(f'gcal_sync_user_2: {kind} failed for attendance {a.id}, result={result}')
+                        gcal_sync_2_remark([a.id], yanks)
+                        retry.add(a.id)
+                        failed += 1
+                        continue
+                    if kind == 'create':
+                        a.gcal_uid = result.json['id']
+                        a.gcal_hash = entry_hash
+                        a.gcal_push_id = user.gcal_push_id
+                        user.gcal_quota -= 1
+                        a.gcal_create_count += 1
+                    elif kind in ('update', 'accept'):
+                        a.gcal_hash = entry_hash
+                        a.gcal_update_count += 1
+                        if kind == 'update' and user.id in a.event.draft_attendees: # We don't set to accepted when attendee is unavailable.
+                            response_status = next((att for att in (result.json or {}).get('attendees', []) if att.get('email') == user.email), {}).get('responseStatus')
+                            if response_status != 'accepted':
+                                accepts.append(('accept', a, entry, entry_hash))
+                    else:
+                        a.gcal_uid = None
+                        a.gcal_hash = None
+                        a.gcal_push_id = None
+                        a.gcal_delete_count += 1
+                db.session.commit() # refresh token
+            ops = accepts
+    except:
+        # Mark whatever wasn't called, or failed, again, so that it
+        # isn't lost.
+        db.session.rollback()
+        gcal_sync_2_remark([a.id for a in attendances if a.id not in called or a.id in retry], yanks)
+        db.session.commit()
+        raise
+    return failed
+
+
 def gcal_create_calendar_for_push(user):
     KRON_CALENDAR_SUMMARY = 'kalendar'
     assert user.gcal_push_state == GcalPushState.CREATING
@@ -0,0 +1,60 @@
+#an in memory index of items with a [start, end) interval and a set of users, for questions like
+#"which items of users U overlap [a, b)?" without going back to the db. see run_solver.ProblemData.
+
+from bisect import bisect_left, insort
+
+class IntervalIndex():
+  """
+  per user, items are kept sorted by start, with the longest item length for that user.
+  an item overlapping [a, b) then starts in [a - longest, b), which bisect finds, and only those are checked.
+  results come back in the order the items were added. items can be added and removed after building.
+  items are removed by key (default their id, the primary key for db rows), so an equal copy removes the original.
+  items whose key is None (eg availability, which isn't stored by row) can't be removed.
+  """
+  def __init__(self, items=(), start=lambda x: x.start_at, end=lambda x: x.end_at, users=lambda x: x.users,
+               key=lambda x: getattr(x, 'id', None)):
+    self.start, self.end, self.users, self.key = start, end, users, key
+    self.by_user = {}   #user -> sorted [(start, seq)]
+    self.longest = {}   #user -> longest end-start of their items
+    self.items = {}     #seq -> (item, start, end, users)
+    self.seqs = {}      #key(item) -> seq
+    self.next_seq = 0
+    for item in items:
+      self.add(item)
+
+  def __len__(self):
+    return len(self.items)
+
+  def add(self, item):
+    s, e, us, k = self.start(item), self.end(item), {int(u) for u in self.users(item)}, self.key(item)
+    if k is not None and k in self.seqs:
+      raise ValueError(f"an item with key {k} is already in the index")
+    seq = self.next_seq
+    self.next_seq += 1
+    self.items[seq] = (item, s, e, us)
+    if k is not None:
+      self.seqs[k] = seq
+    for u in us:
+      insort(self.by_user.setdefault(u, []), (s, seq))
+      length = e - s
+      if u not in self.longest or length > self.longest[u]:
+        self.longest[u] = length
+
+  def remove(self, item):
+    #longest is left as it was, which only makes later lookups look a little further back
+    seq = self.seqs.pop(self.key(item))
+    _, s, _, us = self.items.pop(seq)
+    for u in us:
+      entries = self.by_user[u]
+      del entries[bisect_left(entries, (s, seq))]
+
+  def overlapping(self, start, end, user_ids):
+    found = set()
+    for u in {int(u) for u in user_ids}:
+      entries = self.by_user.get(u)
+      if not entries:
+        continue
+      lo = bisect_left(entries, (start - self.longest[u],))
+      hi = bisect_left(entries, (end,))
+      found.update(seq for _,seq in entries[lo:hi] if self.items[seq][2] > start)
+    return [self.items[seq][0] for seq in sorted(found)]
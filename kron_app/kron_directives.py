@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 from lark import Lark, UnexpectedInput, Visitor
 
 # KRON_DIR_RE = re.compile(r'^\s*@kron(istic)?(\s+if\s+needed)?\s*$', re.IGNORECASE)
@@ -67,13 +68,21 @@ class BuildCostDict(Visitor):
 
 grammar = Lark(KRON_DIR_CFG,g_regex_flags=re.I)
 
-def parse_kron_directive(s):
-    # Returns a pair `(kron_duty, priority)`.
-    # `kron_duty`: flag indicating whether this is a kron duty event
-    # `priority`: optional int. None => required, int => optional with int giving priority
+KRON_TAG_RE = re.compile(r'@kron',flags=re.I)
 
-  is_kron_directive=re.search(r'@kron',s,flags=re.I)
-  if is_kron_directive is not None:
+def _words(terminal):
+  #the alternatives of a terminal of KRON_DIR_CFG that's a list of words, as a regex
+  alternatives = re.search(rf'^\s*{terminal}: (.*)$',KRON_DIR_CFG,flags=re.M).group(1)
+  return '|'.join(re.escape(w) for w in re.findall(r'"([^"]+)"',alternatives))
+
+#the most common directives: a single spec for everyone, eg "@kron", "@kron if really needed", "@kron free if needed".
+#the groups are the REALLYs and the NEEDED of the ifneeded, if any. trailing dots are ignored, as by the grammar.
+#anything else (people, several specs, ..) goes to the grammar.
+SIMPLE_DIR_RE = re.compile(rf'\s*@kron(?:istic)?(?:\s+(?:{_words("_AVAILABLE")}))?(?:\s+if((?:\s+(?:{_words("REALLY")}))*)\s+({_words("NEEDED")}))?[\s.]*',flags=re.I)
+
+def parse_kron_directive_grammar(s):
+  #as parse_kron_directive, always using the grammar
+  if KRON_TAG_RE.search(s) is not None:
 
     try:
       tree = grammar.parse(s,start='start') 
@@ -90,3 +99,37 @@ def parse_kron_directive(s):
     return True, costs if tuple(costs.keys()) == ('everyone',) else {}
   #this is the case where there is no " @kron" in the string:
   return False, None
+
+#directive text longer than this is parsed but not cached, which bounds what the cache holds.
+MAX_CACHED_DIRECTIVE = 256
+
+@lru_cache(maxsize=4096)
+def _parse_kron_directive(s):
+  if KRON_TAG_RE.search(s) is None:
+    return False, None
+  m = SIMPLE_DIR_RE.fullmatch(s)
+  if m is not None:
+    #the cost is the number of REALLYs and NEEDEDs, as in BuildCostDict.ifneeded
+    really, needed = m.groups()
+    cost = 0 if needed is None else len(really.split())+1
+    return True, {'everyone':cost}
+  return parse_kron_directive_grammar(s)
+
+def parse_kron_directive(s):
+    # Returns a pair `(kron_duty, priority)`.
+    # `kron_duty`: flag indicating whether this is a kron duty event
+    # `priority`: optional int. None => required, int => optional with int giving priority
+
+  #summaries repeat a lot (eg the instances of recurring events), so results are cached by directive text: from the kron tag
+  #on, since whitespace before it is skipped by the grammar (anything else before it is kept, the grammar rejects it).
+  #non-directives are rejected by KRON_TAG_RE before the cache, simple directives parsed by SIMPLE_DIR_RE, and only
+  #the rest use the (slow, earley) grammar.
+  tag = KRON_TAG_RE.search(s)
+  if tag is None:
+    return False, None
+  if s[:tag.start()].isspace():
+    s = s[tag.start():]
+  parse = _parse_kron_directive if len(s) <= MAX_CACHED_DIRECTIVE else _parse_kron_directive.__wrapped__
+  kron_duty, costs = parse(s)
+  #copied, since callers own the costs
+  return kron_duty, None if costs is None else dict(costs)
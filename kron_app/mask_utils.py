@@ -1,5 +1,7 @@
 from copy import deepcopy
+from itertools import accumulate
 import math
+import numpy as np
 from enum import Enum, auto
 from datetime import datetime, timedelta
 from kron_app.utils import DotDict
@@ -250,6 +252,181 @@ class PWlinear(PWfn):
         return fn(False, p[0]*x + p[1])
     return super().abstract_eval(x,If,linearfn)
 
+  def __eq__(self,other):
+    if isinstance(other,PWlinearArray):
+      return other == self
+    return super().__eq__(other)
+
+EPOCH = datetime(1970,1,1)
+US = timedelta(microseconds=1)
+
+class PWlinearArray():
+  """
+  array backed version of PWlinear, for masks whose edges are datetimes.
+  edges are int64 microseconds since EPOCH, right[i] is True when edge i is Topo.RIGHT,
+  and the value in each domain is the line (m[i],b[i]) (same units as PWlinear, so there is one more value than edges).
+  each edge is also a "cut" in the line with the point x doubled: a RIGHT edge cuts just before x, a LEFT edge just after.
+  so cut keys 2*x (RIGHT) and 2*x+1 (LEFT) are totally ordered, and combining two functions is a union of their keys
+  plus a searchsorted to find which domain of each is in force after every cut -- no per-segment python objects.
+  use from_pwlinear/to_pwlinear to move between the representations, == compares across them.
+  """
+  def __init__(self, edges=(), right=(), m=(0,), b=(0,)):
+    self.edges = np.asarray(edges, dtype=np.int64)
+    self.right = np.asarray(right, dtype=bool)
+    self.m = np.asarray(m, dtype=np.float64)
+    self.b = np.asarray(b, dtype=np.float64)
+
+  @classmethod
+  def from_pwlinear(cls, pw):
+    edges = pw.data[1::2]
+    vals = pw.data[::2]
+    return cls([(e.val-EPOCH)//US for e in edges],
+               [e.side==Topo.RIGHT for e in edges],
+               [v[0] for v in vals],
+               [v[1] for v in vals])
+
+  def to_pwlinear(self):
+    data = [(float(self.m[0]),float(self.b[0]))]
+    for x,r,m,b in zip(self.edges.tolist(),self.right.tolist(),self.m[1:].tolist(),self.b[1:].tolist()):
+      data.append(Edge(EPOCH+timedelta(microseconds=x),Topo.RIGHT if r else Topo.LEFT))
+      data.append((m,b))
+    return PWlinear(*data)
+
+  def __eq__(self,other):
+    if isinstance(other,PWlinear):
+      other = PWlinearArray.from_pwlinear(other)
+    return isinstance(other,PWlinearArray) and \
+      np.array_equal(self.edges,other.edges) and np.array_equal(self.right,other.right) and \
+      np.array_equal(self.m,other.m) and np.array_equal(self.b,other.b)
+
+  def __repr__(self):
+    return f"PWlinearArray(edges={self.edges!r}, right={self.right!r}, m={self.m!r}, b={self.b!r})"
+
+  def __len__(self):
+    return len(self.edges)
+
+  def keys(self):
+    return 2*self.edges + ~self.right
+
+  def combine(self,other,fn):
+    """combine self and other. fn takes (m1,b1,m2,b2) arrays and returns (m,b) arrays."""
+    sk = self.keys()
+    ok = other.keys()
+    keys = np.union1d(sk,ok)
+    #index of the domain in force after each cut (and 0 before the first):
+    si = np.concatenate(([0],np.searchsorted(sk,keys,side='right')))
+    oi = np.concatenate(([0],np.searchsorted(ok,keys,side='right')))
+    self.m, self.b = fn(self.m[si],self.b[si],other.m[oi],other.b[oi])
+    self.edges = keys >> 1
+    self.right = (keys & 1) == 0
+    return self.simplify()
+
+  def simplify(self):
+    """merge together domains with equal values and domains that both have inf constant term"""
+    m, b = self.m, self.b
+    same = ((m[:-1]==m[1:]) & (b[:-1]==b[1:])) | (np.isposinf(b[:-1]) & np.isposinf(b[1:]))
+    keep = ~same
+    self.edges = self.edges[keep]
+    self.right = self.right[keep]
+    keep = np.concatenate(([True],keep))
+    self.m = m[keep]
+    self.b = b[keep]
+    return self
+
+  def plus(self,other):
+    if isinstance(other,PWlinear):
+      other = PWlinearArray.from_pwlinear(other)
+    return self.combine(other,lambda m1,b1,m2,b2: (m1+m2,b1+b2))
+
+  def scalar_mult(self,s):
+    self.m = s*self.m
+    self.b = s*self.b
+    return self.simplify()
+
+  @classmethod
+  def from_segments(cls, segments):
+    """
+    sum many segments in one sort-and-sweep pass, rather than folding plus over them.
+    each segment is (start, end, val): start/end are Edges (None for unbounded) and val is a constant or (m,b),
+    so a segment is PWlinear(0,start,val,end,0) and the result is the sum of all of them.
+    events are sorted by cut key with segment ends before starts, and the running sums are exact (see exact_cumsum),
+    so a segment closing takes away exactly what it added: domains covered by no segment are exactly 0,
+    and other domains have no float residue left over from segments that have closed.
+    """
+    starts, ends, m, b = [], [], [], []
+    for start,end,val in segments:
+      starts.append(CUT_MIN if start is None else cut_key(start))
+      ends.append(CUT_MAX if end is None else cut_key(end))
+      val = val if isinstance(val,tuple) else (0,val)
+      m.append(val[0])
+      b.append(val[1])
+    return cls.from_segment_arrays(starts,ends,m,b)
+
+  @classmethod
+  def from_segment_arrays(cls, starts, ends, m, b):
+    """from_segments with the segments already as arrays: start and end cut keys (see cut_key), and line (m,b)."""
+    starts = np.asarray(starts,dtype=np.int64)
+    ends = np.asarray(ends,dtype=np.int64)
+    m = np.asarray(m,dtype=np.float64)
+    b = np.asarray(b,dtype=np.float64)
+    keep = starts<ends
+    starts, ends, m, b = starts[keep], ends[keep], m[keep], b[keep]
+    if len(starts)==0:
+      return cls()
+
+    inf = np.isposinf(b)
+    b = np.where(inf,0,b)
+    n = len(starts)
+    keys = np.concatenate((ends,starts))
+    is_start = np.concatenate((np.zeros(n,dtype=bool),np.ones(n,dtype=bool)))
+    order = np.lexsort((is_start,keys))
+    keys = keys[order]
+    sign = np.where(is_start,1,-1)[order]
+    n_inf = np.cumsum(sign*np.concatenate((inf,inf))[order])
+
+    #the value after each cut is the running sum at the last event with that key:
+    last = np.flatnonzero(np.append(keys[1:]!=keys[:-1],True))
+    m = exact_cumsum(sign*np.concatenate((m,m))[order],last)
+    b = exact_cumsum(sign*np.concatenate((b,b))[order],last)
+    keys, n_inf = keys[last], n_inf[last]
+    b = np.where(n_inf>0,math.inf,b)
+    #segments that never end leave a CUT_MAX key, which is never a real edge:
+    if keys[-1]==CUT_MAX:
+      keys, m, b = keys[:-1], m[:-1], b[:-1]
+    #unbounded starts are in force before the first edge:
+    if keys[0]==CUT_MIN:
+      keys = keys[1:]
+    else:
+      m = np.concatenate(([0],m))
+      b = np.concatenate(([0],b))
+    return cls(keys >> 1, (keys & 1) == 0, m, b).simplify()
+
+CUT_MIN = np.iinfo(np.int64).min
+CUT_MAX = np.iinfo(np.int64).max
+
+def cut_key(edge):
+  #position of a datetime Edge on the PWlinearArray cut axis
+  return 2*((edge.val-EPOCH)//US) + (0 if edge.side==Topo.RIGHT else 1)
+
+def exact_cumsum(x, idx):
+  """
+  the running sums of float array x at indices idx, each computed exactly and rounded once.
+  floats are dyadic rationals, so scaling by the largest denominator makes every term an integer.
+  """
+  ratios = [v.as_integer_ratio() for v in x.tolist()]
+  den = max((d for _,d in ratios), default=1)
+  sums = list(accumulate(n*(den//d) for n,d in ratios))
+  return np.array([sums[i]/den for i in idx.tolist()],dtype=np.float64)
+
+def pw_segments(pw):
+  """the non-zero domains of PWlinear pw, as segments for PWlinearArray.from_segments"""
+  data = [None]+pw.data+[None]
+  return [(data[i],data[i+2],data[i+1]) for i in range(0,len(data)-2,2) if data[i+1]!=(0,0)]
+
+def pw_sum(masks):
+  """sum of a list of PWlinear masks (with datetime edges) in a single sweep"""
+  return PWlinearArray.from_segments(s for pw in masks for s in pw_segments(pw)).to_pwlinear()
+
 # def mk_relu(x0,x1,y0=0,y1=1,basetime=datetime(2022,6,22)):
 #   #make a relu, with slope in 1/sec units
 #   # intercept b is the y value when x=basetime
@@ -299,12 +476,13 @@ def mk_path(*args,basetime=datetime(2022,6,22)):
   return PWlinear(*path).simplify()
 
 
-def make_event_mask(e, fixies, fixed_draft, now, basetime=datetime(2022,6,22)):
+def make_event_mask(e, fixies, fixed_draft, now, basetime=datetime(2022,6,22), cache=None):
   """
   make a mask indicating available times and costs.
   e is a FloatMeeting (or Event? similar interfaces).
   fixies is a list of FixedMeeting that affect this event.
   fixed_draft is a list of Events that should be treated as fixed conflicts.
+  cache is an optional UserMaskCache to take user masks from, in place of fixies and fixed_draft.
   initial mask comes from window, adjusted for freeze horizon.
   for each attendee we make a kronduty mask by unioning their available times.
   we then combine kronduty times across users and all the fixed events by sum (intersection).
@@ -326,7 +504,7 @@ def make_event_mask(e, fixies, fixed_draft, now, basetime=datetime(2022,6,22)):
   #   windowmask.plus(buffermask)
 
   #masks for required users
-  umasks = user_masks(fixies,fixed_draft,e.attendees,e,basetime)
+  umasks = user_masks(fixies,fixed_draft,e.attendees,e,basetime,cache=cache)
   #keep components, but smoosh across users
   masks = DotDict({'window':windowmask,'fixed':PWlinear(0),'ifneeded':PWlinear(0), 'kronduty':PWlinear(0)})
   for k,v in umasks.items():
@@ -335,7 +513,7 @@ def make_event_mask(e, fixies, fixed_draft, now, basetime=datetime(2022,6,22)):
     masks.kronduty.plus(v.kronduty)
 
   #masks for optional users.
-  umasks = user_masks(fixies,fixed_draft,e.optionalattendees,e,basetime)
+  umasks = user_masks(fixies,fixed_draft,e.optionalattendees,e,basetime,cache=cache)
   optatt_masks = DotDict({})
   #smoosh the components together but keep separated by user
   #TODO: keep in components?
@@ -389,11 +567,14 @@ def trim_window_start(e, now):
     
   return window_start
 
-def user_masks(fixies, fixed_draft, users, event, basetime):
+def user_masks(fixies, fixed_draft, users, event, basetime, cache=None):
   """
   this returns a dict keyed by user id (str) with values that are the core mask components (fixed, ifneeded, kronduty) for that user for the event.
   used for setting up solver masks and reading repair tea leaves.
+  if cache (a UserMaskCache) is given the components come from it, and fixies and fixed_draft are ignored.
   """
+  if cache is not None:
+    return {str(user): cache.masks(user,event) for user in users}
   user_masks={}
   for user in users:
     m=DotDict({})
@@ -408,14 +589,14 @@ def fixedevent_mask(fixies, fixed_draft, user, event):
   """
   find the availabaility of the user for this event, given fixed events (and fixed drafts).
   """
-  fmask = PWlinear(0)
+  segments = []
   for f in fixies:
     if int(user)==f.calendar.user_id and not f.kron_duty:
-      fmask.plus(PWlinear(0,Edge(f.start_at-event.length,Topo.LEFT),math.inf,Edge(f.end_at,Topo.RIGHT),0))
+      segments.append((Edge(f.start_at-event.length,Topo.LEFT),Edge(f.end_at,Topo.RIGHT),math.inf))
   for f in fixed_draft:
     if int(user) in f.draft_attendees:
-      fmask.plus(PWlinear(0,Edge(f.draft_start-event.length,Topo.LEFT),math.inf,Edge(f.draft_end,Topo.RIGHT),0))
-  return fmask
+      segments.append((Edge(f.draft_start-event.length,Topo.LEFT),Edge(f.draft_end,Topo.RIGHT),math.inf))
+  return PWlinearArray.from_segments(segments).to_pwlinear()
 
 def kronduty_masks(fixies, basetime, user, event_length,people=[]):
   """
@@ -427,16 +608,17 @@ def kronduty_masks(fixies, basetime, user, event_length,people=[]):
   # print(f"user {user}, people {people}, groups {groups}")
   #people shouldn't include self:
   people = [p for p in people if int(p)!=int(user)]
-  kmask = PWlinear(0)
-  imask = PWlinear(0)
+  #collect segments and sum them in one sweep at the end, these loops see every kronduty event of the user:
+  ksegments = []
+  isegments = []
   for f in fixies:
     if int(user) == f.calendar.user_id and f.kron_duty:
-      cost = f.costs.pop('everyone',math.inf)
+      cost = f.costs.get('everyone',math.inf)
       #we add segments to masks (indicating available time for this meeting) if cost is finite
       if math.isfinite(cost):
         # union availability into kronduty times for user:
         if f.kind == 'availability':
-          kmask.plus(PWlinear(0,Edge(f.start_at,Topo.RIGHT),1,Edge(f.end_at,Topo.LEFT),0))
+          ksegments.append((Edge(f.start_at,Topo.RIGHT),Edge(f.end_at,Topo.LEFT),1))
 
         """
         add in ifneeded penalities. 
@@ -454,11 +636,14 @@ def kronduty_masks(fixies, basetime, user, event_length,people=[]):
         """
         #cost is cost per hour used, times weight:
         max_cost=IFNEEDED_WEIGHT * cost * (event_length/timedelta(hours=1)) 
-        past_fstart=mk_path((f.start_at-event_length,0),(f.start_at,max_cost),basetime=basetime)
-        past_fend=mk_path((f.end_at-event_length,0),(f.end_at,-max_cost),basetime=basetime)
-        ifneeded=past_fstart.plus(past_fend)
-        imask.plus(ifneeded)
+        isegments += ifneeded_segments(f.start_at,f.end_at,event_length,max_cost,basetime)
         # print(f"imask {imask}")
+  kmask = PWlinearArray.from_segments(ksegments).to_pwlinear()
+  imask = PWlinearArray.from_segments(isegments).to_pwlinear()
+  return kronduty_fit(kmask,event_length),imask
+
+def kronduty_fit(kmask, event_length):
+  """turn kmask (>0 where the user has kronduty time) into a mask of start times: 0 where the event fits, inf elsewhere."""
   #kmask>0 is now allowable times, need to account for meeting length.
   # to do so, set the edge after an interval with val>0 back by meeting length, 
   # if it passes the edge before it discard the interval (meeting won't fit)
@@ -474,7 +659,93 @@ def kronduty_masks(fixies, basetime, user, event_length,people=[]):
   kmask.apply_domains(kronduty_fit_helper)
   #invert so avialable becomes 0, unavailable inf, to match other masks.
   kmask.apply(lambda p: (0,0 if p[1]>0 else math.inf))
-  return kmask,imask
+  return kmask
+
+def ifneeded_segments(start_at, end_at, event_length, max_cost, basetime):
+  """
+  the overlap penalty of kronduty_masks as bounded segments: 
+    mk_path((start_at-event_length,0),(start_at,max_cost)) plus mk_path((end_at-event_length,0),(end_at,-max_cost)).
+  the constant tails of the two paths cancel after end_at, so we emit max_cost only on [start_at,end_at).
+  """
+  segments = []
+  for x,y in ((start_at,max_cost),(end_at,-max_cost)):
+    m=y/event_length.total_seconds()
+    b=y - m*(x-basetime).total_seconds()
+    segments.append((Edge(x-event_length,Topo.LEFT),Edge(x,Topo.RIGHT),(m,b)))
+  segments.append((Edge(start_at,Topo.RIGHT),Edge(end_at,Topo.RIGHT),max_cost))
+  return segments
+
+class UserMaskCache():
+  """
+  the raw busy, kronduty and ifneeded intervals of each user, shared by all the floaties of a solver run.
+  build it once from the fixed events and fixed drafts over the union of the floaty windows, then user_masks
+  clips those intervals to each floaty window (the overlap test of get_fixed_events and overlapping_draft)
+  and shifts them by the floaty length. the masks are the same as those made from per window fixies,
+  but the db is hit once per run rather than once per floaty.
+  intervals are kept in input order as int64 microseconds since EPOCH, the units of PWlinearArray.
+  """
+  def __init__(self, fixies, fixed_draft, basetime):
+    self.basetime = basetime
+    busy, avail, ifneeded = {}, {}, {}
+    for f in fixies:
+      user = f.calendar.user_id
+      if not f.kron_duty:
+        busy.setdefault(user,[]).append((f.start_at,f.end_at))
+        continue
+      cost = f.costs.get('everyone',math.inf)
+      if math.isfinite(cost):
+        if f.kind == 'availability':
+          avail.setdefault(user,[]).append((f.start_at,f.end_at))
+        ifneeded.setdefault(user,[]).append((f.start_at,f.end_at,cost))
+    for f in fixed_draft:
+      for user in f.draft_attendees:
+        busy.setdefault(int(user),[]).append((f.draft_start,f.draft_end))
+    self.busy = {u: self._arrays(v) for u,v in busy.items()}
+    self.avail = {u: self._arrays(v) for u,v in avail.items()}
+    self.ifneeded = {u: self._arrays(v) for u,v in ifneeded.items()}
+
+  @staticmethod
+  def _arrays(intervals):
+    starts, ends, *rest = zip(*intervals)
+    return (np.array([(x-EPOCH)//US for x in starts],dtype=np.int64),
+            np.array([(x-EPOCH)//US for x in ends],dtype=np.int64),
+            *(np.array(r,dtype=np.float64) for r in rest))
+
+  @staticmethod
+  def _clip(intervals, event):
+    if intervals is None:
+      return [np.empty(0,dtype=np.int64)]*2 + [np.empty(0)]
+    starts, ends = intervals[0], intervals[1]
+    keep = (starts<(event.window_end-EPOCH)//US) & (ends>(event.window_start-EPOCH)//US)
+    return [a[keep] for a in intervals]
+
+  def masks(self, user, event):
+    """the core mask components (fixed, ifneeded, kronduty) of user for event, as in user_masks."""
+    user = int(user)
+    L = event.length//US
+    m = DotDict({})
+
+    s, e = self._clip(self.busy.get(user),event)[:2]
+    m.fixed = PWlinearArray.from_segment_arrays(2*(s-L)+1, 2*e, np.zeros(len(s)), np.full(len(s),math.inf)).to_pwlinear()
+
+    s, e = self._clip(self.avail.get(user),event)[:2]
+    kmask = PWlinearArray.from_segment_arrays(2*s, 2*e+1, np.zeros(len(s)), np.ones(len(s))).to_pwlinear()
+    m.kronduty = kronduty_fit(kmask,event.length)
+
+    #the segments of ifneeded_segments, interleaved per interval in the same order:
+    s, e, cost = self._clip(self.ifneeded.get(user),event)
+    base = (self.basetime-EPOCH)//US
+    max_cost = IFNEEDED_WEIGHT * cost * (event.length/timedelta(hours=1))
+    m1 = max_cost/event.length.total_seconds()
+    m2 = -max_cost/event.length.total_seconds()
+    b1 = max_cost - m1*((s-base)/10**6)
+    b2 = -max_cost - m2*((e-base)/10**6)
+    interleave = lambda *arrays: np.stack(arrays,axis=1).ravel()
+    m.ifneeded = PWlinearArray.from_segment_arrays(interleave(2*(s-L)+1, 2*(e-L)+1, 2*s),
+                                                   interleave(2*s, 2*e, 2*e),
+                                                   interleave(m1, m2, np.zeros(len(s))),
+                                                   interleave(b1, b2, max_cost)).to_pwlinear()
+    return m
 
 # def discretize(e1,v,e2):
 #   e1=Edge(inf_floor(e1.val),e1.side)
@@ -577,6 +848,25 @@ def find_bin(mask,t):
     if left and right:
       return e1,e2
 
+def grain_bins(mask):
+  """
+  the integer starts allowed by mask (with edges in grains), as (lo,hi,(m,b)) for each finite domain, in order.
+  an edge belongs to the domain after it if RIGHT, before it if LEFT. domains with no integer in them are dropped.
+  """
+  data = [None] + mask.data + [None]
+  bins = []
+  for i in range(0,len(data)-2,2):
+    e1,v,e2 = data[i],data[i+1],data[i+2]
+    if math.isinf(v[1]):
+      continue
+    if e1 is None or e2 is None or not (math.isfinite(e1.val) and math.isfinite(e2.val)):
+      raise ValueError(f"mask has unbounded allowed start times: {mask}")
+    lo = math.ceil(e1.val) if e1.side==Topo.RIGHT else math.floor(e1.val)+1
+    hi = math.ceil(e2.val)-1 if e2.side==Topo.RIGHT else math.floor(e2.val)
+    if lo<=hi:
+      bins.append((lo,hi,v))
+  return bins
+
 
 if __name__ == '__main__':
 
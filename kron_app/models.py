@@ -459,6 +459,10 @@ class Attendance(db.Model):
   gcal_create_count = db.Column(db.Integer, nullable = False, default = 0) # gcal_sync_version==2
   gcal_update_count = db.Column(db.Integer, nullable = False, default = 0) # gcal_sync_version==2
   gcal_delete_count = db.Column(db.Integer, nullable = False, default = 0) # gcal_sync_version==2
+  # Set when the attendance's calendar entry may need syncing, cleared
+  # once done. (See gcal_integration.gcal_sync_user_2.)
+  gcal_sync_pending = db.Column(db.Boolean, nullable = False, default = False, index = True) # gcal_sync_version==2
+  gcal_sync_yank = db.Column(db.Boolean, nullable = False, default = False) # gcal_sync_version==2
   #attendence priority is an integer that is used to determine the priority of the event
   # it is [0,100] and 50 is the default
   priority = db.Column(db.Integer, nullable=False, default=50)
@@ -569,13 +573,28 @@ class SolverLog(db.Model):
   id = db.Column(db.Integer, primary_key = True)
   created_at = db.Column(db.DateTime, nullable = False, default = datetime.utcnow)
   jsondata = db.Column(db.Text, nullable = False)
+  summaryjson = db.Column(db.Text, nullable = True) # Null for entries logged before it was added.
+  #payloads are versioned and typed, see kron_app.solver_log (imported here since it depends on mask_utils, which imports models)
   @property
   def data(self):
-    #TODO: de-serialize datetime, timedelta, PWlinear etc properly... since we serialize with repr() we can perhaps just eval() the strings?
-    return json.loads(self.jsondata)
+    from kron_app.solver_log import loads
+    return loads(self.jsondata)
   @data.setter
   def data(self, val):
-    self.jsondata = json.dumps(val,default=repr)
+    from kron_app.solver_log import dumps, summary
+    self.jsondata = dumps(val)
+    self.summaryjson = json.dumps(summary(val))
+  @property
+  def summary(self):
+    from kron_app.solver_log import summary
+    return json.loads(self.summaryjson) if self.summaryjson is not None else summary(self.data)
+
+# A single row, see kron_app.solver_trigger.
+class SolverTrigger(db.Model):
+  __tablename__ = 'solver_trigger'
+  id = db.Column(db.Integer, primary_key = True)
+  requested_at = db.Column(db.DateTime, nullable = True) # First request since the solver last ran.
+  last_requested_at = db.Column(db.DateTime, nullable = True)
 
 class ErrorLog(db.Model):
   __tablename__ = 'error_log'
@@ -633,3 +652,21 @@ class AvailabilityEvent(db.Model):
   @property
   def tz(self):
     return gettz(self.tzname)
+
+# Occurrences of availability events, in UTC, materialized for the
+# window given by the user's AvailabilityHorizon. See
+# kron_app.availability.materialize.
+class AvailabilityInterval(db.Model):
+  __tablename__ = 'availability_intervals'
+  id = db.Column(db.Integer, primary_key = True)
+  user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable = False)
+  start_at = db.Column(db.DateTime, nullable = False)
+  end_at = db.Column(db.DateTime, nullable = False)
+  cost = db.Column(db.Integer, nullable = False)
+  db.Index('ix_availability_intervals_user_id_start_at', user_id, start_at)
+
+class AvailabilityHorizon(db.Model):
+  __tablename__ = 'availability_horizons'
+  user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key = True)
+  start_at = db.Column(db.DateTime, nullable = False)
+  end_at = db.Column(db.DateTime, nullable = False)
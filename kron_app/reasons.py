@@ -2,7 +2,7 @@
 from datetime import datetime, timedelta
 from itertools import combinations
 import math
-from kron_app.mask_utils import Edge, PWlinear, Topo, trim_window_start, user_masks
+from kron_app.mask_utils import Edge, PWlinear, Topo, trim_window_start, user_masks, pw_sum
 from kron_app.utils import ids, dictunion
 from kron_app.models import Calendar, FixedEvent
 from kron_app.solver.utils import FloatMeeting
@@ -89,6 +89,10 @@ def solve_for(event,modifier):
 
   return result,schedule,unschedueled_ids
 
+def scheduled_target(event,schedule):
+  """the draft for event in a counterfactual schedule, or None if it wasn't scheduled (or the solve failed)."""
+  return next((f for f in schedule or [] if f.id==str(event.id)), None)
+
 
 def unscheduled_because_users(event):
   """find minimal set of attendees st if they were optional meeting could be scheduled. 
@@ -112,8 +116,8 @@ def unscheduled_because_users(event):
   result,schedule,unschedueled_ids = solve_for(event,modifier)
 
   #confirm event was scheduled and see which attendees were included
-  if schedule and  str(event.id) not in unschedueled_ids:
-    target=next(f for f in schedule if f.id==str(event.id))
+  target=scheduled_target(event,schedule)
+  if target is not None:
     leftovers =  set(original_attendees) - set(target.actualattendees)
     return leftovers, target.start
   else:
@@ -136,8 +140,8 @@ def unscheduled_because_events(event):
 
   result,schedule,unschedueled_ids = solve_for(event,modifier)
 
-  if str(event.id) not in unschedueled_ids:
-    target=next(f for f in schedule if f.id==str(event.id))
+  target=scheduled_target(event,schedule)
+  if target is not None:
     bumped=unschedueled_ids #TODO: should this be only those that weren't previously unscheduled?
     return bumped, target.start
   else:
@@ -157,8 +161,8 @@ def unscheduled_because_window(event):
   result,schedule,unschedueled_ids = solve_for(event,modifier)
 
   #check if event was scheduled, if so return end
-  if str(event.id) not in unschedueled_ids:
-    target=next(f for f in schedule if f.id==str(event.id))
+  target=scheduled_target(event,schedule)
+  if target is not None:
     return target.end
   else:
     return None
@@ -181,11 +185,7 @@ def unscheduled_because_window(event):
 #   return empties 
 
 def intersect_masks(us,*masks):
-  k=PWlinear(0)
-  for u in us:
-    for m in masks:
-      k.plus(m[u])
-  return k
+  return pw_sum(m[u] for u in us for m in masks)
 
 def minimal_empty_intersection(users, *masks):
   empties=[]
@@ -11,6 +11,7 @@ from flask_login import login_required as flask_login_required
 from flask_login import login_user as flask_login_user
 from sqlalchemy import select, or_, desc, func
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import defer
 from kron_app import app
 from kron_app import db
 from kron_app.models import User, Calendar, Event, EventState, FixedEvent, SolverLog, Email, ErrorLog, Attendance, AttendeeResponse, GcalPushState
@@ -21,7 +22,7 @@ from kron_app.users import find_user_by_email, find_user_by_primary_email, recor
 from kron_app.forms import NewEventForm, SetupForm, GroupForm
 from kron_app.gcal_api import get_google_auth, get_google_auth_with_scope, GoogleAuth, get_oauth_session_for_user, GCAL_SCOPES, GCAL_SCOPES_FULL, GCAL_SCOPES_REDUCED
 from kron_app.gcal_integration import gcal_chk_for_cal_and_get_timezone, gcal_event_queue_for, gcal_list_calendars
-from kron_app.tasks import task_post_signup, task_post_signin, task_post_calendar_notification, task_post_user_notification, task_post_create_events, task_post_modify_event, task_delete_events, task_post_modify_user_timezone, task_post_add_calendar, task_post_delete_calendar, task_post_decline_invite, task_post_add_alias, task_post_modify_groups, task_post_decline_meeting, task_run_solver, task_post_setup, task_enable_push
+from kron_app.tasks import task_post_signup, task_post_signin, task_post_calendar_notification, task_post_user_notification, task_post_create_events, task_post_modify_event, task_delete_events, task_post_modify_user_timezone, task_post_add_calendar, task_post_delete_calendar, task_post_decline_invite, task_post_add_alias, task_post_modify_groups, task_post_decline_meeting, queue_solver_run, task_post_setup, task_enable_push
 from kron_app.utils import getstr, ids, tznames, tzoptions, to_utc, from_utc, dotdict, sanitize_url
 from kron_app.reasons import impossible_because_users
 from kron_app.groups import get_name_and_type, group_members_valid, group_add, group_update, group_delete, unpack_groups, get_deps
@@ -745,7 +746,7 @@ def profile_preferences():
   current_user.tzname = new_tzname
   db.session.commit()
   if tzname_changed:
-    task_post_modify_user_timezone.delay()
+    task_post_modify_user_timezone.delay(current_user.id)
   flash('Preferences updated.')
   return redirect(url_for('profile'))
 
@@ -799,7 +800,7 @@ def update_availability():
   json = request.get_json()
   d = date.fromisoformat(json['date'])
   api_set_availability(current_user, d, json['availability'], json['recur'])
-  task_run_solver.delay()
+  queue_solver_run()
   return 'ok'
 
 # Simulate sync:
@@ -891,7 +892,8 @@ PAGE_SIZE = 20
 @admin_required
 def solver():
   page = max(0, int(request.args.get('page', 0)))
-  entries = SolverLog.query.order_by(desc('created_at')).offset(page*PAGE_SIZE).limit(PAGE_SIZE).all()
+  # The list only shows the summary, so leave the payloads in the db.
+  entries = SolverLog.query.options(defer(SolverLog.jsondata)).order_by(desc('created_at')).offset(page*PAGE_SIZE).limit(PAGE_SIZE).all()
   count = SolverLog.query.count()
   show_prev = page > 0
   show_next = (page+1) * PAGE_SIZE < count
@@ -11,24 +11,34 @@
 #Note: currently using default grain of 15min slots.
 
 import os
-from copy import deepcopy
+import json
+import random
 from itertools import combinations
 import math
 from time import process_time, monotonic
 from datetime import datetime, timedelta, time, date
-from sqlalchemy import update
+from contextlib import contextmanager
+from sqlalchemy import update, text
+from sqlalchemy.orm import selectinload
 import psutil
 from kron_app.solver.utils import FloatMeeting
 from kron_app.solver.solver import solver
 # from kron_app.solver.repair import extend_windows
-from kron_app import db
+from kron_app import app, db
 from kron_app.models import Event, EventState, FixedEvent, User, Calendar, SolverLog, Change, Email, Attendance
 import kron_app.mail as mail
 from kron_app.utils import DotDict, to_utc, from_utc, advance_to_midnight, ids
-from kron_app.mask_utils import PWlinear, kronduty_masks, make_event_mask
+from kron_app.mask_utils import PWlinear, UserMaskCache, kronduty_masks, make_event_mask
 import kron_app.availability as availability
+import kron_app.solver_log as solver_log
+from kron_app.interval_index import IntervalIndex
 
 def solver_with_logging(*args, **kwargs):
+  """
+  solver, logging the run to SolverLog. the log record is built here, but written (with overlapping events for
+  failed runs) by task_write_solver_log when SOLVER_LOG_ASYNC, so the solver run doesn't wait on it.
+  the problem is logged for failed or timed out runs and a SOLVER_LOG_SAMPLE fraction of the rest.
+  """
   caller = kwargs.pop('caller','none')
   now = kwargs.pop('now')
   prov = kwargs.pop('problem_prov')
@@ -36,39 +46,75 @@ def solver_with_logging(*args, **kwargs):
   num_floaties = len(floaties)
   # now = kwargs['now']
   basetime = kwargs['basetime']
-  masks = deepcopy(kwargs['masks'])
+  #the solver adjusts masks in place, so we keep a snapshot (much cheaper than a deepcopy), encoded only if logged:
+  masks = solver_log.snapshot_masks(kwargs['masks'])
   cpustart = process_time()
   wallstart = monotonic()
   p = psutil.Process()
   mem_rss_before = p.memory_info().rss
   mem_available = psutil.virtual_memory().available
-  result = solver(*args, **kwargs)
+  stats = {}
+  result = solver(*args, stats=stats, **kwargs)
   result_code = result[3]
   pid = os.getpid()
   cputime = round((process_time() - cpustart) * 1000)
   walltime = round((monotonic() - wallstart) * 1000)
   mem_rss_after = p.memory_info().rss
   print(f"++solver return: {result_code}, in {cputime}, on problem size {num_floaties}")
-  overlapping = dump_overlapping(floaties) if not result[0] else {}
-  db.session.add(SolverLog( data=dict(pid=pid,
-                            cputime=cputime,
-                            walltime=walltime,
-                            mem_rss_before=mem_rss_before,
-                            mem_rss_after=mem_rss_after,
-                            mem_available=mem_available,
-                            caller=caller, 
-                            problem_size=num_floaties,
-                            result_code=result_code,
-                            result=result,
-                            floaties=[m.dict() for m in floaties],
-                            now=now,
-                            basetime=basetime,
-                            masks=masks,
-                            problem_prov=prov,
-                            overlapping=overlapping)))
-  db.session.commit()
+  data = dict(pid=pid,
+              cputime=cputime,
+              walltime=walltime,
+              mem_rss_before=mem_rss_before,
+              mem_rss_after=mem_rss_after,
+              mem_available=mem_available,
+              caller=caller,
+              problem_size=num_floaties,
+              result_code=result_code,
+              components=stats.get('components'),
+              incremental=stats.get('incremental'),
+              warm_start=warm_start_summary(stats.get('components') or []))
+  if solve_failed(result, stats.get('components') or []) or random.random() < app.config['SOLVER_LOG_SAMPLE']:
+    data.update(result=result,
+                floaties=[m.dict() for m in floaties],
+                now=now,
+                basetime=basetime,
+                problem_prov=prov)
+  record = solver_log.encode(data)
+  if 'floaties' in record:
+    record['masks'] = solver_log.encode_masks(masks)
+  if app.config['SOLVER_LOG_ASYNC']:
+    from kron_app.tasks import task_write_solver_log
+    task_write_solver_log.delay(record)
+  else:
+    write_solver_log(record)
   return result
 
+def solve_failed(result, components):
+  #no result, or a component without a result (unsat or timed out) or that timed out on the way, for any backend
+  return not result[0] or any(not c['result'] or 'timeout' in c['result_code'] for c in components)
+
+def write_solver_log(record):
+  """store an encoded solver log record (see solver_with_logging), adding the events around failed runs' drafts"""
+  result = record.get('result')
+  if result is not None and not result[0]:
+    floaties = solver_log.rows(record['floaties'], solver_log.FLOATY_TIMES, solver_log.FLOATY_DURATIONS)
+    record = dict(record, overlapping=solver_log.encode_overlapping(dump_overlapping(floaties)))
+  db.session.add(SolverLog(jsondata=solver_log.pack(record), summaryjson=json.dumps(solver_log.summary(record))))
+  db.session.commit()
+
+def warm_start_summary(components):
+  """
+  over the components that had a warm start: how many, how many were feasible, and their total check and optimize
+  times (ms). these don't say what the warm start saved, for that replay the logged problems with and without it
+  (solver_bench.py run --no_warm_start) and diff the results.
+  """
+  warm = [c['warm_start'] for c in components if c.get('warm_start')]
+  if not warm:
+    return None
+  return dict(tried=len(warm),
+              feasible=sum(w['feasible'] for w in warm),
+              check_time=sum(w['check_time'] for w in warm),
+              optimize_time=sum(w['optimize_time'] for w in warm))
 
 def dump_overlapping(floaties):
   try:
@@ -78,20 +124,23 @@ def dump_overlapping(floaties):
       out[e.id] = {}
       all_attendees = e.attendees + e.optionalattendees
       overlapping_fixed = get_fixed_events(e.draft_start-margin,e.draft_start+e.length+margin,all_attendees)
-      out[e.id]['fixed'] = [dict(id=f.id, start_at=f.start_at, end_at=f.end_at, kron_duty=f.kron_duty, calendar_id=f.calendar_id, user_id=f.calendar.user_id) for f in overlapping_fixed]
-      overlapping_float = overlapping_draft(e.draft_start-margin,e.draft_start+e.length+margin,all_attendees)
+      #availability comes back as fixed events without an id or calendar:
+      out[e.id]['fixed'] = [dict(id=getattr(f,'id',None), start_at=f.start_at, end_at=f.end_at, kron_duty=f.kron_duty, calendar_id=getattr(f,'calendar_id',None), user_id=f.calendar.user_id) for f in overlapping_fixed]
+      overlapping_float = overlapping_draft(e.draft_start-margin,e.draft_start+e.length+margin,[int(a) for a in all_attendees])
       out[e.id]['float'] = [dict(id=f.id, start_at=f.draft_start, end_at=f.draft_end) for f in overlapping_float if str(f.id) != e.id]
     return out
   except:
     return {}
 
 
-def event_masks(floaties,now,basetime):
+def event_masks(floaties,now,basetime,data=None):
   """
   Get events masks. Returns dotdict keyed by event id string.
 
   We first grab all the fixed events that could conflict with each floating event,
     which means those that fall within its window and have user in (optional)attendees.
+    These come from data (a ProblemData covering the floaties, loaded here if not given),
+    and are shared between floaties through a UserMaskCache which clips them back to each window.
   Floaties that are not added to problem for re-schedule need to be treated as fixed.
    We get those that interact with the problem floaties.
    (Note that this should only be used when we don't unfold teh problem completely.. so currently not..)
@@ -102,15 +151,20 @@ def event_masks(floaties,now,basetime):
   """  
   floaty_ids = [str(f.id) for f in floaties]
   masks=DotDict({})
-  for e in floaties:
-    all_attendees = e.attendees + e.optionalattendees
-    fixed_events = get_fixed_events(e.window_start,e.window_end,all_attendees)
-
-    #Note: sqla seems to coerce from str to int attendees, but maybe we should do that explicitly?
-    draft = overlapping_draft(e.window_start,e.window_end,all_attendees) 
-    fixed_drafts = [f for f in draft if str(f.id) not in floaty_ids]
+  if len(floaties)==0:
+    return masks
+  all_attendees = sorted({int(a) for e in floaties for a in e.attendees + e.optionalattendees})
+  span_start = min(e.window_start for e in floaties)
+  span_end = max(e.window_end for e in floaties)
+  if data is None:
+    data = ProblemData(floaties)
+  fixed_events = data.fixed_events(span_start,span_end,all_attendees)
+  draft = data.drafts(span_start,span_end,all_attendees)
+  fixed_drafts = [f for f in draft if str(f.id) not in floaty_ids]
+  cache = UserMaskCache(fixed_events,fixed_drafts,basetime)
 
-    emasks, optatt_masks = make_event_mask(e,fixed_events,fixed_drafts,now,basetime)
+  for e in floaties:
+    emasks, optatt_masks = make_event_mask(e,None,None,now,basetime,cache=cache)
     masks[e.id] = DotDict({'masks': emasks, 'optatt_masks': optatt_masks})
 
   return masks
@@ -157,7 +211,7 @@ def get_fixed_events(window_start, window_end, all_attendee_ids):
     .all()
   fixed_events = [f for f in fixed_events if window_start<f.end_at and window_end>f.start_at]
   # add availability from new ui
-  fs = [e.to_fixed_event() for e in availability.get_overlapping(window_start, window_end, all_attendee_ids)]
+  fs = availability.get_overlapping_fixed_events(window_start, window_end, all_attendee_ids)
   fixed_events.extend(fs)
   return fixed_events
 
@@ -176,11 +230,42 @@ def overlapping_window(start_at, end_at, user_ids):
                     .filter((Event.window_start<end_at), (Event.window_end>start_at)) \
                     .all()
 
-def is_conflicted(e,now):
-  """check if a (final) event has hard conflicts with its current time"""
+class ProblemData():
+  """
+  The fixed events (including availability) and scheduled drafts that could touch a set of floaties.
+  They are fetched once, over the union of the floaty (optional)attendees and the span of their windows,
+  and then served per window from memory: fixed_events and drafts return the same as get_fixed_events
+  and overlapping_draft would for any window and users inside what was loaded.
+  """
+  def __init__(self, floaties):
+    self.user_ids = {int(a) for e in floaties for a in e.attendees + e.optionalattendees}
+    fixed_events, drafts = [], []
+    if floaties and self.user_ids:
+      self.start = min(e.window_start for e in floaties)
+      self.end = max(e.window_end for e in floaties)
+      fixed_events = get_fixed_events(self.start, self.end, self.user_ids)
+      drafts = overlapping_draft(self.start, self.end, list(self.user_ids))
+    self._fixed = IntervalIndex(fixed_events, lambda f: f.start_at, lambda f: f.end_at, lambda f: (f.calendar.user_id,))
+    self._drafts = IntervalIndex(drafts, lambda d: d.draft_start, lambda d: d.draft_end, lambda d: d.draft_attendees)
+
+  def covers(self, start, end, user_ids):
+    users = {int(u) for u in user_ids}
+    return not users or (users <= self.user_ids and self.start <= start and end <= self.end)
+
+  def fixed_events(self, start, end, user_ids):
+    assert self.covers(start, end, user_ids)
+    return self._fixed.overlapping(start, end, user_ids)
+
+  def drafts(self, start, end, user_ids):
+    assert self.covers(start, end, user_ids)
+    return self._drafts.overlapping(start, end, user_ids)
+
+def is_conflicted(e,now,data=None):
+  """check if a (final) event has hard conflicts with its current time.
+  data is an optional ProblemData covering e, to share the db reads between several checks."""
   if e.is_scheduled():
     #check if current draft time is allowable:
-    masks = event_masks([e],now,now) #CHECK: is basetime=now ok?
+    masks = event_masks([e],now,now,data=data) #CHECK: is basetime=now ok?
     allowed = masks[e.id].masks.hard.abstract_eval(e.draft_start,fn=lambda x,y: not x)
   else:
     #an event without draft times has no hard conflicts...
@@ -208,12 +293,12 @@ def build_problem(now, max_size=100, min_iterations=0, max_iterations=20):
   """
   ##get the `dirty` events and build the problem seed from them:
   #TODO: don't need to worry about dirty events before now?
-  dirtyFloat = Event.query.filter((Event.state==EventState.INIT) |
-                                  (Event.state==EventState.UNSCHEDULED) |
-                                  (Event.state==EventState.SCHEDULED)) \
-                          .filter_by(dirty=True).all()
-  dirtyFixed = FixedEvent.query.filter_by(dirty=True).all()
-  changes = Change.query.all()
+  #we claim what we read: rows are locked (in id order, so concurrent runs don't deadlock) until we clear them below,
+  #and rows another run has locked are left to it.
+  claimed = Event.query.filter_by(dirty=True).order_by(Event.id).with_for_update(skip_locked=True).all()
+  dirtyFloat = [e for e in claimed if e.state in (EventState.INIT, EventState.UNSCHEDULED, EventState.SCHEDULED)]
+  dirtyFixed = FixedEvent.query.filter_by(dirty=True).order_by(FixedEvent.id).with_for_update(skip_locked=True).all()
+  changes = Change.query.order_by(Change.id).with_for_update(skip_locked=True).all()
 
   print(f"  building problem, {len(dirtyFloat)} dirty floats, {len(dirtyFixed)} dirty fixed, {len(changes)} changes..")
 
@@ -260,30 +345,20 @@ def build_problem(now, max_size=100, min_iterations=0, max_iterations=20):
   #Events that are "final" should only be added to problem if they have a true conflict. events that are "past" (start before now) should never be added to problem.
   problemset = set(dirtyFloat) | conflicts | spaces
   problemset = {e for e in problemset if not e.in_progress(now)} # db queries already excluded floaties that have finished
-  nosolve = {e for e in problemset if e.is_final() and not is_conflicted(e,now)}
+  finals = [e for e in problemset if e.is_final()]
+  data = ProblemData(finals)
+  nosolve = {e for e in finals if not is_conflicted(e,now,data)}
   problemset = problemset - nosolve
 
   print(f"  building problem, after dirty and changes {len(problemset)} floats..")
   print(f"  skipping {len(nosolve)} non-conflicted final floats..")
 
 
-  # TODO: Concurrency
-  # This obviously isn't safe to run concurrently (non-atomic
-  # read-modify-write of flags / changes.) That can probably be fixed
-  # with SELECT FOR UPDATE (ordered by e.g. id to guard against
-  # deadlocks). More important is the question of whether there are
-  # more subtle concurrency issues here. Maybe we need to be sure we
-  # always see the dirty fixed event / change relating to a fixed
-  # event move in the same solver run. In which case the fact that (a)
-  # we fetch those with two queries and (b) a write can happen in
-  # between is a potential bug. (This is just an example, it might not
-  # actually be a problem, I've not thought it through.) There
-  # certainly are issues with the wider `run_solver` -- an obvious one
-  # is we don't handle a meeting disappearing by the time we come to
-  # update its draft start / end times -- but there are others. This
-  # all needs careful thought.
-  db.session.execute(update(Event).values(dirty=False))
-  db.session.execute(update(FixedEvent).values(dirty=False).where(FixedEvent.dirty==True))
+  # Only clear what we claimed. Events made dirty since we read them
+  # (or claimed by another run) stay dirty for the next run. See
+  # `user_locks` for how concurrent runs keep their draft writes apart.
+  db.session.execute(update(Event).values(dirty=False).where(Event.id.in_(ids(claimed))))
+  db.session.execute(update(FixedEvent).values(dirty=False).where(FixedEvent.id.in_(ids(dirtyFixed))))
   for c in changes: # Only delete accounted-for changes. (Because the availability UI runs concurrently, for example.)
     db.session.delete(c)
   db.session.commit()
@@ -295,42 +370,99 @@ def build_problem(now, max_size=100, min_iterations=0, max_iterations=20):
   return problemset, nosolve, candidate_ids, prov
 
 def expand_problem(now, problemset, prov, max_size=100, min_iterations=0,max_iterations=20):
-  ##now we iteratively build out the problem:
-  ## for now we include those events that have overlapping attendees and overlapping windows
-  oldsize=0
+  """
+  builds out the problem breadth first: each iteration adds the events with overlapping attendees and overlapping windows
+  of those added by the iteration before (the frontier), with one query per frontier (see frontier_neighbors).
+  when adding all of them would take the problem past max_size (after min_iterations), those overlapping the frontier
+  the most go in first.
+  """
+  frontier = set(problemset)
   for iteration in range(max_iterations):
-    for d in problemset.copy():
-      if ((len(problemset) >= max_size) and (iteration >= min_iterations)): 
-        #return if problem exceeds bounds:
-        return problemset, prov
-
-      #TODO: keep track of new events from last iteration, only get neighbors of these.
-      all_attendees = d.attendees + d.optionalattendees
-      neighbors = overlapping_window(d.window_start, d.window_end, all_attendees)
-      neighbors=[n for n in neighbors if not (n.is_final() or n.in_progress(now))]
-      newneighbors = set(neighbors)-problemset
-      if (len(newneighbors)+len(problemset)>max_size) and (iteration >= min_iterations):
-        newneighbors=list(newneighbors)[:max_size-len(problemset)]
-        #TODO: could simplify by putting the return on len(problemset)>=max_size here instead of above?
-      problemset.update(newneighbors)
-      prov.update(newneighbors,f"expand-{iteration}")
-
-    if len(problemset) == oldsize: 
+    if ((len(problemset) >= max_size) and (iteration >= min_iterations)):
+      #return if problem exceeds bounds:
+      return problemset, prov
+    strength = frontier_neighbors(now, frontier, problemset)
+    if not strength:
       #return if problemset has converged:
       return problemset, prov
-    oldsize=len(problemset)
+    newneighbors = sorted(strength, key=lambda n: (-strength[n], n.id))
+    if (len(newneighbors)+len(problemset)>max_size) and (iteration >= min_iterations):
+      newneighbors = newneighbors[:max_size-len(problemset)]
+    problemset.update(newneighbors)
+    prov.update(newneighbors,f"expand-{iteration}")
+    frontier = set(newneighbors)
     print(f"  building problem, expanded problemset size {len(problemset)}")
 
   return problemset, prov
 
+def frontier_neighbors(now, frontier, problemset):
+  """
+  the events not in problemset that overlap_window would find for some event of the frontier, with the strength of their overlap:
+  the sum over those frontier events of shared attendees times hours of window overlap.
+  they come from one query over all the frontier attendees and the span of their windows, filtered here.
+  """
+  users = {u for d in frontier for u in d.attendees + d.optionalattendees}
+  if not frontier or not users:
+    return {}
+  candidates = Event.query.join(Event.attendances, Attendance.email) \
+                          .filter((Event.state == EventState.INIT) | (Event.state == EventState.UNSCHEDULED) | (Event.state == EventState.SCHEDULED)) \
+                          .filter(Email.user_id.in_(users), Attendance.deleted == False) \
+                          .filter((Event.window_start<max(d.window_end for d in frontier)), (Event.window_end>min(d.window_start for d in frontier))) \
+                          .options(selectinload(Event.attendances).selectinload(Attendance.email)) \
+                          .all()
+  candidates = [n for n in dict.fromkeys(candidates) if n not in problemset and not (n.is_final() or n.in_progress(now))]
+  frontier_users = [(d, set(d.attendees + d.optionalattendees)) for d in frontier]
+  strength = {}
+  for n in candidates:
+    n_users = {a.email.user_id for a in n.attendances if not a.deleted}
+    for d,d_users in frontier_users:
+      overlap = min(n.window_end, d.window_end) - max(n.window_start, d.window_start)
+      shared = len(n_users & d_users)
+      if overlap > timedelta(0) and shared:
+        strength[n] = strength.get(n, 0) + shared * overlap / timedelta(hours=1)
+  return strength
+
 #define an exception subclass for solver errors:
 class SolverError(Exception):
   pass
 
-def run_solver(now=None, config={'timeout': 60000}):
+def run_solver(now=None, config=None):
   if now is None:
     now=datetime.utcnow()
+  if config is None:
+    config = {'timeout': 60000, 'backend': app.config['SOLVER_BACKEND'], 'processes': app.config['SOLVER_PROCESSES'],
+              'incremental': app.config['SOLVER_INCREMENTAL']}
+
+  events, nosolve, _, prov = build_problem(now,max_size=50,min_iterations=0)
+
+  with user_locks(problem_users(events | nosolve)):
+    #a run on some of the same users may have written drafts while we built the problem:
+    db.session.expire_all()
+    return solve_problem(now, config, events, nosolve, prov)
+
+def problem_users(events):
+  #draft attendees too, since writing a draft takes it off their calendar
+  return {u for e in events for u in e.allattendees + e.draft_attendees}
 
+#advisory lock keys are (USER_LOCK_CLASS, user id):
+USER_LOCK_CLASS = 1
+
+@contextmanager
+def user_locks(user_ids):
+  """
+  holds postgres advisory locks on user_ids, for a solver run to read masks and write drafts for a problem on those users.
+  runs on disjoint users go ahead in parallel, others wait their turn. locks are taken in id order, so runs don't deadlock.
+  they are on a connection of their own since the session's connection can change between commits.
+  """
+  with db.engine.connect() as conn:
+    try:
+      for u in sorted({int(u) for u in user_ids}):
+        conn.execute(text("SELECT pg_advisory_lock(:cls, :id)"), dict(cls=USER_LOCK_CLASS, id=u))
+      yield
+    finally:
+      conn.execute(text("SELECT pg_advisory_unlock_all()"))
+
+def solve_problem(now, config, events, nosolve, prov):
   # Build a list of event ids that need to be sync'd and emails to be
   # sent, deferring execution to the queue. This simplifies testing.
   tosync = []
@@ -347,8 +479,6 @@ def run_solver(now=None, config={'timeout': 60000}):
       email = mail.meeting_rescheduled(user, event)
       emails.append((email, event.id, None, 0))
 
-  events, nosolve, _, prov = build_problem(now,max_size=50,min_iterations=0)
-
   for e in (e for e in nosolve if e.is_scheduled()):
     # Propagate changes to draft_* cols and to calendars...
     #
@@ -383,13 +513,25 @@ def run_solver(now=None, config={'timeout': 60000}):
   
   print(f"  {len(impossible_events)} impossible, remaining problem size {len(floaties)}.")
 
-  result, schedule, unschedueled_ids, result_code = solver_with_logging(floaties=floaties,now=now,basetime=basetime,masks=masks,caller='main',config=config,problem_prov=prov)
+  #in incremental mode, events pulled in only by expand_problem (not dirty, conflicted or near a space) are first held at their draft times.
+  pinned = [f.id for f in floaties if prov.elts.get(int(f.id),'').startswith('expand-')] if config.get('incremental') else []
+
+  result, schedule, unschedueled_ids, result_code = solver_with_logging(floaties=floaties,now=now,basetime=basetime,masks=masks,caller='main',config=config,problem_prov=prov,pinned=pinned,partial=True)
+
+  #floaties in components the solver couldn't solve (eg timed out) are in neither the schedule nor unscheduled ids.
+  #leave them as they are, but dirty so that they are tried again next run.
+  solved_ids = set(unschedueled_ids) | {m.id for m in schedule or []}
+  for e in events:
+    if str(e.id) not in solved_ids and str(e.id) not in impossible_events:
+      e.dirty = True
 
   #add the events we skipped into unscheduled ids
   unschedueled_ids += impossible_events
 
   if not result:
-    #no result.. it's not clear how this is possible.
+    #every component failed (eg timed out). build_problem has already committed the claimed events clean,
+    #so commit them dirty again before raising, or they are never retried.
+    db.session.commit()
     raise SolverError(f"Solver failed with result code {result_code}")
     # #since dirty flags have already been cleared we pessimistically set all candidates to optional, 
     # # this will keep from baking in unsat constraints but it won't necessarily avoid hitting this situation again...
@@ -10,52 +10,28 @@ from time import process_time, time
 from kron_app.mask_utils import PWlinear,Edge,Topo
 import datetime
 # from kron_app.solver.solver_experimental import solver
-from kron_app.solver.solver import solver
+from kron_app.solver.solver import solver, pair_constraints
 from numpy import corrcoef, mean
 from kron_app.solver.utils import FloatMeeting
 from kron_app.utils import DotDict
-import matplotlib.pyplot as plt
+from kron_app.solver_log import upgrade_legacy
 
 def load_problem(r):
-  floaties = r['floaties']
-  masks = r['masks']
+  #sampled out runs are logged without their problem (see SOLVER_LOG_SAMPLE):
+  if 'floaties' not in r:
+    raise ValueError(f"{r.get('result_code')} run was logged without its problem")
+  #pickles from /admin/solver.pickle hold typed payloads (see kron_app.solver_log), older ones have repr strings:
+  if isinstance(r['basetime'], str):
+    r = upgrade_legacy(r)
+  floaties = [dict(f) for f in r['floaties']]
+  masks = DotDict(r['masks'])
   result, draftmeetings, unschedueled_ids, result_code=r['result']
-
-  #eval all the mask reprs:
-  masks = DotDict({id:{k:{t:eval(w) for t,w in v.items()} for k,v in u.items()} for id,u in masks.items()})
-
-  #eval the datetime strings:
-  for f in floaties:
-    f['window_start']= eval(f['window_start'])
-    f['window_end']=eval(f['window_end'])
-    f['freeze_horizon']=eval(f['freeze_horizon'])
-    f['length']=eval(f['length'])
-    if f['draft_start'] is not None:
-      f['draft_start']=eval(f['draft_start'])
-  
-  #eval the schedule datetimes:
-  if draftmeetings:
-    for d in draftmeetings:
-      d['start']=eval(d['start'])
-      d['end']=eval(d['end'])
-
-  #read time params from log:
-  basetime=eval(r['basetime'])
-  now=eval(r['now'])
-
-  return floaties,masks,now,basetime,draftmeetings
+  return floaties,masks,r['now'],r['basetime'],draftmeetings
 
 def load_overlapping(r):
-  overlapping = r['overlapping']
-  #eval the datetime strings:
-  for id,neighbors in overlapping.items():
-    for f in neighbors['fixed']:
-      f['start_at']=eval(f['start_at'])
-      f['end_at']=eval(f['end_at'])
-    for f in neighbors['float']:
-      f['start_at']=eval(f['start_at'])
-      f['end_at']=eval(f['end_at'])
-  return overlapping
+  if isinstance(r['basetime'], str):
+    r = upgrade_legacy(r)
+  return r['overlapping']
 
 def mask_cplx(mask):
   return (len(mask.data[1::2]), len(set(mask.data[::2])))
@@ -67,10 +43,10 @@ def inspect_log(logfile='solver_log.pickle',show_floaties=False,show_prov=False)
   for i,r in enumerate(runs):
     print(f"{i}: result {r['result_code']}, time {r['cputime']}, {r['problem_size']} floaties")
 
-    if show_prov:
+    if show_prov and 'problem_prov' in r:
       print(f"problem provenances {r['problem_prov']}")
 
-    if show_floaties:
+    if show_floaties and 'floaties' in r:
       floaties,masks,now,basetime,schedule=load_problem(r)
       for id,u in masks.items():
         hard_mask = u.masks.hard
@@ -83,6 +59,7 @@ def inspect_log(logfile='solver_log.pickle',show_floaties=False,show_prov=False)
           print(f"  {'optional' if m['is_optional'] else ''} floaty {id}, hard mask complexity {hardmask_cplx}, all mask complexity {allmask_cplx}, {len(m['attendees'])} attendees, window length {(m['window_end']-m['window_start']).days}, scheduled at {s['start'] if s else 'never'}")
 
 def stats(logfile):
+  import matplotlib.pyplot as plt
   with open(logfile, 'rb') as f:
     runs = pickle.load(f)
   
@@ -151,14 +128,14 @@ def check_conflicts(run,logfile):
         print(f"floaty {f['id']} overlaps floaty {o['id']}")
 
 
-def run_solve(floaties,masks,now,basetime,timeout=60000):
+def run_solve(floaties,masks,now,basetime,timeout=60000,backend='z3'):
   cpustart = process_time()
-  result, schedule, unschedueled_ids, result_code=solver(floaties,basetime=basetime,masks=masks,config={'timeout':timeout})
+  result, schedule, unschedueled_ids, result_code=solver(floaties,basetime=basetime,masks=masks,config={'timeout':timeout,'backend':backend})
   cputime = round((process_time() - cpustart) * 1000)
   print(f"result {result_code}, runtime {cputime}.")
   print("")
 
-def solve_run(start,end,logfile='solver_log.pickle',timeout=60000,repeat=1):
+def solve_run(start,end,logfile='solver_log.pickle',timeout=60000,repeat=1,backend='z3'):
   with open(logfile, 'rb') as f:
     runs = pickle.load(f)
   
@@ -179,7 +156,7 @@ def solve_run(start,end,logfile='solver_log.pickle',timeout=60000,repeat=1):
       #run solver on restored problem:
       #run this part in a fresh python process:
       # Create a new process
-      p = multiprocessing.Process(target=run_solve, kwargs={'floaties':floaties,'masks':masks,'now':now,'basetime':basetime,'timeout':timeout})
+      p = multiprocessing.Process(target=run_solve, kwargs={'floaties':floaties,'masks':masks,'now':now,'basetime':basetime,'timeout':timeout,'backend':backend})
       # Start the new process
       p.start()
       # # Send data to the new process
@@ -190,7 +167,67 @@ def solve_run(start,end,logfile='solver_log.pickle',timeout=60000,repeat=1):
 
     print(f"total run time: {round((time() - totaltime) * 1000)}\n\n")
 
+def pairs_run(start,end,logfile='solver_log.pickle',timeout=60000,solve=False):
+  """benchmark of non-overlap pair pruning: constraint counts (and optionally solve times) with and without it."""
+  with open(logfile, 'rb') as f:
+    runs = pickle.load(f)
+  rs = runs[start:end] if end else runs[start:]
+
+  totals = DotDict({'all':0,'pruned':0,'time_all':0,'time_pruned':0})
+  for i,r in enumerate(rs):
+    floaties,masks,now,basetime,schedule=load_problem(deepcopy(r))
+    floaties = [FloatMeeting(**f) for f in floaties]
+    masks = {id:u for id,u in masks.items() if id in [f.id for f in floaties]}
+    n_all = len(pair_constraints(floaties,masks,prune=False))
+    n_pruned = len(pair_constraints(floaties,masks,prune=True))
+    totals['all'] += n_all
+    totals['pruned'] += n_pruned
+    line = f"{start+i}: {len(floaties)} floaties, pair constraints {n_all} -> {n_pruned}"
+    if solve:
+      times = {}
+      for prune in [False,True]:
+        wallstart = time()
+        result, _, _, result_code = solver(floaties,basetime=basetime,masks=deepcopy(masks),config={'timeout':timeout,'prune_pairs':prune})
+        times[prune] = round((time() - wallstart) * 1000)
+        line += f", {'pruned' if prune else 'all'} {result_code} in {times[prune]}"
+      totals['time_all'] += times[False]
+      totals['time_pruned'] += times[True]
+    print(line)
+
+  print(f"total pair constraints {totals['all']} -> {totals['pruned']}")
+  if solve:
+    print(f"total solve time {totals['time_all']} -> {totals['time_pruned']}")
+
+def encodings_run(start,end,logfile='solver_log.pickle',timeout=60000):
+  """benchmark of mask encodings: first pass formula size and solve time with If trees and with bin tables."""
+  with open(logfile, 'rb') as f:
+    runs = pickle.load(f)
+  rs = runs[start:end] if end else runs[start:]
+
+  encodings = ['iftree','table']
+  totals = {e:DotDict({'size':0,'time':0}) for e in encodings}
+  for i,r in enumerate(rs):
+    floaties,masks,now,basetime,schedule=load_problem(deepcopy(r))
+    floaties = [FloatMeeting(**f) for f in floaties]
+    masks = {id:u for id,u in masks.items() if id in [f.id for f in floaties]}
+    line = f"{start+i}: {len(floaties)} floaties"
+    for encoding in encodings:
+      stats = {}
+      wallstart = time()
+      result, _, unscheduled, result_code = solver(floaties,basetime=basetime,masks=deepcopy(masks),stats=stats,
+                                                   config={'timeout':timeout,'mask_encoding':encoding,'formula_stats':True})
+      walltime = round((time() - wallstart) * 1000)
+      size = sum(c.get('formula_size',0) for c in stats.get('components',[]))
+      totals[encoding]['size'] += size
+      totals[encoding]['time'] += walltime
+      line += f", {encoding} size {size} {result_code} ({len(unscheduled)} unscheduled) in {walltime}"
+    print(line)
+
+  print(f"total formula size {totals['iftree']['size']} -> {totals['table']['size']}")
+  print(f"total solve time {totals['iftree']['time']} -> {totals['table']['time']}")
+
 def timeuse_stats(logfile):
+  import matplotlib.pyplot as plt
   with open(logfile, 'rb') as f:
     timeuse = pickle.load(f)
   
@@ -271,8 +308,24 @@ if __name__ == '__main__':
   parser_solve.add_argument('-t', '--timeout', type=int, default=60000)
   parser_solve.add_argument('-e', '--end', type=int)
   parser_solve.add_argument('--repeat', type=int, default=1)
+  parser_solve.add_argument('-b', '--backend', choices=['z3','cpsat'], default='z3')
   parser_solve.set_defaults(fn=solve_run)
 
+  parser_pairs = subparsers.add_parser('pairs', help='Benchmark non-overlap pair pruning on logged problems.')
+  parser_pairs.add_argument('start', type=int, nargs='?', default=0)
+  parser_pairs.add_argument('-l', '--logfile',default='solver_log.pickle')
+  parser_pairs.add_argument('-t', '--timeout', type=int, default=60000)
+  parser_pairs.add_argument('-e', '--end', type=int)
+  parser_pairs.add_argument('-s', '--solve', action='store_true', help='also time the solver with and without pruning')
+  parser_pairs.set_defaults(fn=pairs_run)
+
+  parser_encodings = subparsers.add_parser('encodings', help='Benchmark If tree and table mask encodings on logged problems.')
+  parser_encodings.add_argument('start', type=int, nargs='?', default=0)
+  parser_encodings.add_argument('-l', '--logfile',default='solver_log.pickle')
+  parser_encodings.add_argument('-t', '--timeout', type=int, default=60000)
+  parser_encodings.add_argument('-e', '--end', type=int)
+  parser_encodings.set_defaults(fn=encodings_run)
+
   parser_timeuse = subparsers.add_parser('timeuse', help='Display how busy people were.')
   # parser_inspect.add_argument('logfile',nargs='?',default='solver_log.pickle')
   parser_timeuse.add_argument('-l', '--logfile',default='time_usage.pickle')
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import os, json, time, random, argparse, threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from kron_app import db, app
+from kron_app.models import FixedEvent, Change
+import kron_app.gcal_api as gcal_api
+from kron_app.gcal_integration import gcal_sync_full, gcal_list_entries_generator
+from kron_app.tests.helpers import mkuser
+from kron_app.scripts.profile_gcal_sync import mkpages
+
+# ./scripts/dbdrop.sh ; ./scripts/dbreset.sh ; python -m kron_app.scripts.gcal_fetch_bench
+#
+# Benchmarks full sync against a local stub of the Calendar API's
+# events list endpoint, which serves `--pages` pages of `--page_size`
+# items, taking `--latency` ms to respond to each request. Sync is run
+# with page prefetching off and on (see
+# `gcal_list_entries_generator`), reporting the time taken for each.
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Set on the subclass made by `stub_server`.
+    pages = []
+    latency = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.endswith('/events'):
+            self.send_error(404)
+            return
+        params = parse_qs(url.query)
+        i = int(params.get('pageToken', ['0'])[0])
+        payload = dict(items=self.pages[i])
+        if i + 1 < len(self.pages):
+            payload['nextPageToken'] = str(i + 1)
+        else:
+            payload['nextSyncToken'] = 'next_sync_token'
+        body = json.dumps(payload).encode()
+        time.sleep(self.latency / 1000)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@contextmanager
+def stub_server(pages, latency):
+    # Point the api at a stub server for the duration.
+    handler = type('Handler', (StubHandler,), dict(pages=pages, latency=latency))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    calendars_uri = gcal_api.GCAL_CALENDARS_URI
+    insecure = os.environ.get('OAUTHLIB_INSECURE_TRANSPORT')
+    gcal_api.GCAL_CALENDARS_URI = f'http://127.0.0.1:{server.server_port}/calendar/v3/calendars'
+    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    try:
+        yield
+    finally:
+        gcal_api.GCAL_CALENDARS_URI = calendars_uri
+        if insecure is None:
+            del os.environ['OAUTHLIB_INSECURE_TRANSPORT']
+        else:
+            os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = insecure
+        server.shutdown()
+        server.server_close()
+
+def bench(calendar, pages, latency):
+    calendar.user.tokens = json.dumps(dict(access_token='stub', token_type='Bearer', refresh_token='stub',
+                                           expires_at=time.time() + 3600))
+    db.session.commit()
+    results = dict()
+    with stub_server(pages, latency):
+        for prefetch in [False, True]:
+            # Both runs import every item.
+            Change.query.delete()
+            FixedEvent.query.filter_by(calendar=calendar).delete()
+            db.session.commit()
+            t0 = time.time()
+            gcal_sync_full(calendar, gcal_list_entries_generator(calendar, prefetch=prefetch))
+            elapsed = time.time() - t0
+            num_items = sum(len(page) for page in pages)
+            print(f'prefetch={prefetch}: {len(pages)} pages, {num_items} items in {elapsed:.2f}s, {num_items/elapsed:.0f} items/sec')
+            results[prefetch] = elapsed
+    return results
+
+def main(pages=10, page_size=1000, latency=500):
+    if not app.env == 'development':
+        raise Exception('this should only be run in a local dev environment to avoid polluting database')
+
+    random.seed(0)
+
+    u = mkuser(f'jeff@example.com')
+    users = [mkuser(f'{i}@example.com') for i in range(5)]
+    bench(u.primary_calendar, mkpages(u.email, [v.email for v in users], pages, page_size), latency)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--page_size', type=int, default=1000)
+    parser.add_argument('--latency', type=int, default=500, help='ms per request')
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,114 @@
+#microbenchmarks for kron_app.interval_index.
+#
+#  python -m kron_app.scripts.interval_index_bench memory [-n 20000] [-u 200] [-q 2000]
+#  python -m kron_app.scripts.interval_index_bench sql [-n 50]
+#
+#memory times overlap queries on synthetic items, the interval index against a scan of all items
+#starting before the window end (as run_solver did before the index).
+#sql times the fixed event and draft lookups for the next n floaties in the db, one query per floaty
+#(get_fixed_events and overlapping_draft) against loading a ProblemData once and asking it.
+
+import argparse
+import random
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from time import monotonic
+from sqlalchemy import event
+from kron_app.interval_index import IntervalIndex
+from kron_app.utils import dotdict
+
+def synthetic_items(n, n_users, days=90, seed=0):
+  rng = random.Random(seed)
+  basetime = datetime(2023, 1, 2)
+  items = []
+  for _ in range(n):
+    start = basetime + timedelta(minutes=15*rng.randrange(days*96))
+    items.append(dotdict(start_at=start, end_at=start + timedelta(minutes=15*rng.randrange(1, 16)),
+                         users=[rng.randrange(n_users)]))
+  return items, basetime
+
+def scan_overlapping(starts, order, items, start, end, user_ids):
+  #the index before: items sorted by start, everything starting before end checked
+  hi = bisect_left(starts, end)
+  found = [i for i in order[:hi] if items[i].end_at > start and not user_ids.isdisjoint(items[i].users)]
+  return [items[i] for i in sorted(found)]
+
+def bench_memory(n=20000, users=200, queries=2000, **kwargs):
+  items, basetime = synthetic_items(n, users)
+  rng = random.Random(1)
+  windows = []
+  for _ in range(queries):
+    start = basetime + timedelta(minutes=15*rng.randrange(90*96))
+    windows.append((start, start + timedelta(days=rng.choice([1, 3, 7])), set(rng.sample(range(users), 5))))
+
+  wallstart = monotonic()
+  index = IntervalIndex(items)
+  build = monotonic() - wallstart
+  wallstart = monotonic()
+  found = [index.overlapping(*w) for w in windows]
+  indexed = monotonic() - wallstart
+
+  wallstart = monotonic()
+  order = sorted(range(len(items)), key=lambda i: items[i].start_at)
+  starts = [items[i].start_at for i in order]
+  scan_build = monotonic() - wallstart
+  wallstart = monotonic()
+  scanned = [scan_overlapping(starts, order, items, *w) for w in windows]
+  scan = monotonic() - wallstart
+
+  assert found == scanned
+  print(f"{n} items, {users} users, {queries} queries")
+  print(f"  index: build {round(build*1000)} ms, queries {round(indexed*1000)} ms")
+  print(f"  scan:  build {round(scan_build*1000)} ms, queries {round(scan*1000)} ms")
+
+def count_queries(fn):
+  from kron_app import db
+  n = [0]
+  def count(*args):
+    n[0] += 1
+  event.listen(db.engine, 'before_cursor_execute', count)
+  try:
+    wallstart = monotonic()
+    out = fn()
+    return out, round((monotonic()-wallstart)*1000), n[0]
+  finally:
+    event.remove(db.engine, 'before_cursor_execute', count)
+
+def bench_sql_events(events):
+  from kron_app.run_solver import get_fixed_events, overlapping_draft, ProblemData
+  def sql():
+    return [(get_fixed_events(e.window_start, e.window_end, e.allattendees),
+             overlapping_draft(e.window_start, e.window_end, e.allattendees)) for e in events]
+  def indexed():
+    data = ProblemData(events)
+    return [(data.fixed_events(e.window_start, e.window_end, e.allattendees),
+             data.drafts(e.window_start, e.window_end, e.allattendees)) for e in events]
+  for name,fn in [('sql', sql), ('index', indexed)]:
+    out, ms, queries = count_queries(fn)
+    print(f"  {name}: {ms} ms, {queries} queries, {sum(len(f)+len(d) for f,d in out)} events found")
+
+def bench_sql(n=50, **kwargs):
+  from kron_app.models import Event, EventState
+  events = Event.query.filter(Event.state.in_([EventState.INIT, EventState.UNSCHEDULED, EventState.SCHEDULED])) \
+                      .filter(Event.window_end > datetime.utcnow()) \
+                      .order_by(Event.window_start).limit(n).all()
+  print(f"{len(events)} floaties")
+  bench_sql_events(events)
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  parser_memory = subparsers.add_parser('memory', help='Index against a scan, on synthetic items.')
+  parser_memory.add_argument('-n', type=int, default=20000)
+  parser_memory.add_argument('-u', '--users', type=int, default=200)
+  parser_memory.add_argument('-q', '--queries', type=int, default=2000)
+  parser_memory.set_defaults(fn=bench_memory)
+
+  parser_sql = subparsers.add_parser('sql', help='ProblemData against per floaty queries, on the db.')
+  parser_sql.add_argument('-n', type=int, default=50)
+  parser_sql.set_defaults(fn=bench_sql)
+
+  args = parser.parse_args()
+  args.fn(**{k:v for k,v in vars(args).items() if not k in ['command', 'fn']})
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import argparse, random, time
+from kron_app.kron_directives import parse_kron_directive, parse_kron_directive_grammar, _parse_kron_directive
+
+# python -m kron_app.scripts.kron_directive_bench [-n 20000] [--series 2000]
+#
+# Times parsing the summaries of a synthetic calendar sync with the
+# grammar alone (as every summary was parsed before caching and the
+# simple directive regex), with the regex but no cache, and with
+# `parse_kron_directive`, from a cold cache.
+#
+# The corpus is `-n` summaries drawn from `--series` distinct ones,
+# since most summaries repeat (the instances of recurring events).
+# About 1 in 10 series is a kron directive, mostly simple ones.
+
+TITLES = ['Standup', 'Weekly sync', '1:1 Paul / Noah', 'Lunch', 'Team retro', 'Interview: backend candidate',
+          'Focus time', 'Dentist', 'Board prep', 'Planning', 'Coffee with Jane', 'Flight to SFO', 'Gym',
+          'Customer call - Acme', 'Design review', 'Office hours', 'Reading group', 'All hands']
+
+DIRECTIVES = ['@kron', '@kronistic', '@kron if needed', '@kron if really needed', '@Kron free if really really needed',
+              '@kron available', '@kron available if needed', '@kron if needed.', '@kron available for Bob',
+              '@kron available for "Bob" if needed, available if really needed']
+
+def mkcorpus(n, series, seed=0):
+    rng = random.Random(seed)
+    summaries = []
+    for i in range(series):
+        if rng.random() < 0.1:
+            summaries.append(rng.choice(DIRECTIVES))
+        else:
+            summaries.append(f'{rng.choice(TITLES)} #{i}')
+    # Recurring series are heavy tailed: a few series have most instances.
+    weights = [1/(i+1) for i in range(series)]
+    return rng.choices(summaries, weights, k=n)
+
+def timed(name, parse, corpus):
+    t0 = time.time()
+    results = [parse(s) for s in corpus]
+    elapsed = time.time() - t0
+    print(f'{name}: {len(corpus)} summaries in {elapsed:.3f}s, {len(corpus)/elapsed:.0f} summaries/sec')
+    return results
+
+def main(n=20000, series=2000):
+    corpus = mkcorpus(n, series)
+    print(f'{len(set(corpus))} distinct summaries, {sum("@kron" in s.lower() for s in corpus)} directives')
+    before = timed('grammar', parse_kron_directive_grammar, corpus)
+    uncached = timed('uncached', _parse_kron_directive.__wrapped__, corpus)
+    _parse_kron_directive.cache_clear()
+    after = timed('parse_kron_directive', parse_kron_directive, corpus)
+    assert before == uncached == after
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000)
+    parser.add_argument('--series', type=int, default=2000)
+    main(**vars(parser.parse_args()))
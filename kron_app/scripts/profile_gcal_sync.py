@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
-import time, random, cProfile
+import argparse, time, random, cProfile
 from uuid import uuid4
 from datetime import datetime, timedelta
 from kron_app import db, app
-from kron_app.models import User, FixedEvent
+from kron_app.models import User, FixedEvent, Change
 from kron_app.gcal_integration import to_iso8601, gcal_sync_incremental, gcal_sync_full
 from kron_app.tests.test_gcal_sync import sim_api, mkuser
 
-# ./scripts/dbdrop.sh ; ./scripts/dbreset.sh ; ./scripts/profile_gcal_sync.py
+# ./scripts/dbdrop.sh ; ./scripts/dbreset.sh ; python -m kron_app.scripts.profile_gcal_sync
+#
+# Benchmarks full sync of a calendar with `--pages` pages of
+# `--page_size` items, reporting items/sec for each of:
+#
+#   import:    the first full sync, every item new
+#   unchanged: a full sync that sees the same items again
+#   modified:  a full sync with 10% of items moved and 10% removed
+#   inc:       an incremental sync of the same items as "import", into
+#              an empty calendar
+#
+# Use `--profile` to print the cProfile stats of each phase.
 
 # Note: for kalendars sync is now dominated by kron directive parsing.
 # For regular calendars, (real) sync is dominated by the http
@@ -27,7 +38,52 @@ def mkitem(attendees=None):
     #item['recurringEventId'] = 'foo-bar-baz'
     return item
 
-def main():
+def modify(pages):
+    # Move 10% of items by an hour, and drop another 10%.
+    out = []
+    for page in pages:
+        out.append([])
+        for item in page:
+            r = random.random()
+            if r < 0.1:
+                start = datetime.fromisoformat(item['start']['dateTime']) + timedelta(hours=1)
+                end = datetime.fromisoformat(item['end']['dateTime']) + timedelta(hours=1)
+                out[-1].append(dict(item, start={'dateTime': start.isoformat()}, end={'dateTime': end.isoformat()}))
+            elif r >= 0.2:
+                out[-1].append(item)
+    return out
+
+def timed(phase, sync, calendar, pages, profile=False):
+    num_items = sum(len(page) for page in pages)
+    with cProfile.Profile() as pr:
+        t0 = time.time()
+        sync(calendar, sim_api(*pages))
+        elapsed = time.time() - t0
+    if profile:
+        pr.print_stats('cumtime')
+    fixed = FixedEvent.query.filter_by(calendar=calendar).count()
+    print(f'{phase}: {num_items} items in {elapsed:.2f}s, {num_items/elapsed:.0f} items/sec, {fixed} fixed events')
+    return num_items/elapsed
+
+def bench(calendar, pages, profile=False):
+    results = dict()
+    results['import'] = timed('import', gcal_sync_full, calendar, pages, profile)
+    results['unchanged'] = timed('unchanged', gcal_sync_full, calendar, pages, profile)
+    results['modified'] = timed('modified', gcal_sync_full, calendar, modify(pages), profile)
+    Change.query.delete()
+    FixedEvent.query.filter_by(calendar=calendar).delete()
+    calendar.gcal_sync_token = 'next_sync_token'
+    db.session.commit()
+    results['inc'] = timed('inc', gcal_sync_incremental, calendar, pages, profile)
+    return results
+
+def mkpages(email, other_emails, num_pages, page_size):
+    def attendees():
+        n = random.randint(0, len(other_emails)-1)
+        return [dict(email=e) for e in [email] + random.sample(other_emails, n)]
+    return [[mkitem(attendees=attendees()) for _ in range(page_size)] for _ in range(num_pages)]
+
+def main(pages=5, page_size=1000, num_users=5, profile=False):
     if not app.env == 'development':
         raise Exception('this should only be run in a local dev environment to avoid polluting database')
 
@@ -35,36 +91,15 @@ def main():
 
     u = mkuser(f'jeff@example.com')
     c = u.calendars[0]
-
-    num_users = 5
     users = [mkuser(f'{i}@example.com') for i in range(num_users)]
 
-    def noattendees():
-        return None
-
-    def attendees():
-        max_attendees = num_users
-        n = random.randint(0, max_attendees-1)
-        random.shuffle(users)
-        emails = [u.email] + [u.email for u in users[:n]]
-        return [dict(email=email) for email in emails]
-
-    pages = [[mkitem(attendees=attendees()) for _ in range(1000)] for _ in range(5)]
-
-    # t0 = time.time()
-    # result = gcal_sync_incremental(c, sim_api(*pages))
-    # elapsed = time.time() - t0
-    # print(f'result={result}, elapsed={elapsed}')
-
-    with cProfile.Profile() as pr:
-        t0 = time.time()
-        result = gcal_sync_incremental(c, sim_api(*pages))
-        elapsed = time.time() - t0
-    #pr.print_stats('cumtime')
-    print(f'result={result}, elapsed={elapsed}')
-
-    print(FixedEvent.query.filter_by(calendar=c).count())
+    bench(c, mkpages(u.email, [v.email for v in users], pages, page_size), profile)
     print([c for c in u.contacts])
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--page_size', type=int, default=1000)
+    parser.add_argument('--num_users', type=int, default=5)
+    parser.add_argument('--profile', action='store_true')
+    main(**vars(parser.parse_args()))
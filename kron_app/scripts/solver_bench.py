@@ -0,0 +1,170 @@
+#replay benchmark over logged solver problems.
+#
+#  python -m kron_app.scripts.solver_bench run solver.pickle [more.pickle..] -o results.json
+#  python -m kron_app.scripts.solver_bench diff before.json after.json
+#
+#run replays every problem in the corpus (pickles from /admin/solver.pickle) through solver.solver
+#in this process, with the same config for all, and writes a results file. diff compares two results
+#files run by run and exits with status 1 if any run regressed, so it can gate solver and mask changes.
+#
+#to see what warm starting from the logged drafts saves, run once with --no_warm_start and once without,
+#and diff the two (cold first): walltimes are compared run by run.
+
+import argparse
+import json
+import math
+import pickle
+import sys
+from copy import deepcopy
+from datetime import datetime
+from time import process_time, monotonic
+from kron_app.solver.solver import solver, adjust_masks
+from kron_app.solver.utils import FloatMeeting
+from kron_app.scripts.explore_problem_dumps import load_problem
+
+RESULTS_VERSION = 1
+
+def load_corpus(logfiles):
+  #(source, index, SolverLog data) for every entry in the pickles that has its problem (see SOLVER_LOG_SAMPLE), in order
+  corpus = []
+  for logfile in logfiles:
+    with open(logfile, 'rb') as f:
+      runs = pickle.load(f)
+    corpus += [(logfile, i, r) for i,r in enumerate(runs) if 'floaties' in r]
+  return corpus
+
+def objective_values(floaties, masks, schedule, basetime, grain=900):
+  """
+  the solver objectives for a schedule, evaluated on the original masks:
+  priority of scheduled optional meetings (+10 for those with a draft, as in kron_solver),
+  total mask cost at the scheduled starts, optional attendees included, and meetings kept at their draft start.
+  """
+  masks = deepcopy(masks)
+  scheduled = {d['id']: d for d in schedule or []}
+  values = dict(optional=0, cost=0, optional_attendees=0, kept_drafts=0)
+  for f in floaties:
+    d = scheduled.get(f.id)
+    if d is None:
+      continue
+    if f.is_optional:
+      values['optional'] += f.priority + (10 if f.draft_start is not None else 0)
+    if f.draft_start is not None and d['start'] == f.draft_start:
+      values['kept_drafts'] += 1
+    m = masks[f.id]
+    mask = adjust_masks(m.masks.hard,basetime,grain).plus(adjust_masks(m.masks.ifneeded,basetime,grain)).plus(adjust_masks(m.masks.sooner,basetime,grain))
+    for u in f.optionalattendees:
+      if u in d['actualattendees']:
+        values['optional_attendees'] += 1
+        mask.plus(adjust_masks(m.optatt_masks[u],basetime,grain))
+    t = (d['start']-basetime).total_seconds()/grain
+    values['cost'] += mask.abstract_eval(t,fn=lambda is_inf,y: math.inf if is_inf else y)
+  values['cost'] = round(values['cost'],2)
+  return values
+
+def replay(r, config):
+  #solve one logged problem, returning its results entry
+  floaties,masks,now,basetime,_ = load_problem(deepcopy(r))
+  floaties = [FloatMeeting(**f) for f in floaties]
+  masks = {f.id: masks[f.id] for f in floaties}
+  stats = {}
+  cpustart = process_time()
+  wallstart = monotonic()
+  result, schedule, unscheduled, result_code = solver(floaties,basetime=basetime,masks=deepcopy(masks),config=config,stats=stats)
+  walltime = round((monotonic()-wallstart)*1000)
+  cputime = round((process_time()-cpustart)*1000)
+  components = stats.get('components',[])
+  return dict(problem_size=len(floaties),
+              basetime=basetime.isoformat(),
+              result=result,
+              result_code=result_code,
+              walltime=walltime,
+              cputime=cputime,
+              unscheduled=len(unscheduled),
+              objectives=objective_values(floaties,masks,schedule,basetime) if result else None,
+              components=len(components),
+              pairs=sum(c.get('pairs',0) for c in components),
+              formula_size=sum(c.get('formula_size',0) for c in components))
+
+def bench_run(logfiles, out='bench_results.json', timeout=60000, backend='z3', encoding='iftree', processes=1, warm_start=True, start=0, end=None):
+  config = {'timeout':timeout, 'backend':backend, 'mask_encoding':encoding, 'processes':processes, 'warm_start':warm_start, 'formula_stats':True}
+  corpus = load_corpus(logfiles)[start:end]
+  runs = []
+  for source,i,r in corpus:
+    entry = dict(source=source, index=i, **replay(r,config))
+    print(f"{source}:{i}: {entry['problem_size']} floaties, {entry['result_code']} in {entry['walltime']} (cpu {entry['cputime']}), "
+          f"{entry['unscheduled']} unscheduled, objectives {entry['objectives']}")
+    runs.append(entry)
+  with open(out, 'w') as f:
+    json.dump(dict(version=RESULTS_VERSION, created_at=datetime.utcnow().isoformat(), config=config, runs=runs), f, indent=1)
+  print(f"{len(runs)} runs, total time {sum(r['walltime'] for r in runs)}, written to {out}")
+
+def lex_objectives(o):
+  #the objectives in solver priority order, larger is better
+  return (o['optional'], -o['cost'], o['optional_attendees'], o['kept_drafts'])
+
+def regressions(old, new, slowdown=1.5, min_time=1000):
+  """reasons why run new is worse than run old: failing, more unscheduled, worse objectives, or slower."""
+  reasons = []
+  if old['result'] and not new['result']:
+    reasons.append(f"failed ({new['result_code']})")
+  if new['unscheduled'] > old['unscheduled']:
+    reasons.append(f"unscheduled {old['unscheduled']} -> {new['unscheduled']}")
+  if old['objectives'] and new['objectives'] and lex_objectives(new['objectives']) < lex_objectives(old['objectives']):
+    reasons.append(f"objectives {old['objectives']} -> {new['objectives']}")
+  if new['walltime'] > max(slowdown*old['walltime'], old['walltime']+min_time):
+    reasons.append(f"walltime {old['walltime']} -> {new['walltime']}")
+  return reasons
+
+def bench_diff(old, new, slowdown=1.5, min_time=1000):
+  with open(old) as f:
+    old = json.load(f)
+  with open(new) as f:
+    new = json.load(f)
+  old_runs = {(r['source'],r['index']): r for r in old['runs']}
+  regressed = 0
+  totals = [0,0]
+  for r in new['runs']:
+    key = (r['source'],r['index'])
+    o = old_runs.get(key)
+    if o is None or (o['problem_size'],o['basetime']) != (r['problem_size'],r['basetime']):
+      print(f"{key[0]}:{key[1]}: no matching run, skipped")
+      continue
+    totals[0] += o['walltime']
+    totals[1] += r['walltime']
+    reasons = regressions(o,r,slowdown,min_time)
+    if reasons:
+      regressed += 1
+      print(f"{key[0]}:{key[1]}: REGRESSION {', '.join(reasons)}")
+    else:
+      print(f"{key[0]}:{key[1]}: ok, walltime {o['walltime']} -> {r['walltime']}")
+  print(f"total walltime {totals[0]} -> {totals[1]}, {regressed} regressions")
+  return regressed
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  parser_run = subparsers.add_parser('run', help='Replay logged problems and write a results file.')
+  parser_run.add_argument('logfiles', nargs='+')
+  parser_run.add_argument('-o', '--out', default='bench_results.json')
+  parser_run.add_argument('-t', '--timeout', type=int, default=60000)
+  parser_run.add_argument('-b', '--backend', choices=['z3','cpsat'], default='z3')
+  parser_run.add_argument('--encoding', choices=['iftree','table'], default='iftree')
+  parser_run.add_argument('-p', '--processes', type=int, default=1)
+  parser_run.add_argument('--no_warm_start', dest='warm_start', action='store_false', help="don't warm start from the logged drafts")
+  parser_run.add_argument('-s', '--start', type=int, default=0)
+  parser_run.add_argument('-e', '--end', type=int)
+  parser_run.set_defaults(fn=bench_run)
+
+  parser_diff = subparsers.add_parser('diff', help='Compare two results files, exit 1 on regressions.')
+  parser_diff.add_argument('old')
+  parser_diff.add_argument('new')
+  parser_diff.add_argument('--slowdown', type=float, default=1.5, help='flag runs slower by this factor..')
+  parser_diff.add_argument('--min_time', type=int, default=1000, help='..and by at least this many ms')
+  parser_diff.set_defaults(fn=bench_diff)
+
+  args = parser.parse_args()
+  out = args.fn(**{k:v for k,v in vars(args).items() if not k in ['command', 'fn']})
+  if args.command == 'diff' and out:
+    sys.exit(1)
@@ -0,0 +1,188 @@
+#solver core using OR-Tools CP-SAT on a time-indexed formulation.
+#
+#this is an alternative to kron_solver in solver.py, selected with config['backend']='cpsat'.
+#it takes the same floaties and (already adjusted, see solver.solver) masks and returns the same
+#(result, floaties, result_code), so the two can be compared on the same problems.
+#
+#times are integer grains from basetime. each start is a variable whose domain is the union of the
+#grain intervals where the mask is finite, and its penalty is looked up in a table of mask values
+#(one entry per grain) with an element constraint, so there are no If trees and no second LRA pass.
+#non-overlap is a NoOverlap per user over optional intervals, present when the user is at the meeting.
+#the objectives are the same as kron_solver, optimized lexicographically by solving once per objective
+#and then fixing it to at least the value found.
+#
+#ortools is an optional dependency (pip install kronistic[cpsat]), this module is only imported when the
+#cpsat backend is used.
+
+import copy
+import math
+from fractions import Fraction
+from time import monotonic
+import numpy as np
+from ortools.sat.python import cp_model
+from kron_app.mask_utils import Topo, grain_bins
+from kron_app.utils import DotDict
+
+def mask_intervals(mask):
+  """the integer grains where mask is finite, as a sorted list of [lo,hi] intervals."""
+  intervals = []
+  for lo,hi,v in grain_bins(mask):
+    if intervals and intervals[-1][1]+1>=lo:
+      intervals[-1][1] = hi
+    else:
+      intervals.append([lo,hi])
+  return intervals
+
+def mask_table(mask, lo, hi):
+  """the value of mask at each grain in [lo,hi], rounded to ints. grains where mask is inf get 0."""
+  table = np.zeros(hi-lo+1)
+  t = np.arange(lo,hi+1)
+  data = [None] + mask.data + [None]
+  for i in range(0,len(data)-2,2):
+    e1,(m,b),e2 = data[i],data[i+1],data[i+2]
+    if math.isinf(b):
+      continue
+    first = lo if e1 is None else max(lo, math.ceil(e1.val) if e1.side==Topo.RIGHT else math.floor(e1.val)+1)
+    last = hi if e2 is None else min(hi, math.ceil(e2.val)-1 if e2.side==Topo.RIGHT else math.floor(e2.val))
+    if first<=last:
+      table[first-lo:last-lo+1] = m*t[first-lo:last-lo+1]+b
+  return [int(v) for v in np.round(table)]
+
+def penalty(model, start, lo, table, present, name):
+  """an int var that is table[start-lo] when present, and 0 otherwise."""
+  index = model.NewIntVar(0, len(table)-1, name+"index")
+  model.Add(index == start-lo)
+  value = model.NewIntVar(min(table), max(table), name+"value")
+  model.AddElement(index, table, value)
+  cost = model.NewIntVar(min(0,min(table)), max(0,max(table)), name+"cost")
+  model.Add(cost == value).OnlyEnforceIf(present)
+  model.Add(cost == 0).OnlyEnforceIf(present.Not())
+  return cost
+
+def both(model, a, b, name):
+  #a bool that is a and b
+  ab = model.NewBoolVar(name)
+  model.AddBoolAnd([a,b]).OnlyEnforceIf(ab)
+  model.AddBoolOr([a.Not(),b.Not()]).OnlyEnforceIf(ab.Not())
+  return ab
+
+#the largest scale for the optional attendee scores, which keeps objective coefficients small:
+OPTATT_SCALE_LIMIT = 10**6
+
+def optatt_weights(floaties, limit=OPTATT_SCALE_LIMIT):
+  """
+  the optional attendee score of a meeting is the priority of each included optional attendee over the meeting's
+  total (between 0 and 1, as for kron_solver). returns (scale, weights), where weights[m.id][u] is the score of u
+  at m, times scale, as an int. scale is the lcm of the totals, which makes the weights exact, unless that is over
+  limit, in which case scale is limit and each weight is rounded (and we say so, since the objective is then
+  only close to kron_solver's).
+  """
+  totals = {m.id: sum(m.optionalattendeepriorities[a] for a in m.optionalattendees) for m in floaties}
+  totals = {k:v for k,v in totals.items() if v>0}
+  scale = math.lcm(*totals.values()) if totals else 1
+  if scale>limit:
+    print(f"  cpsat optional attendee scale {scale} clamped to {limit}, optional attendee weights are rounded")
+    scale = limit
+  weights = {m.id: {u: round(Fraction(scale*m.optionalattendeepriorities[u], totals[m.id])) for u in m.optionalattendees}
+             for m in floaties if m.id in totals}
+  return scale, weights
+
+def cpsat_solver(floaties, config, masks, stats=None):
+  floaties=[DotDict(m.dict()) for m in floaties]
+  model = cp_model.CpModel()
+
+  #optional attendee scores are fractions of each meeting's total, scale them to ints:
+  scale, weights = optatt_weights(floaties)
+
+  user_intervals = {}
+  optionalmtgs, optionalatt, cost, optatt_cost, keep_draft_start = [], [], [], [], []
+  for m in floaties:
+    m.exist = model.NewBoolVar(m.id+"exist")
+    if not m.is_optional:
+      model.Add(m.exist == 1)
+
+    mask = copy.deepcopy(masks[m.id].masks.hard)
+    mask.plus(masks[m.id].masks.ifneeded).plus(masks[m.id].masks.sooner).simplify()
+    intervals = mask_intervals(mask)
+    if not intervals:
+      #no allowed start, so the meeting can't exist (unsat if it is required, as for kron_solver)
+      model.Add(m.exist == 0)
+      intervals = [[0,0]]
+    lo, hi = intervals[0][0], intervals[-1][1]
+    m.start = model.NewIntVarFromDomain(cp_model.Domain.FromIntervals(intervals), m.id+"start")
+    cost.append(-penalty(model, m.start, lo, mask_table(mask,lo,hi), m.exist, m.id))
+
+    m.included = {}
+    for u in m.optionalattendees:
+      m.included[u] = model.NewBoolVar(u+m.id+"included")
+      present = both(model, m.exist, m.included[u], u+m.id+"present")
+      umask = copy.deepcopy(masks[m.id].optatt_masks[u]).simplify()
+      uintervals = mask_intervals(umask)
+      if uintervals:
+        model.AddLinearExpressionInDomain(m.start, cp_model.Domain.FromIntervals(uintervals)).OnlyEnforceIf(present)
+      else:
+        model.Add(present == 0)
+      optatt_cost.append(-penalty(model, m.start, lo, mask_table(umask,lo,hi), present, u+m.id))
+      user_intervals.setdefault(u,[]).append(model.NewOptionalFixedSizeIntervalVar(m.start, m.length, present, u+m.id+"interval"))
+    for u in m.attendees:
+      user_intervals.setdefault(u,[]).append(model.NewOptionalFixedSizeIntervalVar(m.start, m.length, m.exist, u+m.id+"interval"))
+
+    #scheduled meetings have at least one attendee:
+    if not m.attendees:
+      model.AddBoolOr(list(m.included.values())).OnlyEnforceIf(m.exist)
+
+    if m.is_optional:
+      optionalmtgs.append(m.priority*m.exist)
+      if m.draft_start is not None:
+        optionalmtgs.append(10*m.exist)
+    if m.id in weights:
+      optionalatt += [weights[m.id][u]*v for u,v in m.included.items()]
+
+    if m.draft_start is not None:
+      keep = model.NewBoolVar(m.id+"keepdraft")
+      model.Add(m.start == m.draft_start).OnlyEnforceIf(keep)
+      model.AddImplication(keep, m.exist)
+      keep_draft_start.append(10*keep)
+
+  for u,intervals in user_intervals.items():
+    if len(intervals)>1:
+      model.AddNoOverlap(intervals)
+
+  #same lexicographic order as kron_solver:
+  objectives = [[2*scale*x for x in optionalmtgs]+optionalatt, cost, optatt_cost, keep_draft_start]
+  objectives = [ob for ob in objectives if ob]
+  hint_vars = [v for m in floaties for v in [m.exist, m.start]+list(m.included.values())]
+
+  solver = cp_model.CpSolver()
+  solver.parameters.num_workers = config.get('workers', 8)
+  deadline = monotonic() + config['timeout']/1000
+  values, optimal = None, True
+  for i,ob in enumerate(objectives):
+    model.Maximize(sum(ob))
+    solver.parameters.max_time_in_seconds = max((deadline-monotonic())/(len(objectives)-i), 0.01)
+    status = solver.Solve(model)
+    print(f"  cpsat objective {i} took {round(solver.WallTime()*1000)} (timeout {config['timeout']}), result {solver.StatusName(status)}")
+    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+      if values is None:
+        return False, None, "cpsat_unsat" if status==cp_model.INFEASIBLE else "cpsat_timeout"
+      #keep the solution from the previous objective
+      optimal = False
+      break
+    optimal = optimal and status==cp_model.OPTIMAL
+    values = [solver.Value(v) for v in hint_vars]
+    model.Add(sum(ob) >= round(solver.ObjectiveValue()))
+    model.ClearHints()
+    for v,x in zip(hint_vars,values):
+      model.AddHint(v,x)
+
+  values = dict(zip([v.Index() for v in hint_vars],values))
+  for m in floaties:
+    if values[m.exist.Index()]:
+      start = values[m.start.Index()]
+      m.time = [start, start+m.length]
+    else:
+      m.time = "unscheduled"
+    m.actualattendees = m.attendees + [u for u,v in m.included.items() if values[v.Index()]]
+    del m.exist, m.start, m.included
+
+  return True, floaties, "cpsat_"+("optimal" if optimal else "feasible")
@@ -1,12 +1,14 @@
 # import pysmt.shortcuts as ps
 # from copy import deepcopy
 import copy
-from time import process_time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import process_time, monotonic
 import z3 
 from kron_app.utils import DotDict 
 from datetime import datetime, timedelta
 import math
-from kron_app.mask_utils import Edge, Topo, find_bin, bin_max, coarsen_costs, discretize_slopes
+from kron_app.mask_utils import PWlinear, Edge, Topo, find_bin, grain_bins, bin_max, coarsen_costs, discretize_slopes
 from kron_app.utils import dictunion
 
 Time = z3.RealSort()
@@ -144,8 +146,8 @@ class Set:
 #   length = row['window_end']-row['window_start'] #if not row['window_end'] is None else z3.Const(row['id']+"windowlength", Time)
 #   return Interval(start, length, name=row['id']+"window")
 
-def make_time(row):
-  start = z3.Const(row['id']+"start", Time)
+def make_time(row, sort=Time):
+  start = z3.Const(row['id']+"start", sort)
   return Interval(start, row.length, optional= row.is_optional, name=row.id)
 
 def make_attendees(row):
@@ -184,7 +186,65 @@ def make_attendees(row):
 
 #   return a
 
-def kron_solver(floaties, config, masks):
+def compile_mask(mask, start):
+  """
+  flat encoding of a step mask at integer start: a selector per bin of allowed integer starts (see grain_bins).
+  returns (allowed, penalty): allowed when some selector holds, and penalty the value of the selected bin.
+  unlike abstract_eval's nested If tree, each bin appears once, so the terms grow linearly with the bins.
+  """
+  bins = grain_bins(mask)
+  selectors = [start==lo if lo==hi else z3.And(start>=lo, start<=hi) for lo,hi,v in bins]
+  allowed = z3.Or(selectors) if selectors else z3.BoolVal(False)
+  terms = [z3.If(sel,constant(v[1]),constant(0)) for sel,(lo,hi,v) in zip(selectors,bins) if v[1]!=0]
+  penalty = z3.Sum(terms) if terms else 0
+  return allowed, penalty
+
+def formula_size(exprs):
+  #the number of distinct nodes in the z3 dag of exprs
+  seen = set()
+  todo = [e for e in exprs if z3.is_expr(e)]
+  while todo:
+    e = todo.pop()
+    if e.get_id() not in seen:
+      seen.add(e.get_id())
+      todo.extend(e.children())
+  return len(seen)
+
+def warm_start(floaties, constraints, config):
+  """
+  check whether the previous schedule is still a model: floaties with a draft start exist there (without optional
+  attendees), optional floaties without one don't exist. returns the model (or None) and the check time in ms.
+  the check gets up to a tenth of the timeout, since it's only worth it if it is much quicker than optimizing,
+  and the time it takes comes out of the optimizer's timeout.
+  """
+  assignment = []
+  for m in floaties:
+    if m.draft_start is not None:
+      assignment.append(m.time.start == m.draft_start)
+      if not isinstance(m.time.exist, bool):
+        assignment.append(m.time.exist)
+      assignment += [z3.Not(m.actualattendees.contains(u)) for u in m.optionalattendees]
+    elif not isinstance(m.time.exist, bool):
+      assignment.append(z3.Not(m.time.exist))
+  solver = z3.Solver()
+  solver.set("timeout", max(100, config['timeout']//10))
+  solver.assert_exprs(constraints + assignment)
+  wallstart = monotonic()
+  result = solver.check()
+  walltime = round((monotonic()-wallstart)*1000)
+  print(f"  warm start check took {walltime}, result {result}")
+  return (solver.model() if result==z3.sat else None), walltime
+
+def kron_solver(floaties, config, masks, stats=None):
+  """
+  if config['warm_start'] (default True) and some floaties have draft starts, the previous schedule is checked first
+  and, when it is still a model, used to seed the optimizer (see two_pass_optimize).
+  if stats is a dict, stats['warm_start'] records whether it was feasible, the check time, and the time the
+  (warm started) optimizer took.
+  config['mask_encoding'] is 'iftree' (default) to evaluate masks with abstract_eval on a real start,
+  or 'table' for an integer start and compile_mask. with config['formula_stats'], stats['formula_size'] is the
+  size of the first pass formula and stats['pairs'] the number of non-overlap constraints.
+  """
   # solvestart = process_time()
 
   floaties=[DotDict(m.dict()) for m in floaties]
@@ -196,22 +256,22 @@ def kron_solver(floaties, config, masks):
   # solver = z3.SolverFor("QF_LIA") 
   # solver = z3.SolverFor("QF_LRA") 
 
+  table = config.get('mask_encoding','iftree')=='table'
+
   #add time interval variables for floating meetings to schedule
-  for m in floaties: m.time=make_time(m)
+  for m in floaties: m.time=make_time(m, z3.IntSort() if table else Time)
 
   #convert attendees into Set class
   for m in floaties: m.actualattendees = make_attendees(m)
 
   constraints=[]
 
-  #impose non-overlap constraint on floaties:
-  for r in floaties:
-    for s in floaties:
-      if r==s: break
-      #TODO: can further narrow this to cases where r and s windows overlap.
-      if r.actualattendees.could_intersect(s.actualattendees): 
-        ax = z3.Implies(r.actualattendees.any_intersect(s.actualattendees), r.time.empty_intersect(s.time) )
-        constraints.append(ax)
+  #impose non-overlap constraint on floaties that share attendees and whose feasible spans overlap:
+  pairs = pair_constraints(floaties,masks,prune=config.get('prune_pairs',True))
+  for i,j in pairs:
+    r,s = floaties[i],floaties[j]
+    ax = z3.Implies(r.actualattendees.any_intersect(s.actualattendees), r.time.empty_intersect(s.time) )
+    constraints.append(ax)
 
   #impose constraint that scheduled meetings have at least one attendee
   for r in floaties:
@@ -263,17 +323,23 @@ def kron_solver(floaties, config, masks):
       return e1,(0,round((y1+y2)/2),2),e2
     step_mask.apply_domains(bin_mean_helper).simplify()
 
-    allowed_start = step_mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: not is_inf) 
+    if table:
+      allowed_start, penalty = compile_mask(step_mask, m.time.start)
+    else:
+      allowed_start = step_mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: not is_inf) 
+      penalty = step_mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: 0 if is_inf else y)
     constraints.append(z3.If(m.time.exist,allowed_start,True)) 
-    penalty = step_mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: 0 if is_inf else y)
     cost += z3.If(m.time.exist,-penalty,0)
 
     for u in m.optionalattendees:
       mask=copy.deepcopy(masks[m.id].optatt_masks[u])
       mask.apply_domains(bin_mean_helper).simplify()
-      allowed_start = mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: not is_inf) 
+      if table:
+        allowed_start, penalty = compile_mask(mask, m.time.start)
+      else:
+        allowed_start = mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: not is_inf) 
+        penalty = mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: 0 if is_inf else y) 
       constraints.append(z3.If(z3.And(m.time.exist,m.actualattendees.contains(u)), allowed_start, True))
-      penalty = mask.abstract_eval(m.time.start,If=z3.If,fn=lambda is_inf,y: 0 if is_inf else y) 
       optatt_cost += z3.If(z3.And(m.time.exist,m.actualattendees.contains(u)), -penalty, 0)
 
   #soft constraint that meetings should be at their draft start time
@@ -303,8 +369,19 @@ def kron_solver(floaties, config, masks):
     objectives.append(keep_draft_start) #keep draft start time is lex last
   # print(objectives)
   # print(constraints)
+  if stats is not None and config.get('formula_stats'):
+    stats['formula_size'] = formula_size(constraints+objectives)
+    stats['pairs'] = len(pairs)
+
+  initial, check_time = None, 0
+  if config.get('warm_start',True) and any(m.draft_start is not None for m in floaties):
+    initial, check_time = warm_start(floaties,constraints,config)
   print("solve with wmax objective")
-  result,mod, two_pass = two_pass_optimize(objectives,constraints,config)
+  wallstart = monotonic()
+  result,mod, two_pass = two_pass_optimize(objectives,constraints,dictunion(config,{'timeout':max(1,config['timeout']-check_time)}),initial=initial)
+  if stats is not None and config.get('warm_start',True) and any(m.draft_start is not None for m in floaties):
+    optimize_time = round((monotonic()-wallstart)*1000)
+    stats['warm_start'] = dict(feasible=initial is not None, check_time=check_time, optimize_time=optimize_time)
   print(f" wmax solve was {result} {'with' if two_pass else 'without'} second pass.")
 
   if result != z3.sat:
@@ -428,11 +505,19 @@ After a timeout signal occurred when maximizing an obj instance obtained from ma
 i think this means "upper" is actually the lower bound on the objective...
 """
 
-def two_pass_optimize(objectives,constraints=[],config={'timeout':60000}):
+def two_pass_optimize(objectives,constraints=[],config={'timeout':60000},initial=None):
+  """
+  lexicographically maximize objectives subject to constraints.
+  initial is an optional known model (a warm start). the optimum can't be worse than it on the first objective,
+  so that is imposed as a bound, and it is returned if we time out without finding a model of our own.
+  (we don't pass it to Optimize.set_initial_value: in z3 5.1 that can return models violating the constraints.)
+  """
   two_pass=False
   solver = z3.Optimize()
   # z3.set_param(verbose=1)
   solver.assert_exprs(constraints)
+  if initial is not None and objectives:
+    solver.add(objectives[0] >= initial.eval(objectives[0], model_completion=True))
   # solver.push()
   objs = [solver.maximize(ob) for ob in objectives]
   solver.set("timeout", config['timeout'])  
@@ -480,14 +565,222 @@ def two_pass_optimize(objectives,constraints=[],config={'timeout':60000}):
         m=solver.model() if result==z3.sat else m
         f=f/2 #is this fast enough?
       result=prevresult #set back to last sat (before exiting loop)
+
+  if result!=z3.sat and result!=z3.unsat and initial is not None:
+    print("  no model before timeout, using warm start")
+    result, m = z3.sat, initial
   
   # m=solver.model() if result==z3.sat else None
   return result, m, two_pass
 
 
+def solver_backend(name):
+  """the solver core for config['backend']. all take (floaties, config, masks, stats=None) and return (result, floaties, result_code).
+  backends other than z3 have optional dependencies, so they are only imported when asked for."""
+  if name == 'z3':
+    return kron_solver
+  elif name == 'cpsat':
+    from kron_app.solver.cpsat import cpsat_solver
+    return cpsat_solver
+  raise ValueError(f"unknown solver backend {name}")
+
+def feasible_span(mask, length):
+  """
+  bounds on the time a floaty can occupy, from the finite part of its (adjusted) hard mask:
+  (earliest allowed start, latest allowed start+length), or None if no start is allowed.
+  """
+  data = [None] + mask.data + [None]
+  finite = [i for i in range(0,len(data)-2,2) if not math.isinf(data[i+1][1])]
+  if not finite:
+    return None
+  e1, e2 = data[finite[0]], data[finite[-1]+2]
+  return (-math.inf if e1 is None else e1.val), (math.inf if e2 is None else e2.val)+length
+
+def overlapping_pairs(floaties, masks):
+  """
+  the pairs (i,j), j<i, of floaties whose feasible spans overlap, in order.
+  found by a sweep over spans sorted by start, keeping the spans that haven't ended yet.
+  """
+  spans = [feasible_span(masks[m.id].masks.hard, m.length) for m in floaties]
+  order = sorted((i for i in range(len(floaties)) if spans[i] is not None), key=lambda i: spans[i][0])
+  active, pairs = [], []
+  for i in order:
+    active = [j for j in active if spans[j][1]>spans[i][0]]
+    pairs += [(max(i,j),min(i,j)) for j in active]
+    active.append(i)
+  return sorted(pairs)
+
+def pair_constraints(floaties, masks, prune=True):
+  """
+  the pairs (i,j), j<i, of floaties that need a non-overlap constraint: those that share an (optional)attendee.
+  with prune, only pairs whose feasible spans overlap, since other pairs can never be at the same time.
+  """
+  if prune:
+    pairs = overlapping_pairs(floaties,masks)
+  else:
+    pairs = [(i,j) for i in range(len(floaties)) for j in range(i)]
+  people = [set(m.attendees+m.optionalattendees) for m in floaties]
+  return [(i,j) for i,j in pairs if people[i] & people[j]]
+
+def components(floaties, masks):
+  """
+  partition floaties into groups that can't interact: two floaties are linked if they share an (optional)attendee
+  and their feasible spans overlap, and the groups are the connected components of these links.
+  no constraint spans two groups and the objectives are sums over floaties, so solving each group on its own
+  gives an optimal schedule for the whole problem.
+  linking is a sweep per user over spans sorted by start. groups are lists of indices into floaties, in order.
+  """
+  parent = list(range(len(floaties)))
+  def find(i):
+    while parent[i]!=i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  spans = [feasible_span(masks[m.id].masks.hard, m.length) for m in floaties]
+  by_user = {}
+  for i,m in enumerate(floaties):
+    if spans[i] is not None:
+      for u in m.attendees+m.optionalattendees:
+        by_user.setdefault(u,[]).append(i)
+  for u,idx in by_user.items():
+    idx.sort(key=lambda i: spans[i][0])
+    first, end = None, -math.inf
+    for i in idx:
+      if first is not None and spans[i][0]<end:
+        parent[find(i)] = find(first)
+        end = max(end,spans[i][1])
+      else:
+        first, end = i, spans[i][1]
+
+  groups = {}
+  for i in range(len(floaties)):
+    groups.setdefault(find(i),[]).append(i)
+  return list(groups.values())
+
+MIN_COMPONENT_TIMEOUT = 1000
+
+def component_timeout(size, sizes_left, time_left, lanes=1):
+  """
+  the timeout (ms) for a group of size about to start, when time_left (ms) remains and sizes_left is the total size of
+  the groups not yet started (this one included): its share by size of what is left, over the lanes that are free.
+  the last group gets all that is left, as does any group whose share would be more. never below MIN_COMPONENT_TIMEOUT.
+  """
+  return max(MIN_COMPONENT_TIMEOUT, min(time_left, round(time_left*lanes*size/sizes_left)))
+
+def solve_component(floaties, config, masks):
+  #run the configured backend on one group, returning its result plus wall time (ms) and the backend's stats.
+  wallstart = monotonic()
+  stats = {}
+  result, schedule, result_code = solver_backend(config.get('backend','z3'))(floaties, config=config, masks=masks, stats=stats)
+  return result, schedule, result_code, round((monotonic()-wallstart)*1000), stats
+
+def solve_components(jobs, timeout, processes=1):
+  """
+  run solve_component on each (floaties, config, masks) job, sharing timeout (ms) between them.
+  jobs start smallest first, each with a timeout from component_timeout when it starts, so time left over by fast
+  components goes to the later, larger ones and the last one gets everything that is left.
+  with processes>1 jobs run in a pool of processes, up to processes at a time: z3 contexts can't be shared between
+  threads, and neither z3 nor the db connections survive a fork, so we spawn.
+  returns the outcomes and the timeouts given, in job order.
+  """
+  order = sorted(range(len(jobs)), key=lambda k: len(jobs[k][0]))
+  deadline = monotonic() + timeout/1000
+  outcomes, timeouts = [None]*len(jobs), [None]*len(jobs)
+  def next_job(lanes):
+    k = order.pop(0)
+    floaties, config, masks = jobs[k]
+    time_left = round((deadline-monotonic())*1000)
+    #never more than the whole timeout, even after the MIN_COMPONENT_TIMEOUT floor:
+    timeouts[k] = min(timeout, component_timeout(len(floaties), sum(len(jobs[j][0]) for j in [k]+order), time_left, min(lanes,len(order)+1)))
+    return k, (floaties, dictunion(config,{'timeout':timeouts[k]}), masks)
+
+  if processes<=1 or len(jobs)<=1:
+    while order:
+      k, job = next_job(1)
+      outcomes[k] = solve_component(*job)
+    return outcomes, timeouts
+
+  ctx = multiprocessing.get_context('spawn')
+  with ProcessPoolExecutor(max_workers=min(processes,len(jobs)), mp_context=ctx) as pool:
+    running = {}
+    while order or running:
+      while order and len(running)<processes:
+        k, job = next_job(processes-len(running))
+        running[pool.submit(solve_component, *job)] = k
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for f in done:
+        outcomes[running.pop(f)] = f.result()
+  return outcomes, timeouts
+
+def merge_result_codes(codes):
+  #one code if all components agree, otherwise the distinct codes
+  codes = sorted(set(codes))
+  return codes[0] if len(codes)==1 else "+".join(codes)
+
+def pin_masks(floaties, masks, pinned):
+  """
+  copy of (adjusted) masks where each floaty in pinned can only start at its draft start.
+  floaties without a draft start, or whose draft start the hard mask doesn't allow, are left free.
+  returns the masks and the ids that were pinned.
+  """
+  masks = copy.deepcopy(masks)
+  held = []
+  for m in floaties:
+    if m.id not in pinned or m.draft_start is None:
+      continue
+    hard = masks[m.id].masks.hard
+    if not hard.abstract_eval(m.draft_start,fn=lambda is_inf,y: not is_inf):
+      continue
+    hard.plus(PWlinear(math.inf,Edge(m.draft_start,Topo.RIGHT),0,Edge(m.draft_start,Topo.LEFT),math.inf))
+    held.append(m.id)
+  return masks, held
+
+def solve_groups(floaties, masks, config, stats=None):
+  """
+  solve each independent group of (adjusted) floaties on its own, unless config['decompose'] is False.
+  returns result, the solved floaties in order, the merged result code and whether every group was solved.
+  """
+  groups = components(floaties,masks) if config.get('decompose',True) else [list(range(len(floaties)))]
+  if len(groups)>1:
+    print(f"solving {len(groups)} independent components, sizes {sorted((len(g) for g in groups),reverse=True)}")
+  jobs = [([floaties[i] for i in g], config, {floaties[i].id: masks[floaties[i].id] for i in g}) for g in groups]
+  outcomes, timeouts = solve_components(jobs,config['timeout'],config.get('processes',1))
+
+  schedule_floaties = []
+  for g,(gresult,gschedule,gcode,gtime,gstats) in zip(groups,outcomes):
+    if gresult:
+      schedule_floaties += list(zip(g,gschedule))
+  schedule_floaties = [m for i,m in sorted(schedule_floaties,key=lambda x: x[0])]
+  if stats is not None:
+    stats['components'] = [dict(size=len(g),timeout=t,result=o[0],result_code=o[2],walltime=o[3],**o[4]) for g,t,o in zip(groups,timeouts,outcomes)]
+  return any(o[0] for o in outcomes), schedule_floaties, merge_result_codes([o[2] for o in outcomes]), all(o[0] for o in outcomes)
+
+def adjust_masks(mask, basetime, grain=900):
+  #first we (finish) converting times into grains-from-basetime:
+  mask.apply_edges(lambda x: (x-basetime).total_seconds()/grain)
+  mask.apply(lambda p: (p[0]*grain,p[1]))
+  #push bin edges to even steps (is this needed?)
+  mask.apply_edges(lambda x: math.floor(x) if math.isfinite(x) else x)
+  # #next we are going to discretize the linear functions: times to nearest grain (floor) and costs to nearest utile (ceil to avoid making a cost zero?). we do this only because z3 optimize doesn't seem to do well with complex rational constants -- for mysterious reasons. 
+  # discretize_slopes(mask)
+  return mask
+
 ####### main entry point to solver
-def solver(floaties, basetime: datetime, grain : int =900, masks={}, config = {'timeout': 60000}):
-  """now indicates the current time and is used for makeing sure meetings aren't scheduled sooner than their freeze horizon"""  
+def solver(floaties, basetime: datetime, grain : int =900, masks={}, config = {'timeout': 60000}, stats=None, pinned=(), partial=False):
+  """now indicates the current time and is used for makeing sure meetings aren't scheduled sooner than their freeze horizon.
+  config['backend'] picks the solver core (see solver_backend), default z3.
+  independent components are solved separately, sharing config['timeout'] (see solve_components), in config['processes'] processes (default 1).
+  if any component fails (unsat or timeout) result is False, as for a failed solve of the whole problem, unless partial:
+  then a failed component leaves its floaties out of both the schedule and the unscheduled ids, and result is False
+  only if every component failed.
+  pinned are ids of floaties to first try holding at their draft start (incremental solving): the rest are solved
+  around them with a quarter of the timeout, and only if that fails or leaves anything unscheduled do we solve
+  the whole problem again with everything free, in what is left of the timeout.
+  if stats is a dict, per component sizes, timeouts, results, result codes and wall times are put in stats['components'],
+  and for incremental solves the number pinned and whether we widened in stats['incremental'].
+  """  
+  solver_backend(config.get('backend','z3')) #fail early on an unknown backend
   if len(floaties)==0:
     return True,[],[], "trivial_problem"
 
@@ -504,25 +797,37 @@ def solver(floaties, basetime: datetime, grain : int =900, masks={}, config = {'
       m.draft_start = (m.draft_start-basetime).total_seconds()/grain
       m.draft_start = math.floor(m.draft_start)
 
-  def adjust_masks(mask):
-    #first we (finish) converting times into grains-from-basetime:
-    mask.apply_edges(lambda x: (x-basetime).total_seconds()/grain)
-    mask.apply(lambda p: (p[0]*grain,p[1]))
-    #push bin edges to even steps (is this needed?)
-    mask.apply_edges(lambda x: math.floor(x) if math.isfinite(x) else x)
-    # #next we are going to discretize the linear functions: times to nearest grain (floor) and costs to nearest utile (ceil to avoid making a cost zero?). we do this only because z3 optimize doesn't seem to do well with complex rational constants -- for mysterious reasons. 
-    # discretize_slopes(mask)
-
   for mid,m in masks.items():
     # bin_max(m.masks.ifneeded,basetime)
     # coarsen_costs(m.masks.ifneeded,2)
-    adjust_masks(m.masks.hard)
-    adjust_masks(m.masks.ifneeded)
-    adjust_masks(m.masks.sooner)
+    adjust_masks(m.masks.hard,basetime,grain)
+    adjust_masks(m.masks.ifneeded,basetime,grain)
+    adjust_masks(m.masks.sooner,basetime,grain)
     for u,mask in m.optatt_masks.items():
-      adjust_masks(mask)
-
-  result, schedule_floaties, result_code = kron_solver(floaties,config = config,masks=masks)
+      adjust_masks(mask,basetime,grain)
+
+  solved = None
+  timeout = config['timeout']
+  if pinned:
+    #the solver cores mutate masks, so pin_masks hands us a copy and masks are left for widening.
+    pinned_masks, held = pin_masks(floaties,masks,set(pinned))
+    if held:
+      print(f"incremental solve, {len(held)} of {len(floaties)} floaties pinned to their draft start")
+      deadline = monotonic() + timeout/1000
+      solved = solve_groups(floaties,pinned_masks,dictunion(config,{'timeout':max(MIN_COMPONENT_TIMEOUT,timeout//4)}),stats)
+      result, schedule_floaties, result_code, complete = solved
+      #widening gets what is left of the timeout, if anything:
+      timeout = round((deadline-monotonic())*1000)
+      widen = (not complete or any(m.time=="unscheduled" for m in schedule_floaties)) and timeout>0
+      if stats is not None:
+        stats['incremental'] = dict(pinned=len(held),widened=widen)
+      if widen:
+        print(f"incremental solve {result_code} with unscheduled or failed floaties, widening to full problem")
+        solved = None
+  if solved is None:
+    solved = solve_groups(floaties,masks,dictunion(config,{'timeout':timeout}),stats)
+  result, schedule_floaties, result_code, complete = solved
+  result = result and (complete or partial)
 
   if result:
     unschedueled_ids = [m['id'] for m in schedule_floaties if m.time=="unscheduled"]
@@ -0,0 +1,249 @@
+#serialization of SolverLog payloads.
+#
+#the payload of a solver run (see run_solver.solver_with_logging) holds the problem: floaties, masks and times,
+#plus the result and assorted stats. it is stored as json with a schema version, where
+#  datetimes are ints, microseconds since EPOCH, and timedeltas are ints, microseconds,
+#  masks are PWlinearArray columns: {'e': edges, 'r': 'R'/'L' per edge, 'm': slopes, 'b': intercepts (None for inf)},
+#   with the first edge as a time and the rest as differences from the one before,
+#  floaties and the schedule are stored by column, and problem provenance as {id: tag}.
+#the json is zlib compressed and base64'd (masks repeat a lot between floaties), which is what makes rows small.
+#the fields listed on the admin page (SUMMARY_FIELDS) are also stored uncompressed in SolverLog.summaryjson,
+#so the list doesn't have to unpack every payload.
+#loads returns the payload with python types again (datetimes, PWlinear masks in DotDicts, ..) and never evals:
+#payloads logged before the schema was versioned (everything repr'd) have no version and are parsed with a
+#whitelist, see parse_repr. version 1 is the format described here.
+
+import ast
+import base64
+import copy
+import json
+import math
+import zlib
+import datetime
+from datetime import timedelta
+import numpy as np
+from kron_app.mask_utils import PWlinear, PWlinearArray, Edge, Topo, EPOCH, US
+from kron_app.utils import DotDict
+
+VERSION = 1
+
+SUMMARY_FIELDS = ['pid', 'cputime', 'walltime', 'mem_rss_before', 'mem_rss_after', 'mem_available', 'caller',
+                  'result_code', 'problem_size']
+
+FLOATY_TIMES = ['window_start', 'window_end', 'draft_start']
+FLOATY_DURATIONS = ['freeze_horizon', 'length']
+
+def encode_time(t):
+  return None if t is None else (t-EPOCH)//US
+
+def decode_time(x):
+  return None if x is None else EPOCH+timedelta(microseconds=x)
+
+def encode_duration(d):
+  return None if d is None else d//US
+
+def decode_duration(x):
+  return None if x is None else timedelta(microseconds=x)
+
+def compact_num(x):
+  return int(x) if x.is_integer() else x
+
+def encode_mask(pw):
+  a = PWlinearArray.from_pwlinear(pw)
+  edges = a.edges.tolist()
+  return {'e': edges[:1]+[x-y for x,y in zip(edges[1:],edges)],
+          'r': ''.join('R' if r else 'L' for r in a.right.tolist()),
+          'm': [compact_num(m) for m in a.m.tolist()],
+          'b': [None if math.isinf(b) else compact_num(b) for b in a.b.tolist()]}
+
+def decode_mask(d):
+  edges = np.cumsum(np.asarray(d['e'], dtype=np.int64))
+  return PWlinearArray(edges, [r=='R' for r in d['r']], d['m'], [math.inf if b is None else b for b in d['b']]).to_pwlinear()
+
+def encode_masks(masks):
+  return {id: {'masks': {k: encode_mask(pw) for k,pw in u['masks'].items()},
+               'optatt_masks': {a: encode_mask(pw) for a,pw in u['optatt_masks'].items()}}
+          for id,u in masks.items()}
+
+def snapshot_masks(masks):
+  #masks as they are now, for encode_masks later. the solver adjusts masks in place but only ever replaces their
+  #data (edges and values are never changed in place), so copying each mask's data list is enough, and much cheaper.
+  def snapshot(pw):
+    pw = copy.copy(pw)
+    pw.data = list(pw.data)
+    return pw
+  return {id: {'masks': {k: snapshot(pw) for k,pw in u['masks'].items()},
+               'optatt_masks': {a: snapshot(pw) for a,pw in u['optatt_masks'].items()}}
+          for id,u in masks.items()}
+
+def decode_masks(masks):
+  return DotDict({id: DotDict({'masks': DotDict({k: decode_mask(pw) for k,pw in u['masks'].items()}),
+                               'optatt_masks': DotDict({a: decode_mask(pw) for a,pw in u['optatt_masks'].items()})})
+                  for id,u in masks.items()})
+
+def columns(rows, times=(), durations=()):
+  #list of dicts -> dict of lists, with times and durations as ints
+  keys = list(rows[0].keys()) if rows else []
+  cols = {k: [r[k] for r in rows] for k in keys}
+  for k in times:
+    if k in cols:
+      cols[k] = [encode_time(t) for t in cols[k]]
+  for k in durations:
+    if k in cols:
+      cols[k] = [encode_duration(t) for t in cols[k]]
+  return cols
+
+def rows(cols, times=(), durations=()):
+  cols = dict(cols)
+  for k in times:
+    if k in cols:
+      cols[k] = [decode_time(t) for t in cols[k]]
+  for k in durations:
+    if k in cols:
+      cols[k] = [decode_duration(t) for t in cols[k]]
+  n = len(next(iter(cols.values()))) if cols else 0
+  return [DotDict({k: v[i] for k,v in cols.items()}) for i in range(n)]
+
+def encode_overlapping(overlapping):
+  return {id: {kind: columns(fs, times=['start_at','end_at']) for kind,fs in o.items()} for id,o in overlapping.items()}
+
+def decode_overlapping(overlapping):
+  return {id: {kind: rows(fs, times=['start_at','end_at']) for kind,fs in o.items()} for id,o in overlapping.items()}
+
+def encode(data):
+  """the json-able form of a solver log payload"""
+  out = dict(data, version=VERSION)
+  if 'floaties' in data:
+    out['floaties'] = columns(data['floaties'], FLOATY_TIMES, FLOATY_DURATIONS)
+  if 'masks' in data:
+    out['masks'] = encode_masks(data['masks'])
+  for k in ['now', 'basetime']:
+    if k in data:
+      out[k] = encode_time(data[k])
+  if 'result' in data:
+    result, schedule, unscheduled, result_code = data['result']
+    out['result'] = [result, None if schedule is None else columns(schedule, times=['start','end']), unscheduled, result_code]
+  if 'problem_prov' in data:
+    prov = data['problem_prov']
+    out['problem_prov'] = {str(k): v for k,v in getattr(prov, 'elts', prov).items()}
+  if 'overlapping' in data:
+    out['overlapping'] = encode_overlapping(data['overlapping'])
+  return out
+
+def decode(d):
+  """a solver log payload from its json-able form (see encode)"""
+  out = dict(d)
+  if 'floaties' in d:
+    out['floaties'] = [dict(f) for f in rows(d['floaties'], FLOATY_TIMES, FLOATY_DURATIONS)]
+  if 'masks' in d:
+    out['masks'] = decode_masks(d['masks'])
+  for k in ['now', 'basetime']:
+    if k in d:
+      out[k] = decode_time(d[k])
+  if 'result' in d:
+    result, schedule, unscheduled, result_code = d['result']
+    out['result'] = [result, None if schedule is None else rows(schedule, times=['start','end']), unscheduled, result_code]
+  if 'problem_prov' in d:
+    out['problem_prov'] = {int(k): v for k,v in d['problem_prov'].items()}
+  if 'overlapping' in d:
+    out['overlapping'] = decode_overlapping(d['overlapping'])
+  return out
+
+def summary(d):
+  """the SUMMARY_FIELDS of a payload, encoded or not (they are plain json either way)"""
+  return {k: d.get(k) for k in SUMMARY_FIELDS}
+
+def pack(d):
+  """the stored text of an encoded payload (see encode)"""
+  #anything else that isn't json-able is repr'd, as before versioning
+  s = json.dumps(d, separators=(',',':'), default=repr)
+  return base64.b64encode(zlib.compress(s.encode())).decode()
+
+def dumps(data):
+  return pack(encode(data))
+
+def loads(s):
+  #plain json is a payload from before compression (or before versioning)
+  if not s.startswith('{'):
+    s = zlib.decompress(base64.b64decode(s)).decode()
+  d = json.loads(s)
+  if d.get('version') is None:
+    return upgrade_legacy(d)
+  if d['version'] > VERSION:
+    raise ValueError(f"solver log version {d['version']} is newer than {VERSION}")
+  return decode(d)
+
+#the names that may appear in repr'd payloads, for parse_repr:
+REPR_CALLS = {'datetime.datetime': datetime.datetime,
+              'datetime.timedelta': datetime.timedelta,
+              'PWlinear': PWlinear,
+              'Edge': Edge}
+REPR_NAMES = {'inf': math.inf, 'Topo.RIGHT': Topo.RIGHT, 'Topo.LEFT': Topo.LEFT, 'True': True, 'False': False, 'None': None}
+
+def parse_repr(s):
+  """
+  the value of a repr'd datetime, timedelta, mask or python literal, without eval:
+  only literals and the calls and names above are allowed.
+  """
+  def dotted(node):
+    if isinstance(node, ast.Name):
+      return node.id
+    if isinstance(node, ast.Attribute):
+      return dotted(node.value)+'.'+node.attr
+    raise ValueError(f"unexpected {ast.dump(node)} in solver log")
+
+  def value(node):
+    if isinstance(node, ast.Constant):
+      return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+      return -value(node.operand)
+    if isinstance(node, ast.Tuple):
+      return tuple(value(e) for e in node.elts)
+    if isinstance(node, ast.List):
+      return [value(e) for e in node.elts]
+    if isinstance(node, ast.Dict):
+      return {value(k): value(v) for k,v in zip(node.keys, node.values)}
+    if isinstance(node, (ast.Name, ast.Attribute)):
+      name = dotted(node)
+      if name not in REPR_NAMES:
+        raise ValueError(f"unexpected name {name} in solver log")
+      return REPR_NAMES[name]
+    if isinstance(node, ast.Call):
+      name = dotted(node.func)
+      if name not in REPR_CALLS:
+        raise ValueError(f"unexpected call {name} in solver log")
+      args = []
+      for a in node.args:
+        if isinstance(a, ast.Starred):
+          args += value(a.value)
+        else:
+          args.append(value(a))
+      return REPR_CALLS[name](*args, **{k.arg: value(k.value) for k in node.keywords})
+    raise ValueError(f"unexpected {ast.dump(node)} in solver log")
+
+  return value(ast.parse(s, mode='eval').body)
+
+def upgrade_legacy(d):
+  """a payload logged with json.dumps(default=repr), with the repr'd fields parsed back (see parse_repr)"""
+  d = dict(d)
+  if 'floaties' in d:
+    d['floaties'] = [dict(f, **{k: parse_repr(f[k]) for k in FLOATY_TIMES+FLOATY_DURATIONS if isinstance(f.get(k), str)})
+                     for f in d['floaties']]
+  if 'masks' in d:
+    d['masks'] = DotDict({id: DotDict({k: DotDict({t: parse_repr(w) for t,w in v.items()}) for k,v in u.items()})
+                          for id,u in d['masks'].items()})
+  for k in ['now', 'basetime']:
+    if isinstance(d.get(k), str):
+      d[k] = parse_repr(d[k])
+  if d.get('result'):
+    result, schedule, unscheduled, result_code = d['result']
+    if schedule:
+      schedule = [DotDict(dict(s, start=parse_repr(s['start']), end=parse_repr(s['end']))) for s in schedule]
+    d['result'] = [result, schedule, unscheduled, result_code]
+  if isinstance(d.get('problem_prov'), str):
+    d['problem_prov'] = parse_repr(d['problem_prov'])
+  if d.get('overlapping'):
+    d['overlapping'] = {id: {kind: [dict(f, start_at=parse_repr(f['start_at']), end_at=parse_repr(f['end_at'])) for f in fs]
+                             for kind,fs in o.items()}
+                        for id,o in d['overlapping'].items()}
+  return d
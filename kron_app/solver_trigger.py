@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+from sqlalchemy import update, or_
+from sqlalchemy.dialects import postgresql
+from kron_app import app, db
+from kron_app.models import SolverTrigger
+
+# Requests for a solver run are coalesced: a request only records that
+# the solver is needed (in the single `solver_trigger` row) and the
+# solver then runs once for all of the requests made before it started.
+# The run waits until no request has been made for `SOLVER_DEBOUNCE`,
+# but never more than `SOLVER_MAX_LATENCY` after the first request.
+
+def request_solver_run(utcnow=None):
+    """
+    Record that the solver needs to run. Returns True for the first
+    request since the solver last ran, for which the caller should
+    queue a run.
+    """
+    if utcnow is None:
+        utcnow = datetime.utcnow()
+    db.session.execute(postgresql.insert(SolverTrigger).values(id=1).on_conflict_do_nothing())
+    first = db.session.execute(update(SolverTrigger)
+                               .where(SolverTrigger.id == 1, SolverTrigger.requested_at == None)
+                               .values(requested_at=utcnow, last_requested_at=utcnow)).rowcount == 1
+    if not first:
+        db.session.execute(update(SolverTrigger)
+                           .where(SolverTrigger.id == 1)
+                           .values(last_requested_at=utcnow))
+    db.session.commit()
+    return first
+
+def solver_run_wait(utcnow=None):
+    """
+    How long until the requested solver run is due (zero when it's due
+    now), or None when no run has been requested.
+    """
+    if utcnow is None:
+        utcnow = datetime.utcnow()
+    trigger = SolverTrigger.query.get(1)
+    if trigger is None or trigger.requested_at is None:
+        return None
+    due = min(trigger.last_requested_at + app.config['SOLVER_DEBOUNCE'],
+              trigger.requested_at + app.config['SOLVER_MAX_LATENCY'])
+    return max(due - utcnow, timedelta(0))
+
+def claim_solver_run(utcnow=None):
+    """
+    Clear the requests if the run they asked for is due, in one
+    statement, so that of the tasks that find the run due (the queued
+    task and the periodic one) only one runs the solver. Returns True
+    for that one.
+    """
+    if utcnow is None:
+        utcnow = datetime.utcnow()
+    claimed = db.session.execute(update(SolverTrigger)
+                                 .where(SolverTrigger.id == 1,
+                                        SolverTrigger.requested_at != None,
+                                        or_(SolverTrigger.last_requested_at <= utcnow - app.config['SOLVER_DEBOUNCE'],
+                                            SolverTrigger.requested_at <= utcnow - app.config['SOLVER_MAX_LATENCY']))
+                                 .values(requested_at=None, last_requested_at=None)
+                                 .returning(SolverTrigger.id)).first() is not None
+    db.session.commit()
+    return claimed
+
+def clear_solver_requests():
+    # Called as a run that wasn't claimed (e.g. from the cli) starts.
+    # Requests made while it runs will queue another run.
+    db.session.execute(update(SolverTrigger)
+                       .where(SolverTrigger.id == 1)
+                       .values(requested_at=None, last_requested_at=None))
+    db.session.commit()
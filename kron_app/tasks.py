@@ -1,13 +1,15 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy import or_
-from kron_app import celery, db
+from kron_app import app, celery, db
 from kron_app.models import User, Calendar, Event, EventState, ErrorLog, Email, GcalPushState
 from kron_app.gcal_api import get_oauth_session_for_user, stop_gcal_channel
-from kron_app.gcal_integration import gcal_renew, gcal_sync, gcal_sync_full, gcal_subscribe, gcal_set_gcal_summary, gcal_sync_event_2, gcal_create_calendar_for_push, gcal_update_api_quotas, gcal_list_calendars, gcal_handle_user_notification
+from kron_app.gcal_integration import gcal_renew, gcal_sync, gcal_sync_full, gcal_subscribe, gcal_set_gcal_summary, gcal_sync_event_2, gcal_request_sync_2, gcal_sync_user_2, gcal_create_calendar_for_push, gcal_update_api_quotas, gcal_list_calendars, gcal_handle_user_notification
 from kron_app.events import past_horizon, past_draft_end, past_window_end, delete_event, events_for
-from kron_app.run_solver import run_solver
+from kron_app.run_solver import run_solver, write_solver_log
 from kron_app.events import move_from_pending, delete_event, populate_contacts
 from kron_app.changes import record_current
+from kron_app.availability import materialize, refresh_materialized
+from kron_app.solver_trigger import request_solver_run, solver_run_wait, claim_solver_run, clear_solver_requests
 from kron_app.smtp import sendmail
 import kron_app.mail as mail
 
@@ -94,7 +96,7 @@ def complete_setup(user):
         db.session.commit()
         runsolver = move_from_pending(user)
         if runsolver:
-            task_run_solver.delay()
+            queue_solver_run()
         task_sendmail.delay(mail.welcome(user))
 
 @celery.task(on_failure=log_error)
@@ -152,7 +154,7 @@ def task_post_calendar_notification(calendar_id):
     calendar = Calendar.query.get(calendar_id)
     changes_made = gcal_sync(calendar)
     if changes_made:
-        task_run_solver.delay()
+        queue_solver_run()
 
 @celery.task(on_failure=log_error)
 def task_post_user_notification(user_id):
@@ -165,7 +167,7 @@ def task_post_create_events(event_ids, attendees_to_notify, invitees_to_notify,
     assert len(event_ids) >= 1
     event = Event.query.get(event_ids[0])
     if run_solver:
-        task_run_solver.delay()
+        queue_solver_run()
     for user_id in attendees_to_notify:
         user = User.query.get(user_id)
         if user.send_new_meeting_notifications:
@@ -183,7 +185,7 @@ def task_post_create_events(event_ids, attendees_to_notify, invitees_to_notify,
 @celery.task(on_failure=log_error)
 def task_post_modify_event(event_id, attendees_to_notify, invitees_to_notify, made_pending):
     event = Event.query.get(event_id)
-    task_run_solver.delay()
+    queue_solver_run()
     for user_id in attendees_to_notify:
         user = User.query.get(user_id)
         if user.send_new_meeting_notifications:
@@ -201,12 +203,12 @@ def task_delete_events(event_ids):
     for event_id in event_ids:
         delete_event(event_id)
         task_gcal_sync_event.delay(event_id)
-    task_run_solver.delay()
+    queue_solver_run()
 
 @celery.task(on_failure=log_error)
 def task_post_decline_meeting(user_id, event_ids, send_notification):
     assert len(event_ids) > 0
-    task_run_solver.delay()
+    queue_solver_run()
     # A meeting may have moved into PENDING, and therefore a calendar
     # sync may be required. We trigger the sync task for all meetings
     # for simplicity. (The sync task will avoid doing redundant work.)
@@ -228,21 +230,49 @@ def task_post_decline_invite(email_id, user_ids):
 def task_post_add_alias(tosync):
     for event_id in tosync:
         task_gcal_sync_event.delay(event_id)
-    task_run_solver.delay()
+    queue_solver_run()
 
 @celery.task(on_failure=log_error)
-def task_post_modify_user_timezone():
-    task_run_solver.delay()
+def task_post_modify_user_timezone(user_id=None):
+    if user_id is not None:
+        materialize(user_id)
+        db.session.commit()
+    queue_solver_run()
+
+@celery.task(on_failure=log_error)
+def task_refresh_availability():
+    refresh_materialized()
 
 @celery.task(on_failure=log_error)
 def task_post_modify_groups(user_id, group_names):
     pass
 
-# TODO: Specify a rate limit. i.e. Limit the number of times the
-# solver runs in some period of time.
-# https://docs.celeryq.dev/en/stable/userguide/tasks.html#Task.rate_limit
+# Ask for a solver run. Requests are coalesced into one run, at most
+# once per debounce window (see kron_app.solver_trigger).
+def queue_solver_run():
+    if request_solver_run():
+        task_solver_requested.apply_async(countdown=app.config['SOLVER_DEBOUNCE'].total_seconds())
+
+# Also run periodically, in case a queued task was lost.
+@celery.task(on_failure=log_error)
+def task_solver_requested():
+    wait = solver_run_wait()
+    if wait is None:
+        # An earlier run took care of it.
+        return
+    if wait > timedelta(0):
+        task_solver_requested.apply_async(countdown=wait.total_seconds())
+        return
+    # The other task may have found the run due too, only one claims it.
+    if claim_solver_run():
+        do_solver_run()
+
 @celery.task(on_failure=log_error)
 def task_run_solver():
+    clear_solver_requests()
+    do_solver_run()
+
+def do_solver_run():
     # Ensure that all events that are past their freeze horizon have
     # the final flag set when the solver runs. Otherwise we can hit
     # the issue described in #515.
@@ -255,6 +285,10 @@ def task_run_solver():
     for args in emails:
         task_send_solver_email.apply_async(args[:-1], countdown=args[-1])
 
+@celery.task(on_failure=log_error)
+def task_write_solver_log(record):
+    write_solver_log(record)
+
 @celery.task(on_failure=log_error)
 def task_post_add_calendar(calendar_id):
     calendar = Calendar.query.get(calendar_id)
@@ -263,11 +297,11 @@ def task_post_add_calendar(calendar_id):
     gcal_sync(calendar)
     gcal_subscribe(calendar)
     gcal_sync(calendar)
-    task_run_solver.delay()
+    queue_solver_run()
 
 @celery.task(on_failure=log_error)
 def task_post_delete_calendar(user_id, gcal_channel_id, gcal_resource_id):
-    task_run_solver.delay()
+    queue_solver_run()
     if gcal_channel_id and gcal_resource_id:
         user = User.query.get(user_id)
         if user:
@@ -288,9 +322,29 @@ def task_gcal_sync(calendar_id, full):
 def task_gcal_sync_event(event_id, yank=False):
     event = Event.query.get(event_id)
     assert event and event.gcal_sync_version == 2
-    for a in (a for a in event.attendances if a.email.user is not None):
-        task_gcal_sync_event_2.delay(a.id, yank)
+    # Each user's sync waits a little, so that it picks up the other
+    # events synced at the same time (e.g. by a solver run) and makes
+    # batched api calls for them all. The syncs queued for those
+    # events find nothing left to do.
+    countdown = app.config['GCAL_SYNC_BATCH_DELAY'].total_seconds()
+    for user_id in gcal_request_sync_2(event, yank):
+        task_gcal_sync_user_2.apply_async((user_id,), countdown=countdown)
 
+@celery.task(on_failure=log_error)
+def task_gcal_sync_user_2(user_id, attempt=0):
+    # Failed calls are left pending (see `gcal_sync_user_2`), and the
+    # sync is queued again to retry them, backing off, up to
+    # GCAL_SYNC_RETRIES times. After that they wait for the user's
+    # next sync.
+    failed = True
+    try:
+        failed = gcal_sync_user_2(user_id) > 0
+    finally:
+        if failed and attempt < app.config['GCAL_SYNC_RETRIES']:
+            countdown = app.config['GCAL_SYNC_BATCH_DELAY'].total_seconds() * 2**(attempt+1)
+            task_gcal_sync_user_2.apply_async((user_id, attempt+1), countdown=countdown)
+
+# No longer queued, kept for tasks queued before batching.
 @celery.task(on_failure=log_error)
 def task_gcal_sync_event_2(attendance_id, yank):
     gcal_sync_event_2(attendance_id, yank=yank)
@@ -1,6 +1,10 @@
 
 import math
-from kron_app.mask_utils import PWlinear, PWfn, Edge, Topo
+import random
+import pytest
+from copy import deepcopy
+from datetime import datetime, timedelta
+from kron_app.mask_utils import PWlinear, PWlinearArray, PWfn, Edge, Topo, mk_path, pw_sum, pw_segments, ifneeded_segments, grain_bins, eq_line
 
 def test_PWfn_combine():
   m=PWfn(False, Edge(1), True, Edge(2.3), False)
@@ -64,3 +68,141 @@ def test_PWlinear_plus():
 #TODO: check linear fns with slope (not just constant)
 
 #TODO: check that innterpolating up, plus interpolating down, then simplifying yields a constant function, even for small slopes
+
+
+def test_PWlinearArray_roundtrip():
+  t=datetime(2022,6,22,9,30,0,123)
+  x=PWlinear(math.inf,Edge(t,Topo.RIGHT),(0.5,2),Edge(t+timedelta(hours=1),Topo.LEFT),math.inf)
+  a=PWlinearArray.from_pwlinear(x)
+  assert len(a)==2
+  assert a.to_pwlinear()==x
+  assert a==x
+  assert x==a
+  assert PWlinearArray()==PWlinear(0)
+  assert PWlinearArray()!=PWlinear(math.inf)
+
+def test_PWlinearArray_plus():
+  t=datetime(2022,6,22)
+  #shared edge with different sides, as in test_PWlinear_plus:
+  x=PWlinear(math.inf,Edge(t+timedelta(hours=1),Topo.RIGHT),0,Edge(t+timedelta(hours=2),Topo.RIGHT),math.inf)
+  y=PWlinear(0,Edge(t+timedelta(hours=1),Topo.LEFT),math.inf,Edge(t+timedelta(hours=2),Topo.LEFT),0)
+  a=PWlinearArray.from_pwlinear(x).plus(y)
+  assert a==PWlinear(math.inf,Edge(t+timedelta(hours=1),Topo.RIGHT),0,Edge(t+timedelta(hours=1),Topo.LEFT),math.inf)
+
+  x=PWlinear(0,Edge(t,Topo.LEFT),1)
+  y=PWlinear(0,Edge(t,Topo.RIGHT),4)
+  z=PWlinear(0,Edge(t,Topo.RIGHT),2,Edge(t+timedelta(hours=1),Topo.LEFT),1)
+  a=PWlinearArray.from_pwlinear(y).plus(x)
+  assert a==PWlinear(0,Edge(t,Topo.RIGHT),4,Edge(t,Topo.LEFT),5)
+  a.plus(PWlinearArray.from_pwlinear(z))
+  assert a==PWlinear(0,Edge(t,Topo.RIGHT),6,Edge(t,Topo.LEFT),7,Edge(t+timedelta(hours=1),Topo.LEFT),6)
+
+def test_PWlinearArray_plus_matches_PWlinear():
+  random.seed(0)
+  t=datetime(2022,6,22)
+  def rand_mask():
+    n=random.randint(0,6)
+    xs=sorted(random.sample(range(0,24),n))
+    data=[random.choice([0,1,math.inf,(0.25,3)])]
+    for x in xs:
+      data.append(Edge(t+timedelta(hours=x),random.choice([Topo.LEFT,Topo.RIGHT])))
+      data.append(random.choice([0,1,math.inf,(0.25,3)]))
+    return PWlinear(*data).simplify()
+  for _ in range(200):
+    masks=[rand_mask() for _ in range(4)]
+    expected=deepcopy(masks[0])
+    a=PWlinearArray.from_pwlinear(masks[0])
+    for m in masks[1:]:
+      expected.plus(m)
+      a.plus(m)
+    assert a==expected
+    assert a.to_pwlinear()==expected
+
+def test_PWlinearArray_from_segments():
+  random.seed(1)
+  t=datetime(2022,6,22)
+  for _ in range(200):
+    segments=[]
+    expected=PWlinear(0)
+    for _ in range(random.randint(0,20)):
+      start=t+timedelta(minutes=15*random.randint(0,100))
+      end=start+timedelta(minutes=15*random.randint(1,8))
+      val=random.choice([1,math.inf])
+      side=random.choice([(Topo.LEFT,Topo.RIGHT),(Topo.RIGHT,Topo.LEFT)])
+      segments.append((Edge(start,side[0]),Edge(end,side[1]),val))
+      expected.plus(PWlinear(0,Edge(start,side[0]),val,Edge(end,side[1]),0))
+    assert PWlinearArray.from_segments(segments)==expected
+
+  #unbounded segments:
+  a=PWlinearArray.from_segments([(None,Edge(t),2),(Edge(t,Topo.RIGHT),None,math.inf)])
+  assert a==PWlinear(2,Edge(t,Topo.RIGHT),math.inf)
+  assert PWlinearArray.from_segments([])==PWlinear(0)
+
+def test_pw_sum():
+  t=datetime(2022,6,22)
+  masks=[PWlinear(math.inf,Edge(t,Topo.RIGHT),0,Edge(t+timedelta(hours=3),Topo.LEFT),math.inf),
+         PWlinear(0,Edge(t+timedelta(hours=1),Topo.LEFT),math.inf,Edge(t+timedelta(hours=2),Topo.RIGHT),0),
+         PWlinear(0)]
+  expected=PWlinear(0)
+  for m in masks:
+    expected.plus(m)
+  assert pw_sum(masks)==expected
+  assert len(pw_segments(masks[0]))==2
+  assert pw_sum([masks[0],masks[1],PWlinear(math.inf)])==PWlinear(math.inf)
+
+def test_ifneeded_segments():
+  basetime=datetime(2022,6,22)
+  length=timedelta(minutes=30)
+  for start,end in [(basetime+timedelta(hours=1),basetime+timedelta(hours=3)),
+                    (basetime+timedelta(hours=1),basetime+timedelta(hours=1,minutes=15))]:
+    past_fstart=mk_path((start-length,0),(start,500),basetime=basetime)
+    past_fend=mk_path((end-length,0),(end,-500),basetime=basetime)
+    expected=past_fstart.plus(past_fend)
+    imask=PWlinearArray.from_segments(ifneeded_segments(start,end,length,500,basetime)).to_pwlinear()
+    assert imask.data[1::2]==expected.data[1::2]
+    for v,w in zip(imask.data[::2],expected.data[::2]):
+      assert v==pytest.approx(w)
+    #outside the penalty the mask is exactly 0:
+    assert imask.data[0]==(0,0) and imask.data[-1]==(0,0)
+
+def test_grain_bins():
+  m = PWlinear(math.inf, Edge(2,Topo.RIGHT), 0, Edge(4,Topo.RIGHT), 5, Edge(6.5,Topo.LEFT), math.inf, Edge(8,Topo.LEFT), (1,2), Edge(8.5,Topo.LEFT), math.inf)
+  assert grain_bins(m) == [(2,3,(0,0)), (4,6,(0,5))]
+  with pytest.raises(ValueError):
+    grain_bins(PWlinear(math.inf, Edge(2,Topo.RIGHT), 0))
+
+def test_pw_sum_matches_plus_fold():
+  #ramps cancel in the sweep, so it must not leave float residue domains that the plus fold doesn't have:
+  random.seed(2)
+  basetime=datetime(2022,6,22)
+  length=timedelta(minutes=30)
+  #both round, in different orders, so either can split a line on its last bit. merge those splits,
+  #with no absolute tolerance so that residue next to an exact 0 is still a different domain:
+  merge_close=lambda pw: PWfn.simplify(pw,lambda a,b: eq_line(a,b) or a==pytest.approx(b,rel=1e-12,abs=0))
+  def assert_matches(summed,expected):
+    merge_close(summed)
+    merge_close(expected)
+    assert summed.data[1::2]==expected.data[1::2]
+    for v,w in zip(summed.data[::2],expected.data[::2]):
+      assert v==pytest.approx(w,abs=1e-9)
+  for _ in range(300):
+    masks=[]
+    for _ in range(random.randint(1,4)):
+      segments=[]
+      expected=PWlinear(0)
+      for _ in range(random.randint(1,8)):
+        start=basetime+timedelta(minutes=15*random.randint(0,60))
+        end=start+timedelta(minutes=15*random.randint(1,12))
+        cost=random.choice([0,0.5,1,3])*500
+        segments+=ifneeded_segments(start,end,length,cost,basetime)
+        expected.plus(mk_path((start-length,0),(start,cost),basetime=basetime))
+        expected.plus(mk_path((end-length,0),(end,-cost),basetime=basetime))
+      imask=PWlinearArray.from_segments(segments).to_pwlinear()
+      assert_matches(deepcopy(imask),expected)
+      masks.append(imask)
+    start=basetime+timedelta(minutes=15*random.randint(0,60))
+    masks.append(PWlinear(0,Edge(start-length,Topo.LEFT),math.inf,Edge(start+timedelta(minutes=15*random.randint(1,4)),Topo.RIGHT),0))
+    expected=PWlinear(0)
+    for m in masks:
+      expected.plus(m)
+    assert_matches(pw_sum(masks),expected)
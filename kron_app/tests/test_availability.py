@@ -1,7 +1,8 @@
 import pytest
 from datetime import datetime, timedelta
-from kron_app.models import AvailabilityEvent as AEvent, Change
+from kron_app.models import AvailabilityEvent as AEvent, AvailabilityInterval as AInterval, Change
 from kron_app.availability import get_overlapping, clear_window, clear_window_unbounded, get_bitmap, set_bitmap, get_events_bitmap, get_meetings_bitmap, record_changes, is_naive_dt, add_core_availability
+from kron_app.availability import materialize, refresh_materialized, get_overlapping_fixed_events
 from kron_app.availability import EventBitmap, UNAVAILABLE
 from kron_app.tests.helpers import mkuser, mkevent, mkfixedevent, mkavail, schedule, days, hrs, mins
 from kron_app import db
@@ -513,3 +514,44 @@ def test_add_core_availability():
     assert all(e.recur_end_at is None for e in es)
     assert all(e.tzname == u.tzname for e in es)
     assert all(e.cost == 0 for e in es)
+
+def fixed_events_key(f):
+    return (f.calendar.user_id, f.start_at, f.end_at, f.costs['everyone'])
+
+def test_materialize(utcnow):
+    u1 = mkuser()
+    u2 = mkuser()
+    mkavail(u1, utcnow-days(300), hrs(8), tzname='Europe/London', recur='forever')
+    mkavail(u1, utcnow+days(2), hrs(1), cost=1)
+    mkavail(u2, utcnow+hrs(3), hrs(2), recur=4)
+    materialize(u1.id, utcnow)
+    materialize(u2.id, utcnow)
+    db.session.commit()
+    assert AInterval.query.count() > 0
+    inside = get_overlapping_fixed_events(utcnow, utcnow+days(7), [u1.id, u2.id])
+    assert len(inside) == 3
+    # Inside and across the edge of the horizon.
+    for start, end in [(utcnow, utcnow+days(7)), (utcnow-days(3), utcnow+days(40)), (utcnow+days(85), utcnow+days(100))]:
+        expected = [o.to_fixed_event() for o in get_overlapping(start, end, [u1.id, u2.id])]
+        actual = get_overlapping_fixed_events(start, end, [u1.id, u2.id])
+        assert sorted(actual, key=fixed_events_key) == sorted(expected, key=fixed_events_key)
+    # Inside the horizon, availability is read from the materialized intervals.
+    AEvent.query.delete()
+    assert get_overlapping_fixed_events(utcnow, utcnow+days(7), [u1.id, u2.id]) == inside
+    assert get_overlapping_fixed_events(utcnow+days(85), utcnow+days(100), [u1.id, u2.id]) == []
+
+def test_refresh_materialized(utcnow):
+    u1 = mkuser()
+    u2 = mkuser()
+    mkavail(u1, utcnow, hrs(8), recur='forever')
+    assert refresh_materialized(utcnow) == 1
+    assert refresh_materialized(utcnow+hrs(12)) == 0
+    assert refresh_materialized(utcnow+days(2)) == 1
+    assert len(get_overlapping_fixed_events(utcnow+days(85), utcnow+days(92), [u1.id])) == 1
+
+def test_api_set_availability_materializes(utcnow):
+    from kron_app.availability import api_set_availability, horizon
+    u = mkuser()
+    d = utcnow.date()
+    api_set_availability(u, d, [F]*4*24 + [B]*4*24*6, recur=True)
+    assert AInterval.query.filter_by(user_id=u.id).count() >= horizon // days(7)
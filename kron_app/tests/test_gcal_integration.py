@@ -1,7 +1,11 @@
 import pytest
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from kron_app import db
 from kron_app.tests.helpers import mkuser, mkevent, schedule, unschedule
+from kron_app.gcal_api import OAuthSession
 from kron_app.gcal_integration import is_free, get_start_end, get_kron_duty_and_costs, gcal_update_api_quotas, gcal_event_queue_for
 
 def test_creator_no_attendees():
@@ -410,3 +414,42 @@ def test_gcal_event_queue_for(testdb):
     e3 = mkevent(u, attendees=[u.id])
     unschedule(e3)
     assert gcal_event_queue_for(u.id) == [e2,e1]
+
+Response = namedtuple('Response', ['status_code', 'text'])
+
+class FakeOAuth2Session:
+    # Records the thread requests are made on, and refreshes the token
+    # on each request.
+    def __init__(self, hook, status_code=200):
+        self.token_updater = hook
+        self.status_code = status_code
+        self.threads = []
+    def get(self, url):
+        self.threads.append(threading.current_thread())
+        self.token_updater(dict(access_token='new'))
+        return Response(self.status_code, '')
+
+def test_oauth_session_prefetch(testdb):
+    u = mkuser()
+    u.gcal_api_error_count = 2
+    db.session.commit()
+    hook_threads = []
+    fake = FakeOAuth2Session(lambda token: hook_threads.append(threading.current_thread()))
+    google = OAuthSession(fake, u)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        wait = google.prefetch(executor, 'get', 'url')
+        resp = wait()
+    assert resp.status_code == 200
+    assert fake.threads[0] != threading.current_thread()
+    # The token hook and error handling happen in the waiting thread.
+    assert hook_threads == [threading.current_thread()]
+    assert u.gcal_api_error_count == 0
+    fake.status_code = 401
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert google.prefetch(executor, 'get', 'url')() is None
+    assert u.gcal_api_error_count == 1
+    # Without an executor the request is made immediately.
+    fake.status_code = 200
+    wait = google.prefetch(None, 'get', 'url')
+    assert fake.threads[-1] == threading.current_thread()
+    assert wait().status_code == 200
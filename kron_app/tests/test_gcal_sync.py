@@ -1,14 +1,18 @@
+import re
+import json
 import pytest
+from email.parser import BytesParser
 from uuid import uuid4
 from datetime import datetime, timedelta
 from collections import namedtuple
 from functools import partial
-from kron_app import db
+from kron_app import app, db
 from kron_app.tests.helpers import mkuser, mkevent, schedule, unschedule, mkcal, mkfixedevent as mkfixed, mins
 from kron_app.utils import uid
 from kron_app.models import Event, FixedEvent, Change, Email, GcalResponseState, Attendance
-from kron_app.gcal_api import GCAL_EVENT_UID_PREFIX
-from kron_app.gcal_integration import gcal_sync_full, gcal_sync_incremental, IncSyncResult, gcal_sync_event_2
+import kron_app.tasks
+from kron_app.gcal_api import GCAL_EVENT_UID_PREFIX, GCAL_BATCH_URI, OAuthSession
+from kron_app.gcal_integration import gcal_sync_full, gcal_sync_incremental, IncSyncResult, gcal_sync_event_2, gcal_request_sync_2, gcal_sync_user_2
 
 def mkitem(**kwargs):
     # Map `uid` arg to `id`.
@@ -285,6 +289,28 @@ def test_full_sync_delete_entry(testdb):
     assert fixed(c).count() == 0
     assert change().count() == 1
 
+def test_full_sync_records_previous_positions(testdb):
+    u = mkuser()
+    c = u.primary_calendar
+    start_at = datetime(2022, 4, 1, 9)
+    f = mkfixed(c, start_at) # Modified
+    g = mkfixed(c, start_at + timedelta(days=1)) # Deleted
+    h = mkfixed(c, start_at + timedelta(days=2)) # Unchanged
+    f_id = f.id
+    i = mkbusy(uid=f.uid)
+    j = mkbusy(uid=h.uid, start={'dateTime': '2022-04-03T09:00:00Z'}, end={'dateTime': '2022-04-03T10:00:00Z'})
+    k = mkbusy(uid=h.uid, summary='@kron') # Duplicate, skipped
+    gcal_sync_full(c, sim_api([i], [j, k]))
+    db.session.rollback()
+    fs = dict((f.uid, f) for f in fixed(c).all())
+    assert set(fs.keys()) == {i['id'], j['id']}
+    assert fs[i['id']].dirty and fs[i['id']].start_at == datetime(2022, 4, 7, 8, 15)
+    assert not fs[j['id']].dirty and not fs[j['id']].kron_duty
+    changes = change().order_by('start_at').all()
+    assert [(ch.start_at, ch.end_at, ch.users) for ch in changes] == [(start_at, start_at + timedelta(hours=1), [u.id]),
+                                                                      (start_at + timedelta(days=1), start_at + timedelta(days=1, hours=1), [u.id])]
+    assert [ch.fixed_event_id for ch in changes] == [f_id, None]
+
 @pytest.mark.parametrize('gcal_sync', [gcal_sync_incremental, gcal_sync_full])
 def test_sync_motion_events(testdb, gcal_sync):
     u = mkuser()
@@ -390,6 +416,19 @@ def test_sync_adds_contacts_all_pairs(testdb, gcal_sync):
     assert set(e.contacts) == {n,p}
     assert set(o.contacts) == set()
 
+@pytest.mark.parametrize('gcal_sync', [gcal_sync_incremental, gcal_sync_full])
+def test_sync_adds_contacts_across_pages(testdb, gcal_sync):
+    n = mkuser('noah@kronistic.com')
+    p = mkuser('paul@kronistic.com')
+    e = mkuser('emily@kronistic.com')
+    i = mkitem(attendees = [{'email': p.email}])
+    j = mkitem(attendees = [{'email': p.email}, {'email': e.email}]) # n,p seen again on a later page
+    gcal_sync(n.primary_calendar, sim_api([i], [j]))
+    db.session.rollback()
+    assert set(n.contacts) == {p,e}
+    assert set(p.contacts) == {n,e}
+    assert set(e.contacts) == {n,p}
+
 @pytest.mark.parametrize('gcal_sync', [gcal_sync_incremental, gcal_sync_full])
 def test_sync_adds_known_alias_as_contact(testdb, gcal_sync):
     p = mkuser('paul@kronistic.com')
@@ -597,3 +636,285 @@ def test_gcal_push_sync_2__remove_entry(testdb):
     assert a.gcal_hash is None
     assert a.gcal_push_id is None
     assert gcal_counts(a) == (1,0,1)
+
+# =BATCHED=PUSH=SYNC============================================================
+
+class BatchResponse:
+    def __init__(self, status_code, text, headers={}):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+        self.ok = status_code < 400
+
+class GcalBatchStandIn:
+    """A local stand-in for the gcal batch endpoint, to be wrapped in an
+    `OAuthSession`. Entries are kept in memory, by uid.
+
+    """
+    def __init__(self, fail=(), decline=()):
+        self.entries = dict()
+        self.deleted = set()
+        self.fail = set(fail) # uids whose calls fail
+        self.decline = set(decline) # uids whose next update comes back not accepted
+        self.down = False # batch requests themselves fail
+        self.on_post = None # called as each batch request is made
+        self.batches = [] # the (method, uid) of the calls in each batch request
+    def post(self, uri, data, headers):
+        assert uri == GCAL_BATCH_URI
+        if self.on_post is not None:
+            self.on_post()
+        if self.down:
+            return BatchResponse(503, 'stand-in is down')
+        msg = BytesParser().parsebytes(f'Content-Type: {headers["Content-Type"]}\r\n\r\n'.encode() + data)
+        assert msg.is_multipart()
+        boundary = 'response_boundary'
+        parts = []
+        calls = []
+        for part in msg.get_payload():
+            assert part.get_content_type() == 'application/http'
+            item = re.fullmatch(r'<item(\d+)>', part['Content-ID']).group(1)
+            request_line, _, body = re.split(r'(\r?\n\r?\n)', part.get_payload(), maxsplit=1)
+            method, path, _ = request_line.split('\r\n')[0].split(' ')
+            uid, status_code, entry = self.call(method, path, json.loads(body) if body.strip() else None)
+            calls.append((method, uid))
+            body = json.dumps(entry) if entry is not None else ''
+            parts.append(f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-item{item}>\r\n\r\n'
+                         f'HTTP/1.1 {status_code} X\r\nContent-Type: application/json\r\n\r\n{body}\r\n')
+        self.batches.append(calls)
+        # Responses needn't be in the order of the calls.
+        text = ''.join(parts[::-1]) + f'--{boundary}--\r\n'
+        return BatchResponse(200, text, {'Content-Type': f'multipart/mixed; boundary={boundary}'})
+    def call(self, method, path, entry):
+        assert path.startswith('/calendar/v3/calendars/')
+        uid = entry['id'] if method == 'POST' else path.split('/')[-1]
+        if uid in self.fail:
+            return uid, 500, dict(error='stand-in failure')
+        if method == 'POST':
+            self.entries[uid] = entry
+            return uid, 200, entry
+        elif method == 'PUT':
+            entry = dict(entry, id=uid)
+            if uid in self.decline:
+                self.decline.remove(uid)
+                entry['attendees'] = [dict(a, responseStatus='needsAction') for a in entry['attendees']]
+            self.entries[uid] = entry
+            return uid, 200, entry
+        else:
+            assert method == 'DELETE'
+            if uid in self.deleted:
+                return uid, 410, None
+            if uid not in self.entries:
+                return uid, 404, None
+            del self.entries[uid]
+            self.deleted.add(uid)
+            return uid, 204, None
+
+def sync_user_2(user, standin):
+    failed = gcal_sync_user_2(user.id, OAuthSession(standin, user))
+    db.session.rollback()
+    return failed
+
+def mkscheduled(n, user):
+    es = [mkevent(user, [user.id]) for _ in range(n)]
+    for i, e in enumerate(es):
+        schedule(e, e.window_start + mins(15*i), [user.id])
+    return es
+
+def test_gcal_batch_sync_2__new_entries(testdb):
+    u = mkuser('u')
+    quota = u.gcal_quota
+    es = mkscheduled(3, u)
+    for e in es:
+        assert gcal_request_sync_2(e) == [u.id]
+    assert all(the_attendance(e).gcal_sync_pending for e in es)
+    standin = GcalBatchStandIn()
+    sync_user_2(u, standin)
+    assert [[method for method, _ in b] for b in standin.batches] == [['POST']*3]
+    for e in es:
+        a = the_attendance(e)
+        assert a.gcal_uid in standin.entries
+        assert a.gcal_hash and a.gcal_push_id == u.gcal_push_id
+        assert gcal_counts(a) == (1,0,0)
+        assert not a.gcal_sync_pending
+    assert u.gcal_quota == quota - 3
+    # Nothing pending, nothing to do.
+    sync_user_2(u, standin)
+    assert len(standin.batches) == 1
+
+def test_gcal_batch_sync_2__batch_size(testdb, monkeypatch):
+    monkeypatch.setitem(app.config, 'GCAL_BATCH_SIZE', 2)
+    u = mkuser('u')
+    es = mkscheduled(3, u)
+    for e in es:
+        gcal_request_sync_2(e)
+    standin = GcalBatchStandIn()
+    sync_user_2(u, standin)
+    assert [len(b) for b in standin.batches] == [2, 1]
+    assert all(gcal_counts(the_attendance(e)) == (1,0,0) for e in es)
+
+def test_gcal_batch_sync_2__insufficient_quota(testdb):
+    u = mkuser('u')
+    u.gcal_quota = 2
+    db.session.commit()
+    es = mkscheduled(3, u)
+    for e in es:
+        gcal_request_sync_2(e)
+    standin = GcalBatchStandIn()
+    sync_user_2(u, standin)
+    # The earliest events in the queue are created.
+    assert [gcal_counts(the_attendance(e)) for e in es] == [(1,0,0), (1,0,0), (0,0,0)]
+    assert u.gcal_quota == 0
+
+def test_gcal_batch_sync_2__update_entries(testdb):
+    u = mkuser('u')
+    e1, e2, e3 = mkscheduled(3, u)
+    for e in [e1, e2, e3]:
+        gcal_request_sync_2(e)
+    standin = GcalBatchStandIn()
+    sync_user_2(u, standin)
+    hashes = [the_attendance(e).gcal_hash for e in [e1, e2, e3]]
+    e1.title += '!'
+    e2.title += '!'
+    db.session.commit()
+    # e2's entry comes back no longer accepted.
+    standin.decline.add(the_attendance(e2).gcal_uid)
+    for e in [e1, e2, e3]:
+        gcal_request_sync_2(e)
+    sync_user_2(u, standin)
+    # e3 is unchanged, so is skipped. e2 is updated again to accept.
+    assert [[(method, uid) for method, uid in b] for b in standin.batches[1:]] == \
+        [[('PUT', the_attendance(e1).gcal_uid), ('PUT', the_attendance(e2).gcal_uid)],
+         [('PUT', the_attendance(e2).gcal_uid)]]
+    assert [gcal_counts(the_attendance(e)) for e in [e1, e2, e3]] == [(1,1,0), (1,2,0), (1,0,0)]
+    assert [the_attendance(e).gcal_hash != h for e, h in zip([e1, e2, e3], hashes)] == [True, True, False]
+
+def test_gcal_batch_sync_2__per_item_failures(testdb):
+    u = mkuser('u')
+    e1, e2 = mkscheduled(2, u)
+    for e in [e1, e2]:
+        gcal_request_sync_2(e)
+    standin = GcalBatchStandIn()
+    sync_user_2(u, standin)
+    a1, a2 = the_attendance(e1), the_attendance(e2)
+    uid1, uid2 = a1.gcal_uid, a2.gcal_uid
+    # Meetings are removed from the calendar, and one delete fails.
+    unschedule(e1)
+    unschedule(e2)
+    standin.fail.add(uid2)
+    for e in [e1, e2]:
+        gcal_request_sync_2(e)
+    assert sync_user_2(u, standin) == 1
+    assert standin.batches[-1] == [('DELETE', uid1), ('DELETE', uid2)]
+    assert (a1.gcal_uid, a1.gcal_hash, a1.gcal_push_id) == (None, None, None)
+    assert gcal_counts(a1) == (1,0,1)
+    assert not a1.gcal_sync_pending
+    # The failed delete is left pending, and retried by the next sync.
+    assert a2.gcal_uid == uid2 and a2.gcal_sync_pending
+    assert gcal_counts(a2) == (1,0,0)
+    standin.fail.clear()
+    assert sync_user_2(u, standin) == 0
+    assert standin.batches[-1] == [('DELETE', uid2)]
+    assert a2.gcal_uid is None and not a2.gcal_sync_pending
+    assert uid1 not in standin.entries and uid2 not in standin.entries
+
+def test_gcal_batch_sync_2__yank(testdb):
+    u = mkuser('u')
+    e1, = mkscheduled(1, u)
+    gcal_request_sync_2(e1)
+    standin = GcalBatchStandIn()
+    sync_user_2(u, standin)
+    gcal_request_sync_2(e1, yank=True)
+    sync_user_2(u, standin)
+    a = the_attendance(e1)
+    assert standin.entries == {}
+    assert a.gcal_uid is None and not a.gcal_sync_yank
+    assert gcal_counts(a) == (1,0,1)
+
+def test_gcal_batch_sync_2__request_failure(testdb, monkeypatch):
+    monkeypatch.setitem(app.config, 'GCAL_BATCH_SIZE', 2)
+    u = mkuser('u')
+    es = mkscheduled(3, u)
+    for e in es:
+        gcal_request_sync_2(e)
+    standin = GcalBatchStandIn()
+    standin.down = True
+    with pytest.raises(Exception):
+        sync_user_2(u, standin)
+    # Nothing was synced, so everything is pending again.
+    assert all(the_attendance(e).gcal_sync_pending and gcal_counts(the_attendance(e)) == (0,0,0) for e in es)
+    standin.down = False
+    assert sync_user_2(u, standin) == 0
+    assert all(not the_attendance(e).gcal_sync_pending and gcal_counts(the_attendance(e)) == (1,0,0) for e in es)
+
+@pytest.mark.parametrize('down', [False, True])
+def test_gcal_batch_sync_2__failure_keeps_newer_request(testdb, down):
+    u = mkuser('u')
+    e1, = mkscheduled(1, u)
+    gcal_request_sync_2(e1)
+    standin = GcalBatchStandIn()
+    sync_user_2(u, standin)
+    a = the_attendance(e1)
+    e1.title += '!'
+    db.session.commit()
+    gcal_request_sync_2(e1)
+    # The update fails, and the meeting is yanked while it's in flight.
+    standin.fail.add(a.gcal_uid)
+    standin.down = down
+    standin.on_post = lambda: gcal_request_sync_2(e1, yank=True)
+    if down:
+        with pytest.raises(Exception):
+            sync_user_2(u, standin)
+    else:
+        assert sync_user_2(u, standin) == 1
+    assert a.gcal_sync_pending and a.gcal_sync_yank
+    standin.fail.clear()
+    standin.down = False
+    standin.on_post = None
+    sync_user_2(u, standin)
+    assert standin.entries == {}
+    assert a.gcal_uid is None and not a.gcal_sync_pending
+
+def test_gcal_batch_sync_2__calls_made_before_a_failure_are_not_repeated(testdb, monkeypatch):
+    monkeypatch.setitem(app.config, 'GCAL_BATCH_SIZE', 1)
+    u = mkuser('u')
+    e1, e2 = mkscheduled(2, u)
+    for e in [e1, e2]:
+        gcal_request_sync_2(e)
+    standin = GcalBatchStandIn()
+    # The first entry is created, but its response can't be processed.
+    call = standin.call
+    def call_without_id(method, path, entry):
+        uid, status_code, entry = call(method, path, entry)
+        return uid, status_code, {k: v for k, v in entry.items() if k != 'id'}
+    standin.call = call_without_id
+    with pytest.raises(KeyError):
+        sync_user_2(u, standin)
+    assert len(standin.entries) == 1
+    assert not the_attendance(e1).gcal_sync_pending
+    assert the_attendance(e2).gcal_sync_pending
+    standin.call = call
+    sync_user_2(u, standin)
+    assert [len(b) for b in standin.batches] == [1, 1]
+    assert len(standin.entries) == 2
+
+def test_task_gcal_sync_user_2_retries(testdb, monkeypatch):
+    monkeypatch.setitem(app.config, 'GCAL_SYNC_RETRIES', 2)
+    queued = []
+    monkeypatch.setattr(kron_app.tasks.task_gcal_sync_user_2, 'apply_async', lambda args, countdown: queued.append((args, countdown)))
+    delay = app.config['GCAL_SYNC_BATCH_DELAY'].total_seconds()
+    monkeypatch.setattr(kron_app.tasks, 'gcal_sync_user_2', lambda user_id: 0)
+    kron_app.tasks.task_gcal_sync_user_2(1)
+    assert queued == []
+    # Failed calls are retried, backing off, until the retries run out.
+    monkeypatch.setattr(kron_app.tasks, 'gcal_sync_user_2', lambda user_id: 1)
+    kron_app.tasks.task_gcal_sync_user_2(1)
+    kron_app.tasks.task_gcal_sync_user_2(1, 1)
+    kron_app.tasks.task_gcal_sync_user_2(1, 2)
+    assert queued == [((1, 1), 2*delay), ((1, 2), 4*delay)]
+    # As is a sync that raises.
+    def fail(user_id):
+        raise Exception('api error')
+    monkeypatch.setattr(kron_app.tasks, 'gcal_sync_user_2', fail)
+    with pytest.raises(Exception):
+        kron_app.tasks.task_gcal_sync_user_2(1)
+    assert queued[-1] == ((1, 1), 2*delay)
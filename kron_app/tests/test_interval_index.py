@@ -0,0 +1,62 @@
+import random
+import pytest
+from datetime import datetime, timedelta
+from kron_app.interval_index import IntervalIndex
+from kron_app.utils import dotdict
+
+basetime = datetime(2023, 1, 2, 9)
+
+def mkitems(n, rng):
+    items = []
+    for i in range(n):
+        start = basetime + timedelta(minutes=15*rng.randrange(200))
+        items.append(dotdict(id=i, start_at=start, end_at=start + timedelta(minutes=15*rng.randrange(1, 40)),
+                             users=rng.sample(range(8), rng.randrange(1, 3))))
+    return items
+
+def brute_force(items, start, end, user_ids):
+    return [x for x in items if x.start_at < end and x.end_at > start and set(x.users) & set(user_ids)]
+
+def test_overlapping():
+    rng = random.Random(0)
+    items = mkitems(300, rng)
+    index = IntervalIndex(items)
+    assert len(index) == 300
+    for _ in range(200):
+        start = basetime + timedelta(minutes=15*rng.randrange(-20, 220))
+        end = start + timedelta(minutes=15*rng.randrange(1, 20))
+        user_ids = rng.sample(range(10), 3)
+        assert index.overlapping(start, end, user_ids) == brute_force(items, start, end, user_ids)
+
+def test_add_remove():
+    rng = random.Random(1)
+    items = mkitems(100, rng)
+    index = IntervalIndex(items[:50])
+    for x in items[50:]:
+        index.add(x)
+    #removal is by id, so copies do as well as the items added:
+    for x in items[::3]:
+        index.remove(dotdict(**x))
+    kept = [x for i,x in enumerate(items) if i % 3]
+    for _ in range(100):
+        start = basetime + timedelta(minutes=15*rng.randrange(200))
+        end = start + timedelta(hours=3)
+        assert index.overlapping(start, end, range(8)) == brute_force(kept, start, end, range(8))
+
+def test_touching_intervals():
+    items = [dotdict(start_at=basetime, end_at=basetime + timedelta(hours=1), users=['1'])]
+    index = IntervalIndex(items)
+    assert index.overlapping(basetime + timedelta(hours=1), basetime + timedelta(hours=2), ['1']) == []
+    assert index.overlapping(basetime - timedelta(hours=1), basetime, [1]) == []
+    assert index.overlapping(basetime - timedelta(hours=1), basetime + timedelta(minutes=1), [1]) == items
+
+def test_keys():
+    items = [dotdict(id=1, start_at=basetime, end_at=basetime + timedelta(hours=1), users=[1]),
+             dotdict(start_at=basetime, end_at=basetime + timedelta(hours=1), users=[1])]
+    index = IntervalIndex(items)
+    with pytest.raises(ValueError):
+        index.add(dotdict(**items[0]))
+    with pytest.raises(KeyError):
+        index.remove(items[1])
+    index.remove(items[0])
+    assert index.overlapping(basetime, basetime + timedelta(hours=1), [1]) == [items[1]]
@@ -1,5 +1,6 @@
 import pytest
-from kron_app.kron_directives import parse_kron_directive
+from hypothesis import given, settings, strategies as st
+from kron_app.kron_directives import parse_kron_directive, parse_kron_directive_grammar, _parse_kron_directive, MAX_CACHED_DIRECTIVE
 
 @pytest.mark.parametrize('item, expected',[
         ('@kron',(True,{'everyone':0})),
@@ -54,3 +55,28 @@ from kron_app.kron_directives import parse_kron_directive
 ])
 def test_parse_kronduty(item,expected):
   assert parse_kron_directive(item) == expected
+
+WORDS = ['@kron', '@Kronistic', '@KRON', 'kron', 'if', 'IF', 'really', 'Really', 'so', 'far', 'needed', 'Vital', 'must-have',
+         'available', 'free', 'usable', 'for', 'to', 'everyone', 'Bob', '"jane"', 'and', ',', '.', 'meeting']
+SPACES = ['', ' ', '  ', '\t']
+
+@settings(max_examples=1000)
+@given(st.lists(st.tuples(st.sampled_from(SPACES), st.sampled_from(WORDS)), max_size=8), st.sampled_from(SPACES))
+def test_parse_kron_directive_matches_grammar(words, trailing):
+  s = ''.join(space+word for space,word in words)+trailing
+  assert parse_kron_directive(s) == parse_kron_directive_grammar(s)
+
+def test_parse_kron_directive_cached():
+  kron_duty, costs = parse_kron_directive('@kron if really needed')
+  costs['everyone'] = 0
+  assert parse_kron_directive('@kron if really needed') == (True, {'everyone':2})
+
+def test_parse_kron_directive_cache_keys():
+  _parse_kron_directive.cache_clear()
+  assert parse_kron_directive('Standup') == (False, None)
+  assert parse_kron_directive('@kron if needed') == parse_kron_directive(' \t@kron if needed') == (True, {'everyone':1})
+  assert _parse_kron_directive.cache_info().currsize == 1
+  #long text is parsed, but not cached:
+  description = '@kron ' + 'x'*MAX_CACHED_DIRECTIVE
+  assert parse_kron_directive(description) == parse_kron_directive_grammar(description) == (True, {})
+  assert _parse_kron_directive.cache_info().currsize == 1
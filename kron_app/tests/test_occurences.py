@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+from itertools import islice
+from hypothesis import given, settings, strategies as st
+from kron_app.models import AvailabilityEvent as AEvent
+from kron_app.availability import occurences, first_occurence, overlapping_occurences, overlaps
+
+TZNAMES = ['UTC', 'Europe/London', 'America/New_York', 'Australia/Lord_Howe', 'Pacific/Kiritimati', 'Pacific/Pago_Pago', 'Asia/Kolkata']
+
+basetime = datetime(2021, 1, 1)
+grains = lambda lo, hi: st.integers(lo, hi).map(lambda n: timedelta(minutes=15*n))
+
+@st.composite
+def aevents(draw):
+    start_at = basetime + draw(grains(0, 2*365*96))
+    end_at = start_at + draw(grains(1, 2*96))
+    weeks = draw(st.none() | st.integers(0, 150))
+    return AEvent(user_id=1, tzname=draw(st.sampled_from(TZNAMES)), cost=0, start_at=start_at, end_at=end_at,
+                  recur_end_at=None if weeks is None else end_at + weeks*timedelta(days=7))
+
+def stepping(aevent, utc_window_start, utc_window_end):
+    # Step through every occurrence from the first.
+    out = []
+    for i in occurences(aevent):
+        if i.utc_start_at > utc_window_end:
+            break
+        if overlaps(i, utc_window_start, utc_window_end):
+            out.append(i)
+    return out
+
+def key(occurences):
+    return [(i.start_at, i.end_at) for i in occurences]
+
+@settings(max_examples=500)
+@given(aevents(), grains(-30*96, 4*365*96), grains(0, 20*96))
+def test_overlapping_occurences(aevent, offset, length):
+    utc_window_start = basetime + offset
+    utc_window_end = utc_window_start + length
+    assert key(overlapping_occurences(aevent, utc_window_start, utc_window_end)) == key(stepping(aevent, utc_window_start, utc_window_end))
+
+@settings(max_examples=500)
+@given(aevents(), grains(-30*96, 4*365*96))
+def test_first_occurence(aevent, offset):
+    utc_window_start = basetime + offset
+    first = first_occurence(aevent, utc_window_start)
+    assert all(i.utc_end_at < utc_window_start for i in islice(occurences(aevent), first))
@@ -1,9 +1,18 @@
 import pytest
 from datetime import datetime, timedelta
-from kron_app import db
+import json
+import math
+from kron_app import db, app
 from kron_app.tests.helpers import mins, hrs, days, mkuser, mkevent_for_solver_tests as mkevent, isinit, isunscheduled, isscheduled, schedule, unschedule, mkclean, mkdirty, mkfinal, mkfixedevent, mkspace, mkconflict, setpriority, add_attendee, delete_attendee, mkavail
-from kron_app.models import Series, User, Event, EventState
-from kron_app.run_solver import run_solver, build_problem
+from kron_app.models import Series, User, Event, EventState, SolverLog
+from sqlalchemy import text
+from kron_app.run_solver import run_solver, build_problem, solver_with_logging, write_solver_log, solve_failed, user_locks, USER_LOCK_CLASS, SolverError
+import kron_app.solver.solver as solver_module
+from kron_app.solver.utils import FloatMeeting
+from kron_app.mask_utils import PWlinear, Edge, Topo
+from kron_app.utils import DotDict
+import kron_app.tasks
+import kron_app.solver_log as solver_log
 from kron_app.events import build_weekly_series
 
 # This implicitly does test db setup/teardown for all tests in this
@@ -532,6 +541,135 @@ def test_final(basetime,utcnow):
     problemset, *_ =  build_problem(utcnow)
     assert problemset == set()
 
+def test_incremental(basetime,utcnow):
+    """a clean scheduled event pulled in by expansion is held at its draft time while a new event is fit around it"""
+    u = mkuser('p')
+    mkavail(u, start_at=utcnow, length=hrs(12))
+    e1 = mkevent(u, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u.id])
+    schedule(e1, basetime+hrs(1), [u.id])
+    mkclean(e1)
+    e2 = mkevent(u, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u.id])
+    run_solver(config={'timeout': 60000, 'incremental': True})
+    assert e1.draft_start == basetime+hrs(1)
+    assert isscheduled(e2)
+    assert SolverLog.query.one().data['incremental'] == {'pinned': 1, 'widened': False}
+    assert SolverLog.query.one().data['warm_start']['feasible'] == 1
+
+def test_solver_log_sampling(basetime,utcnow,monkeypatch):
+    """successful runs are logged without their problem when sampled out, failed runs always with it"""
+    monkeypatch.setitem(app.config, 'SOLVER_LOG_SAMPLE', 0)
+    # Masks are only encoded for runs that are logged with their problem.
+    encoded = []
+    encode_masks = solver_log.encode_masks
+    monkeypatch.setattr(solver_log, 'encode_masks', lambda masks: encoded.append(masks) or encode_masks(masks))
+    u = mkuser('p')
+    mkavail(u, start_at=utcnow, length=hrs(12))
+    e = mkevent(u, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u.id])
+    run_solver()
+    assert isscheduled(e)
+    assert encoded == []
+    data = SolverLog.query.one().data
+    assert data['problem_size'] == 1 and data['result_code'].startswith('sat')
+    assert 'floaties' not in data and 'masks' not in data
+    assert json.loads(SolverLog.query.one().summaryjson)['result_code'] == data['result_code']
+    # Two required meetings for one slot.
+    slot = lambda: PWlinear(math.inf, Edge(basetime, Topo.RIGHT), 0, Edge(basetime, Topo.LEFT), math.inf)
+    floaties = [FloatMeeting(id=str(i), attendees=[str(u.id)], window_start=basetime, window_end=basetime+hrs(1),
+                             length=hrs(1), draft_start=basetime) for i in range(2)]
+    masks = {f.id: DotDict({'masks': {'hard': slot(), 'ifneeded': PWlinear(0), 'sooner': PWlinear(0)}, 'optatt_masks': {}})
+             for f in floaties}
+    result = solver_with_logging(floaties=floaties, now=utcnow, basetime=basetime, masks=masks, caller='test',
+                                 config={'timeout': 60000}, problem_prov={})
+    assert not result[0]
+    assert len(encoded) == 1
+    data = SolverLog.query.order_by(SolverLog.id.desc()).first().data
+    assert [f['id'] for f in data['floaties']] == ['0', '1']
+    assert data['masks']['0'].masks.hard == slot()
+    assert data['overlapping'].keys() == {'0', '1'}
+
+def test_solve_failed():
+    """success is read from each component's result, whatever the backend's result codes"""
+    ok = (True, [], [], 'x')
+    assert not solve_failed(ok, [dict(result=True, result_code='sat_1-lra_sat_1')])
+    assert not solve_failed(ok, [dict(result=True, result_code='cpsat_optimal'), dict(result=True, result_code='cpsat_feasible')])
+    assert solve_failed(ok, [dict(result=True, result_code='cpsat_optimal'), dict(result=False, result_code='cpsat_unsat')])
+    assert solve_failed(ok, [dict(result=False, result_code='timeout_timeout')])
+    assert solve_failed((False, None, [], 'unsat_1'), [])
+
+def test_solver_log_sampling_cpsat(basetime,utcnow,monkeypatch):
+    """successful cpsat runs are sampled like z3 runs"""
+    pytest.importorskip('ortools')
+    monkeypatch.setitem(app.config, 'SOLVER_LOG_SAMPLE', 0)
+    u = mkuser('p')
+    mkavail(u, start_at=utcnow, length=hrs(12))
+    e = mkevent(u, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u.id])
+    run_solver(config=CPSAT)
+    assert isscheduled(e)
+    data = SolverLog.query.one().data
+    assert data['result_code'].startswith('cpsat_')
+    assert 'floaties' not in data and 'masks' not in data
+
+def test_solver_log_async(basetime,utcnow,monkeypatch):
+    """with SOLVER_LOG_ASYNC the record is handed to the task queue as json"""
+    monkeypatch.setitem(app.config, 'SOLVER_LOG_ASYNC', True)
+    records = []
+    monkeypatch.setattr(kron_app.tasks.task_write_solver_log, 'delay', records.append)
+    u = mkuser('p')
+    mkavail(u, start_at=utcnow, length=hrs(12))
+    e = mkevent(u, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u.id])
+    run_solver()
+    assert isscheduled(e)
+    assert SolverLog.query.count() == 0
+    [record] = records
+    write_solver_log(json.loads(json.dumps(record)))
+    data = SolverLog.query.one().data
+    assert data['basetime'] == basetime
+    assert [f['id'] for f in data['floaties']] == [str(e.id)]
+
+def test_build_problem_skips_claimed(basetime,utcnow):
+    """dirty events locked by another run are left dirty for it, and only what was claimed is cleared"""
+    u = mkuser('p')
+    e1 = mkevent(u, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u.id])
+    e2 = mkevent(u, length=hrs(1), wstart=basetime+days(2), wlength=hrs(3), attendees=[u.id])
+    db.session.commit()
+    with db.engine.connect() as other:
+        with other.begin():
+            other.execute(text("SELECT id FROM events WHERE id = :id FOR UPDATE"), dict(id=e2.id))
+            problemset, *_ = build_problem(utcnow)
+    assert problemset == {e1}
+    assert not e1.dirty
+    assert e2.dirty
+    problemset, *_ = build_problem(utcnow)
+    assert problemset == {e2}
+
+def test_failed_solve_leaves_events_dirty(basetime,utcnow,monkeypatch):
+    u1, u2 = mkuser('a'), mkuser('b')
+    e1 = mkevent(u1, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u1.id])
+    e2 = mkevent(u2, length=hrs(1), wstart=basetime, wlength=hrs(3), attendees=[u2.id])
+    mkavail(u1, start_at=utcnow, length=hrs(12))
+    mkavail(u2, start_at=utcnow, length=hrs(12))
+    db.session.commit()
+    monkeypatch.setattr(solver_module, 'solve_component',
+                        lambda floaties, config, masks: (False, None, 'timeout', config['timeout'], {}))
+    with pytest.raises(SolverError):
+        run_solver(config={'timeout': 60000})
+    #as log_error does when the task fails:
+    db.session.rollback()
+    assert e1.dirty and e2.dirty
+    problemset, *_ = build_problem(utcnow)
+    assert problemset == {e1, e2}
+
+def test_user_locks(testdb):
+    u1, u2 = mkuser('a'), mkuser('b')
+    def try_lock(conn, user_id):
+        return conn.execute(text("SELECT pg_try_advisory_lock(:cls, :id)"), dict(cls=USER_LOCK_CLASS, id=user_id)).scalar()
+    with db.engine.connect() as other:
+        with user_locks([u1.id]):
+            assert not try_lock(other, u1.id)
+            assert try_lock(other, u2.id)
+        assert try_lock(other, u1.id)
+        other.execute(text("SELECT pg_advisory_unlock_all()"))
+
 def test_adjacent_windows(basetime,utcnow):
     """test that adjacent windows don't cause meeting interaction"""
 
@@ -572,6 +710,21 @@ def test_problem_limits(basetime,utcnow):
     problemset, *_ = build_problem(utcnow, max_size=5, min_iterations=6)
     assert len(problemset)==7
 
+def test_problem_limits_prioritized(basetime,utcnow):
+    """when the problem is truncated, neighbors with more shared attendees and window go in first"""
+    u1 = mkuser('p')
+    u2 = mkuser('n')
+    e1 = mkevent(u1, length=mins(30), wstart=basetime, wlength=hrs(4), attendees=[u1.id,u2.id])
+    weak = mkevent(u2, length=mins(30), wstart=basetime+hrs(3), wlength=hrs(4), attendees=[u2.id])
+    strong = mkevent(u1, length=mins(30), wstart=basetime, wlength=hrs(4), attendees=[u1.id,u2.id])
+    medium = mkevent(u1, length=mins(30), wstart=basetime+hrs(1), wlength=hrs(4), attendees=[u1.id])
+    for e in [weak, strong, medium]:
+        mkclean(e)
+    mkdirty(e1)
+    problemset, _, _, prov = build_problem(utcnow, max_size=3)
+    assert problemset == {e1, strong, medium}
+    assert prov.elts[strong.id] == prov.elts[medium.id] == 'expand-0'
+
 
 # def test_extend_windows3():
 #   floaties=[FloatMeeting(id='11', attendees=['1'], optionalattendees=[], window_start=d(2022, 4, 1, 6, 0), window_end=d(2022, 4, 1, 8, 0), length=td(minutes=30), priority=None, is_optional=False, is_fixed=False)]
@@ -585,3 +738,117 @@ def test_problem_limits(basetime,utcnow):
 #   extensions = extend_windows(floaties,fixies, ["11"],now)
 #   print(extensions)
 #   assert(extensions=={'11': td(minutes=210)})
+
+def test_event_masks_cache(basetime, utcnow):
+    from kron_app.run_solver import event_masks, get_fixed_events, overlapping_draft
+    from kron_app.mask_utils import PWlinear, make_event_mask
+    u1 = mkuser()
+    u2 = mkuser()
+    u3 = mkuser()
+    mkavail(u1, basetime, hrs(8), recur=2)
+    mkavail(u1, basetime + days(1) + hrs(8), hrs(2), cost=1, recur=2)
+    mkavail(u2, basetime + hrs(1), hrs(6), recur='forever')
+    mkavail(u3, basetime + days(2), hrs(3), cost=2)
+    mkfixedevent(u1, start_at=basetime + hrs(2), length=hrs(1))
+    mkfixedevent(u2, start_at=basetime + days(2) - hrs(1), length=hrs(1))
+    mkfixedevent(u3, start_at=basetime + days(1) + hrs(3), length=mins(45))
+    d = mkevent(u1, length=hrs(1), wstart=basetime, wlength=days(3), attendees=[u2.id])
+    schedule(d, basetime + days(1) + hrs(1), [u2.id])
+    floaties = [
+        mkevent(u1, length=mins(30), wstart=basetime, wlength=days(2), attendees=[u1.id, u2.id], optionalattendees=[u3.id]),
+        mkevent(u2, length=hrs(2), wstart=basetime + days(2), wlength=days(5), attendees=[u2.id, u3.id]),
+        mkevent(u3, length=hrs(1), wstart=basetime + days(1), wlength=days(10), attendees=[u1.id, u3.id], optionalattendees=[u2.id]),
+    ]
+    masks = event_masks(floaties, utcnow, basetime)
+    floaty_ids = [str(e.id) for e in floaties]
+    for e in floaties:
+        all_attendees = e.attendees + e.optionalattendees
+        fixed_events = get_fixed_events(e.window_start, e.window_end, all_attendees)
+        fixed_drafts = [f for f in overlapping_draft(e.window_start, e.window_end, all_attendees) if str(f.id) not in floaty_ids]
+        emasks, optatt_masks = make_event_mask(e, fixed_events, fixed_drafts, utcnow, basetime)
+        assert masks[e.id].masks == emasks
+        assert masks[e.id].optatt_masks == optatt_masks
+    assert any(m.masks.ifneeded != PWlinear(0) for m in masks.values())
+
+def test_problem_data(basetime, utcnow):
+    from kron_app.run_solver import ProblemData, get_fixed_events, overlapping_draft
+    u1 = mkuser()
+    u2 = mkuser()
+    u3 = mkuser()
+    mkavail(u1, basetime, hrs(8), recur=3)
+    mkavail(u3, basetime + days(3), hrs(2), cost=1)
+    mkfixedevent(u1, start_at=basetime + hrs(2), length=hrs(1))
+    mkfixedevent(u2, start_at=basetime + days(1), length=hrs(1))
+    mkfixedevent(u3, start_at=basetime + days(4), length=hrs(1), kron_directive='@kron')
+    d = mkevent(u1, length=hrs(1), wstart=basetime, wlength=days(3), attendees=[u2.id, u3.id])
+    schedule(d, basetime + days(2), [u2.id, u3.id])
+    floaties = [
+        mkevent(u1, length=mins(30), wstart=basetime, wlength=days(1), attendees=[u1.id, u2.id]),
+        mkevent(u2, length=hrs(1), wstart=basetime + days(1), wlength=days(2), attendees=[u2.id], optionalattendees=[u3.id]),
+        mkevent(u3, length=hrs(1), wstart=basetime + days(2), wlength=days(7), attendees=[u3.id, u1.id]),
+    ]
+    data = ProblemData(floaties)
+    def key(f):
+        return (f.kind, f.start_at, f.end_at, f.calendar.user_id)
+    for e in floaties:
+        users = e.attendees + e.optionalattendees
+        assert [key(f) for f in data.fixed_events(e.window_start, e.window_end, users)] == \
+            [key(f) for f in get_fixed_events(e.window_start, e.window_end, users)]
+        assert set(data.drafts(e.window_start, e.window_end, users)) == \
+            set(overlapping_draft(e.window_start, e.window_end, users))
+    assert data.drafts(basetime, basetime + days(9), [u2.id]) == [d]
+    assert not data.covers(basetime, basetime + days(10), [u1.id])
+
+CPSAT = {'timeout': 60000, 'backend': 'cpsat'}
+
+def test_cpsat_schedule_highest_priority(utcnow, basetime):
+    pytest.importorskip('ortools')
+    u1 = mkuser('n')
+    u2 = mkuser('p')
+    u3 = mkuser('e')
+    e1 = mkevent(u1, length=hrs(1), wstart=basetime, wlength=hrs(1), attendees=[u1.id, u2.id])
+    e2 = mkevent(u3, length=hrs(1), wstart=basetime, wlength=hrs(1), attendees=[u1.id, u3.id])
+    schedule(e1, basetime, attendees=[u1.id, u2.id])
+    setpriority(e2, u1, 100)
+    for u in [u1, u2, u3]:
+        mkavail(u, start_at=utcnow, length=hrs(12))
+    run_solver(config=CPSAT)
+    assert isunscheduled(e1)
+    assert isscheduled(e2)
+
+def test_cpsat_keep_draft_time(utcnow, basetime):
+    pytest.importorskip('ortools')
+    u1 = mkuser('n')
+    u2 = mkuser('p')
+    e1 = mkevent(u1, length=hrs(1), wstart=basetime, wlength=hrs(2), attendees=[u1.id, u2.id])
+    e2 = mkevent(u2, length=hrs(1), wstart=basetime, wlength=hrs(2), attendees=[u1.id, u2.id])
+    schedule(e1, basetime + hrs(1), attendees=[u1.id, u2.id])
+    schedule(e2, basetime, attendees=[u1.id, u2.id])
+    mkavail(u1, start_at=utcnow, length=hrs(12))
+    mkavail(u2, start_at=utcnow, length=hrs(12))
+    run_solver(config=CPSAT)
+    assert e1.draft_start == basetime + hrs(1)
+    assert e2.draft_start == basetime
+
+def test_cpsat_matches_z3(utcnow, basetime):
+    pytest.importorskip('ortools')
+    u1 = mkuser('n')
+    u2 = mkuser('p')
+    u3 = mkuser('e')
+    mkavail(u1, start_at=basetime, length=hrs(6))
+    mkavail(u2, start_at=basetime + hrs(1), length=hrs(6))
+    mkavail(u3, start_at=basetime + hrs(4), length=hrs(2), cost=1)
+    mkfixedevent(u2, start_at=basetime + hrs(2), length=hrs(1))
+    events = [mkevent(u1, length=hrs(1), wstart=basetime, wlength=hrs(8), attendees=[u1.id, u2.id]),
+              mkevent(u1, length=mins(30), wstart=basetime, wlength=hrs(8), attendees=[u1.id], optionalattendees=[u3.id]),
+              mkevent(u2, length=hrs(2), wstart=basetime, wlength=hrs(8), attendees=[u2.id])]
+    results = []
+    for config in [{'timeout': 60000, 'backend': 'z3'}, CPSAT]:
+        for e in events:
+            unschedule(e)
+            mkdirty(e)
+        run_solver(config=config)
+        db.session.rollback()
+        results.append([(e.state, e.draft_start, set(e.draft_attendees)) for e in events])
+    assert all(isscheduled(e) for e in events)
+    assert results[0] == results[1]
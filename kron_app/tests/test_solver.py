@@ -0,0 +1,251 @@
+import math
+import pytest
+from copy import deepcopy
+from datetime import datetime, timedelta
+from kron_app.mask_utils import PWlinear, Edge, Topo
+import kron_app.solver.solver as solver_module
+from kron_app.solver.solver import solver, components, feasible_span, component_timeout, overlapping_pairs, pair_constraints
+from kron_app.solver.utils import FloatMeeting
+from kron_app.utils import DotDict
+
+basetime = datetime(2023,1,2,9)
+
+def window(start, end):
+  return PWlinear(math.inf, Edge(start,Topo.RIGHT), 0, Edge(end,Topo.LEFT), math.inf)
+
+def mkfloaty(id, attendees, start, end, length=1, optionalattendees=[]):
+  return DotDict({'id':id, 'attendees':attendees, 'optionalattendees':optionalattendees, 'length':length,
+                  'mask':window(start,end)})
+
+def test_feasible_span():
+  assert feasible_span(window(2,10), 3) == (2,13)
+  assert feasible_span(PWlinear(math.inf), 3) is None
+  assert feasible_span(PWlinear(math.inf, Edge(2,Topo.RIGHT), 0, Edge(4,Topo.LEFT), math.inf, Edge(8,Topo.RIGHT), 5, Edge(9,Topo.LEFT), math.inf), 1) == (2,10)
+
+def test_components():
+  floaties = [mkfloaty('a', ['1','2'], 0, 10),
+              mkfloaty('b', ['2'], 11, 20, length=2),   # shares 2 with a, but starts after a must end
+              mkfloaty('c', ['3'], 0, 10),
+              mkfloaty('d', ['3','4'], 5, 15),
+              mkfloaty('e', ['5'], 0, 0),
+              mkfloaty('f', ['4'], 14, 16, optionalattendees=['2']),  # joins d, and b via optional 2
+              mkfloaty('g', ['6'], 0, 5)]
+  floaties[4].mask = PWlinear(math.inf)
+  masks = {f.id: DotDict({'masks':{'hard':f.mask}}) for f in floaties}
+  groups = components(floaties, masks)
+  assert sorted(groups) == [[0], [1,2,3,5], [4], [6]]
+
+def pairs_problem(n=3):
+  #n pairs of meetings, each pair competing for the same slot of one user
+  floaties, masks = [], {}
+  for i in range(2*n):
+    users = [str(i//2)]
+    start = basetime + timedelta(hours=i//2)
+    floaties.append(FloatMeeting(id=str(i), attendees=users, window_start=start, window_end=start+timedelta(hours=2),
+                                 length=timedelta(hours=1), is_optional=True, priority=10*(i%2+1)))
+    masks[str(i)] = DotDict({'masks': {'hard': window(start, start),
+                                       'ifneeded': PWlinear(0),
+                                       'sooner': PWlinear(0)},
+                             'optatt_masks': {}})
+  return floaties, masks
+
+def test_decomposed_solve_matches_whole():
+  problem = pairs_problem
+  floaties, masks = problem()
+  whole = solver(floaties, basetime, masks=masks, config={'timeout':60000, 'decompose':False})
+  floaties, masks = problem()
+  decomposed = solver(floaties, basetime, masks=masks, config={'timeout':60000})
+  assert whole[0] and decomposed[0]
+  assert sorted(whole[2]) == sorted(decomposed[2]) == ['0','2','4']
+  assert sorted((d.id, d.start) for d in whole[1]) == sorted((d.id, d.start) for d in decomposed[1])
+
+def test_component_timeout():
+  assert component_timeout(1, 10, 60000) == 6000
+  assert component_timeout(3, 9, 54000) == 18000
+  assert component_timeout(6, 6, 36000) == 36000
+  assert component_timeout(1, 10, 60000, lanes=2) == 12000
+  assert component_timeout(6, 6, 60000, lanes=2) == 60000
+  assert component_timeout(1, 100, 60000) == 1000
+  assert component_timeout(2, 2, 500) == 1000
+
+def test_component_budget_carries_over(monkeypatch):
+  #small components finish at once, and the large one needs most of the timeout:
+  floaties, masks = pairs_problem(3)
+  end = basetime+timedelta(hours=4)
+  for i in range(6, 16):
+    floaties.append(FloatMeeting(id=str(i), attendees=['x'], window_start=basetime, window_end=end, length=timedelta(minutes=15)))
+    masks[str(i)] = DotDict({'masks': {'hard': window(basetime, end), 'ifneeded': PWlinear(0), 'sooner': PWlinear(0)},
+                             'optatt_masks': {}})
+  solve_component = solver_module.solve_component
+  def fake_solve_component(floaties, config, masks):
+    if len(floaties)>2 and config['timeout']<8000:
+      return False, None, 'timeout', config['timeout'], {}
+    return solve_component(floaties, config, masks)
+  monkeypatch.setattr(solver_module, 'solve_component', fake_solve_component)
+  stats = {}
+  result, schedule, unscheduled, result_code = solver(floaties, basetime, masks=masks, config={'timeout':10000}, stats=stats)
+  assert result
+  assert sorted(c['size'] for c in stats['components']) == [2, 2, 2, 10]
+  #with shares fixed up front by size the large component would get 10000*10/16, and time out:
+  big = next(c for c in stats['components'] if c['size']==10)
+  assert big['timeout'] >= 8000
+
+def test_partial_result():
+  floaties, masks = pairs_problem(2)
+  #a required meeting with no allowed start makes its component unsat:
+  floaties[0].is_optional = False
+  masks['0'].masks.hard = PWlinear(math.inf)
+  #by default a failed component fails the whole solve:
+  result, schedule, unscheduled, result_code = solver(deepcopy(floaties), basetime, masks=deepcopy(masks), config={'timeout':60000})
+  assert not result and schedule is None and unscheduled == []
+  stats = {}
+  result, schedule, unscheduled, result_code = solver(floaties, basetime, masks=masks, config={'timeout':60000}, stats=stats, partial=True)
+  assert result
+  #meeting 0 has no feasible span, so is a component on its own and meeting 1 is still scheduled:
+  assert [d.id for d in schedule] == ['1', '3']
+  assert unscheduled == ['2']
+  assert result_code == 'sat_1-lra_sat_1+unsat_1'
+  assert sorted((c['size'], c['result_code']) for c in stats['components']) == [(1, 'sat_1-lra_sat_1'), (1, 'unsat_1'), (2, 'sat_1-lra_sat_1')]
+
+def test_parallel_components():
+  floaties, masks = pairs_problem()
+  sequential = solver(floaties, basetime, masks=masks, config={'timeout':60000})
+  floaties, masks = pairs_problem()
+  stats = {}
+  parallel = solver(floaties, basetime, masks=masks, config={'timeout':60000, 'processes':2}, stats=stats)
+  assert parallel[0]
+  assert parallel[2] == sequential[2]
+  assert [(d.id, d.start) for d in parallel[1]] == [(d.id, d.start) for d in sequential[1]]
+  assert len(stats['components']) == 3
+  assert all(c['walltime'] is not None for c in stats['components'])
+
+def test_pair_constraints():
+  floaties = [mkfloaty('a', ['1','2'], 0, 10),
+              mkfloaty('b', ['2'], 11, 20),
+              mkfloaty('c', ['1'], 5, 15),
+              mkfloaty('d', ['3'], 0, 30),
+              mkfloaty('e', ['1'], 0, 0)]
+  floaties[4].mask = PWlinear(math.inf)
+  masks = {f.id: DotDict({'masks':{'hard':f.mask}}) for f in floaties}
+  assert overlapping_pairs(floaties, masks) == [(2,0), (2,1), (3,0), (3,1), (3,2)]  # a ends as b can start
+  assert pair_constraints(floaties, masks) == [(2,0)]
+  assert pair_constraints(floaties, masks, prune=False) == [(1,0), (2,0), (4,0), (4,2)]
+
+def incremental_problem(b_start, b_end):
+  #a is scheduled and pinned, b is new and competes with a for user 0
+  floaties, masks = [], {}
+  for id,start,end,draft,priority in [('a',basetime,basetime+timedelta(hours=2),basetime+timedelta(hours=1),10),
+                                      ('b',b_start,b_end,None,20)]:
+    floaties.append(FloatMeeting(id=id, attendees=['0'], window_start=basetime, window_end=basetime+timedelta(hours=3),
+                                 length=timedelta(hours=1), is_optional=True, priority=priority, draft_start=draft))
+    masks[id] = DotDict({'masks': {'hard': window(start, end),
+                                   'ifneeded': PWlinear(0),
+                                   'sooner': PWlinear(0)},
+                         'optatt_masks': {}})
+  return floaties, masks
+
+def test_incremental_pinned():
+  floaties, masks = incremental_problem(basetime, basetime+timedelta(hours=2))
+  stats = {}
+  result, schedule, unscheduled, _ = solver(floaties, basetime, masks=masks, config={'timeout':60000}, stats=stats, pinned=['a'])
+  assert result and unscheduled == []
+  assert stats['incremental'] == {'pinned':1, 'widened':False}
+  starts = {d.id: d.start for d in schedule}
+  assert starts['a'] == basetime+timedelta(hours=1)
+  assert starts['b'] in (basetime, basetime+timedelta(hours=2))
+
+def test_incremental_widens():
+  #b can only go at a's draft time, so a has to move
+  b_start = basetime+timedelta(hours=1)
+  floaties, masks = incremental_problem(b_start, b_start)
+  stats = {}
+  result, schedule, unscheduled, _ = solver(floaties, basetime, masks=masks, config={'timeout':60000}, stats=stats, pinned=['a'])
+  assert result and unscheduled == []
+  assert stats['incremental'] == {'pinned':1, 'widened':True}
+  starts = {d.id: d.start for d in schedule}
+  assert starts['b'] == b_start
+  assert starts['a'] in (basetime, basetime+timedelta(hours=2))
+
+def test_incremental_widening_shares_timeout(monkeypatch):
+  #each component takes all of its timeout, on a fake clock:
+  clock, timeouts = [0], []
+  solve_component = solver_module.solve_component
+  def slow_solve_component(floaties, config, masks):
+    timeouts.append(config['timeout'])
+    clock[0] += config['timeout']/1000
+    return solve_component(floaties, config, masks)
+  monkeypatch.setattr(solver_module, 'monotonic', lambda: clock[0])
+  monkeypatch.setattr(solver_module, 'solve_component', slow_solve_component)
+  b_start = basetime+timedelta(hours=1)
+  floaties, masks = incremental_problem(b_start, b_start)
+  stats = {}
+  result, schedule, unscheduled, _ = solver(floaties, basetime, masks=masks, config={'timeout':60000}, stats=stats, pinned=['a'])
+  assert result and stats['incremental']['widened']
+  assert timeouts == [15000, 45000]
+
+def test_warm_start():
+  floaties, masks = incremental_problem(basetime, basetime+timedelta(hours=2))
+  stats = {}
+  result, schedule, unscheduled, _ = solver(floaties, basetime, masks=masks, config={'timeout':60000}, stats=stats)
+  assert result and unscheduled == []
+  assert stats['components'][0]['warm_start']['feasible']
+  assert {d.id: d.start for d in schedule}['a'] == basetime+timedelta(hours=1)
+  #b is required and can only go at a's draft time, so the previous schedule is no longer a model:
+  b_start = basetime+timedelta(hours=1)
+  floaties, masks = incremental_problem(b_start, b_start)
+  floaties[1].is_optional = False
+  stats = {}
+  result, schedule, unscheduled, _ = solver(floaties, basetime, masks=masks, config={'timeout':60000}, stats=stats)
+  assert result and unscheduled == []
+  assert not stats['components'][0]['warm_start']['feasible']
+  assert {d.id: d.start for d in schedule}['b'] == b_start
+
+def test_warm_start_shares_timeout(monkeypatch):
+  timeouts = []
+  two_pass_optimize = solver_module.two_pass_optimize
+  def recording_two_pass_optimize(objectives, constraints, config, initial=None):
+    timeouts.append(config['timeout'])
+    return two_pass_optimize(objectives, constraints, config, initial=initial)
+  monkeypatch.setattr(solver_module, 'two_pass_optimize', recording_two_pass_optimize)
+  #a check that takes 5s:
+  warm_start = solver_module.warm_start
+  monkeypatch.setattr(solver_module, 'warm_start', lambda floaties, constraints, config: (warm_start(floaties, constraints, config)[0], 5000))
+  floaties, masks = incremental_problem(basetime, basetime+timedelta(hours=2))
+  solver(floaties, basetime, masks=masks, config={'timeout':60000})
+  #the wmax pass gets what the warm start check left:
+  assert timeouts[0] == 55000
+
+def test_table_mask_encoding():
+  for problem in [pairs_problem, lambda: incremental_problem(basetime, basetime+timedelta(hours=2))]:
+    schedules, sizes = [], []
+    for encoding in ['iftree', 'table']:
+      floaties, masks = problem()
+      #prefer later starts, so the penalty has to be read from the mask:
+      for m in masks.values():
+        m.masks.sooner = PWlinear(2, Edge(basetime+timedelta(hours=1),Topo.LEFT), 1, Edge(basetime+timedelta(hours=2),Topo.LEFT), 0)
+      stats = {}
+      result, schedule, unscheduled, _ = solver(floaties, basetime, masks=masks, stats=stats,
+                                                config={'timeout':60000, 'decompose':False, 'mask_encoding':encoding, 'formula_stats':True})
+      assert result
+      schedules.append((sorted((d.id, d.start) for d in schedule), unscheduled))
+      sizes.append(stats['components'][0]['formula_size'])
+    assert schedules[0] == schedules[1]
+    assert sizes[1] < sizes[0]
+
+def test_cpsat_optatt_weights(capsys):
+  pytest.importorskip('ortools')
+  from kron_app.solver.cpsat import optatt_weights
+  def mkmeeting(id, priorities):
+    return DotDict({'id':id, 'optionalattendees':list(priorities), 'optionalattendeepriorities':priorities})
+  #exact when the lcm of the totals is small enough:
+  scale, weights = optatt_weights([mkmeeting('a', {'1':1, '2':2}), mkmeeting('b', {'3':1}), mkmeeting('c', {})])
+  assert scale == 3
+  assert weights == {'a': {'1':1, '2':2}, 'b': {'3':3}}
+  assert 'clamped' not in capsys.readouterr().out
+  #totals 1009 and 1013 (primes) have an lcm over the limit, so each weight is rounded rather than truncated:
+  scale, weights = optatt_weights([mkmeeting('a', {'1':1, '2':1008}), mkmeeting('b', {'3':13, '4':1000})])
+  assert scale == 10**6
+  assert weights['a'] == {'1':991, '2':999009}
+  assert weights['b'] == {'3':12833, '4':987167}
+  assert all(abs(sum(w.values())-scale) <= 1 for w in weights.values())
+  assert 'clamped to 1000000' in capsys.readouterr().out
@@ -0,0 +1,115 @@
+import json
+import math
+import random
+import pytest
+from datetime import datetime, timedelta
+from kron_app.mask_utils import PWlinear, Edge, Topo, mk_path, pw_sum
+from kron_app.models import SolverLog
+from kron_app.run_solver import ProvSet
+from kron_app.solver_log import dumps, loads, parse_repr, VERSION
+from kron_app.utils import DotDict
+
+basetime = datetime(2023, 1, 2, 9)
+
+def payload():
+    mask = PWlinear(math.inf, Edge(basetime, Topo.RIGHT), (0.5, 2), Edge(basetime + timedelta(hours=3, microseconds=7), Topo.LEFT), math.inf)
+    floaty = dict(id='1', attendees=['1'], optionalattendees=['2'], optionalattendeepriorities={'2': 1},
+                  window_start=basetime, window_end=basetime + timedelta(days=1), freeze_horizon=timedelta(hours=1),
+                  length=timedelta(minutes=30), priority=10, is_optional=True, is_fixed=False, final=False,
+                  draft_start=None, repair_prefs='extend')
+    schedule = [DotDict({'id': '1', 'start': basetime, 'end': basetime + timedelta(minutes=30), 'actualattendees': ['1']})]
+    prov = ProvSet().update([DotDict({'id': 1})], 'initFloat')
+    return dict(pid=1, caller='main', result_code='sat_1-lra_sat_1', components=[dict(size=1)],
+                result=(True, schedule, [], 'sat_1-lra_sat_1'), floaties=[floaty], now=basetime, basetime=basetime,
+                masks=DotDict({'1': DotDict({'masks': DotDict({'hard': mask, 'sooner': PWlinear(0)}),
+                                             'optatt_masks': DotDict({'2': PWlinear(1)})})}),
+                problem_prov=prov,
+                overlapping={'1': {'fixed': [dict(id=3, start_at=basetime, end_at=basetime + timedelta(hours=1))], 'float': []}})
+
+def test_round_trip():
+    data = payload()
+    back = loads(dumps(data))
+    assert back['floaties'] == data['floaties']
+    assert back['masks'] == data['masks']
+    assert back['masks']['1'].masks.hard == data['masks']['1'].masks.hard
+    assert back['result'] == [True, data['result'][1], [], 'sat_1-lra_sat_1']
+    assert back['now'] == back['basetime'] == basetime
+    assert back['problem_prov'] == {1: 'initFloat'}
+    assert back['overlapping'] == data['overlapping']
+    assert back['components'] == [dict(size=1)]
+    assert back['version'] == VERSION
+
+def test_legacy():
+    data = payload()
+    legacy = json.dumps(data, default=repr)
+    back = loads(legacy)
+    assert back['floaties'] == data['floaties']
+    assert back['masks'] == data['masks']
+    assert back['result'][1] == data['result'][1]
+    assert back['basetime'] == basetime
+    assert back['problem_prov'] == {1: 'initFloat'}
+    assert back['overlapping'] == data['overlapping']
+
+def test_parse_repr_is_safe():
+    assert parse_repr("datetime.timedelta(seconds=60)") == timedelta(minutes=1)
+    assert parse_repr("PWlinear(*[(0, inf), Edge(datetime.datetime(2023, 1, 2, 9, 0),Topo.RIGHT), (0, -1.5)])") == \
+        PWlinear(math.inf, Edge(basetime, Topo.RIGHT), -1.5)
+    for s in ["__import__('os').getcwd()", "datetime.datetime.now()", "(lambda: 1)()", "open('x')"]:
+        with pytest.raises(ValueError):
+            parse_repr(s)
+
+def test_solver_log_data(testdb):
+    data = payload()
+    log = SolverLog(data=data)
+    assert len(log.jsondata) < len(json.dumps(data, default=repr))
+    assert log.data['masks'] == data['masks']
+
+def multi_user_payload():
+    # 20 floaties over 8 users and a working week, with masks made the
+    # way event_masks makes them: busy blocks and ifneeded ramps.
+    random.seed(0)
+    def start():
+        return basetime + timedelta(minutes=15*random.randint(0, 4*24*5))
+    def busy_mask(n):
+        blocks = []
+        for _ in range(n):
+            s = start()
+            blocks.append(PWlinear(0, Edge(s - timedelta(minutes=30), Topo.LEFT), math.inf, Edge(s + timedelta(minutes=15*random.randint(2, 8)), Topo.RIGHT), 0))
+        return pw_sum(blocks)
+    def ifneeded_mask(n):
+        mask = PWlinear(0)
+        for _ in range(n):
+            s = start()
+            e = s + timedelta(minutes=15*random.randint(2, 12))
+            cost = random.choice([0.5, 1, 2])*250
+            mask.plus(mk_path((s - timedelta(minutes=30), 0), (s, cost), basetime=basetime))
+            mask.plus(mk_path((e - timedelta(minutes=30), 0), (e, -cost), basetime=basetime))
+        return mask
+    data = payload()
+    floaty = data['floaties'][0]
+    users = [str(u) for u in range(8)]
+    data['floaties'], data['masks'] = [], DotDict({})
+    for i in range(20):
+        attendees = random.sample(users, 4)
+        data['floaties'].append(dict(floaty, id=str(i), attendees=attendees[:3], optionalattendees=attendees[3:],
+                                     optionalattendeepriorities={attendees[3]: 1}))
+        data['masks'][str(i)] = DotDict({'masks': DotDict({'hard': busy_mask(25), 'ifneeded': ifneeded_mask(15),
+                                                           'sooner': mk_path((basetime, 0), (basetime + timedelta(days=5), 100), basetime=basetime)}),
+                                         'optatt_masks': DotDict({attendees[3]: busy_mask(20)})})
+    return data
+
+def test_solver_log_size():
+    data = multi_user_payload()
+    legacy = json.dumps(data, default=repr)
+    stored = dumps(data)
+    assert len(legacy) >= 5*len(stored)
+    assert loads(stored)['masks'] == data['masks']
+
+def test_solver_log_summary(testdb):
+    data = payload()
+    log = SolverLog(data=data)
+    assert log.summary == dict(pid=1, cputime=None, walltime=None, mem_rss_before=None, mem_rss_after=None,
+                               mem_available=None, caller='main', result_code='sat_1-lra_sat_1', problem_size=None)
+    #entries logged before the summary was stored fall back to the payload:
+    legacy = SolverLog(jsondata=json.dumps(data, default=repr))
+    assert legacy.summary == log.summary
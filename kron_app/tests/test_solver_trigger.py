@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+from kron_app import app
+import kron_app.tasks as tasks
+from kron_app.solver_trigger import request_solver_run, solver_run_wait, claim_solver_run, clear_solver_requests
+
+def secs(n):
+    return timedelta(seconds=n)
+
+def test_requests_are_coalesced(testdb, utcnow, monkeypatch):
+    monkeypatch.setitem(app.config, 'SOLVER_DEBOUNCE', secs(10))
+    monkeypatch.setitem(app.config, 'SOLVER_MAX_LATENCY', secs(60))
+    assert solver_run_wait(utcnow) is None
+    assert request_solver_run(utcnow)
+    assert solver_run_wait(utcnow) == secs(10)
+    assert solver_run_wait(utcnow + secs(4)) == secs(6)
+    # A later request pushes the run back...
+    assert not request_solver_run(utcnow + secs(5))
+    assert solver_run_wait(utcnow + secs(5)) == secs(10)
+    assert solver_run_wait(utcnow + secs(15)) == secs(0)
+    # ...but not past the max latency.
+    for i in range(10, 60, 5):
+        assert not request_solver_run(utcnow + secs(i))
+    assert solver_run_wait(utcnow + secs(55)) == secs(5)
+    assert solver_run_wait(utcnow + secs(70)) == secs(0)
+    clear_solver_requests()
+    assert solver_run_wait(utcnow + secs(70)) is None
+    assert request_solver_run(utcnow + secs(80))
+
+def test_claim_solver_run(testdb, utcnow, monkeypatch):
+    monkeypatch.setitem(app.config, 'SOLVER_DEBOUNCE', secs(10))
+    monkeypatch.setitem(app.config, 'SOLVER_MAX_LATENCY', secs(60))
+    assert not claim_solver_run(utcnow)
+    request_solver_run(utcnow)
+    assert not claim_solver_run(utcnow + secs(5))
+    assert claim_solver_run(utcnow + secs(10))
+    assert not claim_solver_run(utcnow + secs(10))
+    assert solver_run_wait(utcnow + secs(10)) is None
+
+def test_one_run_per_request(testdb, monkeypatch):
+    monkeypatch.setitem(app.config, 'SOLVER_DEBOUNCE', secs(10))
+    runs = []
+    monkeypatch.setattr(tasks, 'run_solver', lambda now: runs.append(now) or ([], []))
+    request_solver_run(datetime.utcnow() - secs(20))
+    # The periodic task finds the run due while the queued task is
+    # between its own check and its run.
+    raced = []
+    def solver_run_wait_racing():
+        wait = solver_run_wait()
+        if not raced:
+            raced.append(True)
+            tasks.task_solver_requested()
+        return wait
+    monkeypatch.setattr(tasks, 'solver_run_wait', solver_run_wait_racing)
+    tasks.task_solver_requested()
+    assert len(runs) == 1
@@ -30,6 +30,10 @@ setup(
         'dev': [
             'pytest',
             'sqlalchemy-utils',
+            'hypothesis',
+        ],
+        'cpsat': [
+            'ortools',
         ],
     },
 )